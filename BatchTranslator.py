@@ -0,0 +1,166 @@
+import argparse
+import copy
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import VMTranslator
+from VMTranslator import (find_program_files, parse_args,
+                          split_translator_args, translate_program)
+
+
+# Translator arguments of the programs translated by this process, set by
+# init_worker
+worker_args = None
+
+
+def read_manifest(path):
+    """
+    Returns the program paths or glob patterns listed in a manifest, one
+    per line; blank lines and lines starting with '#' are skipped.
+    """
+    with open(path, 'r') as file:
+        return [line.strip() for line in file
+                if line.strip() and not line.lstrip().startswith('#')]
+
+
+def expand_inputs(patterns):
+    """
+    Expands program paths and glob patterns into the distinct program
+    paths, in a stable order. Patterns that match nothing are kept, so
+    that they are reported as failed programs.
+    """
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            paths.append(pattern)
+    return list(dict.fromkeys(os.path.normpath(path) for path in paths))
+
+
+def init_worker(translator_args):
+    """
+    Prepares a worker process: parses the translator arguments once and
+    shares the compiled CodeWriter templates across all its programs.
+    """
+    global worker_args
+    worker_args = parse_args(['.'] + translator_args)
+    # Programs are the unit of parallelism, so each is translated serially
+    worker_args.jobs = 1
+    VMTranslator.shared_templates = {}
+
+
+def translate_one(input_path):
+    """
+    Translates one program with the worker's arguments. Returns its
+    summary record; a failure is recorded instead of raised, so it does
+    not affect the other programs.
+    """
+    start = time.perf_counter()
+    record = {'path': input_path}
+    try:
+        args = copy.copy(worker_args)
+        args.input_path = input_path
+        output_path, files_to_translate = find_program_files(
+            input_path, args.output_format)
+        result = translate_program(files_to_translate, output_path, args)
+        code_writer = result['code_writer']
+        rom_words = code_writer.instruction_count
+        if code_writer.peephole:
+            rom_words -= code_writer.peephole.words_saved
+        record.update(status='ok', output=output_path,
+                      files=len(files_to_translate),
+                      output_bytes=os.path.getsize(output_path),
+                      rom_words=rom_words)
+    except Exception as e:
+        # Any error, including one from malformed input that the parser
+        # does not anticipate, fails only this program
+        record.update(status='error', error=f'{type(e).__name__}: {e}')
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+def translate_batch(paths, translator_args, n_jobs=1):
+    """
+    Translates many programs with the same translator arguments, in a
+    pool of n_jobs warm worker processes when n_jobs > 1. Returns the
+    summary record of each program, in the order of paths.
+    """
+    if n_jobs > 1 and len(paths) > 1:
+        # Hand out programs in chunks to keep the per-program overhead low
+        chunk_size = max(1, len(paths) // (n_jobs * 8))
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=init_worker,
+                                 initargs=(translator_args,)) as pool:
+            return list(pool.map(translate_one, paths, chunksize=chunk_size))
+    init_worker(translator_args)
+    return [translate_one(path) for path in paths]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Translates many VM programs in one process, each a '
+                    '.vm file or a directory of .vm files, and writes a '
+                    'JSON summary with the status, time and output size '
+                    'of each program.',
+        epilog='Arguments after -- are passed to the translator, e.g. '
+               '"-- -O1 --output-format hack".')
+    arg_parser.add_argument(
+        'inputs', nargs='*',
+        help='program paths or glob patterns, e.g. "submissions/*"')
+    arg_parser.add_argument(
+        '--manifest', action='append', default=[],
+        help='file listing one program path or glob pattern per line, may '
+             'be repeated')
+    arg_parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='number of worker processes (default: %(default)s)')
+    arg_parser.add_argument(
+        '--summary', help='write the JSON summary to this file')
+    argv, translator_args = split_translator_args(sys.argv[1:])
+    args = arg_parser.parse_args(argv)
+
+    # Validates the translator arguments before any worker starts
+    translate_args = parse_args(['.'] + translator_args)
+    if translate_args.profile or translate_args.cprofile is not None:
+        arg_parser.error('--profile and --cprofile are not supported in '
+                         'batch mode')
+
+    patterns = list(args.inputs)
+    for manifest in args.manifest:
+        patterns.extend(read_manifest(manifest))
+    paths = expand_inputs(patterns)
+    if not paths:
+        arg_parser.error('no programs given')
+
+    start = time.perf_counter()
+    records = translate_batch(paths, translator_args, args.jobs)
+    seconds = time.perf_counter() - start
+
+    failed = [record for record in records if record['status'] != 'ok']
+    summary = {
+        'translator_args': translator_args,
+        'seconds': seconds,
+        'programs': len(records),
+        'failed': len(failed),
+        'results': records,
+    }
+    if args.summary:
+        with open(args.summary, 'w') as file:
+            json.dump(summary, file, indent=2)
+            file.write('\n')
+
+    for record in failed:
+        print(f'FAILED {record["path"]}: {record["error"]}')
+    print(f'Translated {len(records) - len(failed)} of {len(records)} '
+          f'programs in {seconds:.2f} s '
+          f'({seconds / len(records) * 1000:.2f} ms per program)')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
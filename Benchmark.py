@@ -0,0 +1,447 @@
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from Parser import Parser
+from HackAssembler import assemble
+from HackEmulator import HackEmulator
+from VMTranslator import (apply_profile, new_code_writer, parse_args,
+                          run_whole_program_passes, uses_whole_program,
+                          write_program)
+
+
+# Number of words in the Hack ROM; larger programs are not emulated
+ROM_SIZE = 32768
+
+# Label that ends every generated Sys.init in a halt loop
+HALT = ['label Sys.init$HALT', 'goto Sys.init$HALT']
+
+
+def sys_file(body):
+    """Returns a Sys.vm that runs the given commands and then halts."""
+    return '\n'.join(['function Sys.init 0'] + body + HALT) + '\n'
+
+
+def generate_call_chain(scale):
+    """
+    A deep call chain: Sys.init repeatedly calls Chain.f0, which calls
+    Chain.f1 and so on, each adding one to its argument.
+    """
+    depth = 150
+    chain = []
+    for i in range(depth):
+        chain += [f'function Chain.f{i} 0',
+                  'push argument 0', 'push constant 1', 'add',
+                  f'call Chain.f{i + 1} 1', 'return']
+    chain += [f'function Chain.f{depth} 0', 'push argument 0', 'return']
+    return {
+        'Sys': sys_file([
+            f'push constant {10 * scale}', 'pop static 0',
+            'label Sys.init$LOOP',
+            'push constant 0', 'call Chain.f0 1', 'pop static 1',
+            'push static 0', 'push constant 1', 'sub', 'pop static 0',
+            'push static 0', 'push constant 0', 'gt',
+            'if-goto Sys.init$LOOP',
+        ]),
+        'Chain': '\n'.join(chain) + '\n',
+    }
+
+
+def generate_loops(scale):
+    """
+    Tight nested counting loops over local variables, summing the inner
+    loop counter.
+    """
+    return {
+        'Sys': sys_file([
+            f'push constant {20 * scale}', 'push constant 50',
+            'call Loops.run 2', 'pop static 0',
+        ]),
+        'Loops': '\n'.join([
+            'function Loops.run 3',
+            'label Loops.run$OUTER',
+            'push local 0', 'push argument 0', 'lt', 'not',
+            'if-goto Loops.run$DONE',
+            'push constant 0', 'pop local 1',
+            'label Loops.run$INNER',
+            'push local 1', 'push argument 1', 'lt', 'not',
+            'if-goto Loops.run$NEXT',
+            'push local 2', 'push local 1', 'add', 'pop local 2',
+            'push local 1', 'push constant 1', 'add', 'pop local 1',
+            'goto Loops.run$INNER',
+            'label Loops.run$NEXT',
+            'push local 0', 'push constant 1', 'add', 'pop local 0',
+            'goto Loops.run$OUTER',
+            'label Loops.run$DONE',
+            'push local 2', 'return',
+        ]) + '\n',
+    }
+
+
+def generate_arithmetic(scale):
+    """
+    Long straight-line arithmetic on locals, statics and constants,
+    generated from a fixed seed so every run benchmarks the same code.
+    """
+    rng = random.Random(12)
+    operations = ['add', 'sub', 'and', 'or', 'eq', 'lt', 'gt']
+    segments = ['local', 'static', 'constant', 'temp']
+    body = []
+    for _ in range(600 * scale):
+        for _ in range(2):
+            segment = rng.choice(segments)
+            body.append(f'push {segment} {rng.randrange(8)}')
+        body.append(rng.choice(operations))
+        if rng.random() < 0.3:
+            body.append(rng.choice(['neg', 'not']))
+        segment = rng.choice(['local', 'static', 'temp'])
+        body.append(f'pop {segment} {rng.randrange(8)}')
+    return {
+        'Sys': sys_file(['call Arith.compute 0', 'pop temp 0']),
+        'Arith': '\n'.join(['function Arith.compute 8'] + body +
+                           ['push local 0', 'return']) + '\n',
+    }
+
+
+def generate_many_files(scale):
+    """
+    A directory of many small classes, each with a few functions using its
+    own statics, all called from Sys.init.
+    """
+    files = {}
+    calls = []
+    for k in range(30 * scale):
+        class_name = f'Class{k}'
+        functions = []
+        for f in range(5):
+            functions += [
+                f'function {class_name}.f{f} 1',
+                'push argument 0', f'push static {f}', 'add',
+                'pop local 0',
+                'push local 0', f'pop static {f}',
+                'push local 0', 'return',
+            ]
+            calls += [f'push constant {f}', f'call {class_name}.f{f} 1',
+                      'pop temp 0']
+        files[class_name] = '\n'.join(functions) + '\n'
+    files['Sys'] = sys_file(calls)
+    return files
+
+
+def generate_fibonacci(scale):
+    """The classic recursive Fibonacci function."""
+    return {
+        'Sys': sys_file([f'push constant {12 + scale}',
+                         'call Main.fibonacci 1', 'pop static 0']),
+        'Main': '\n'.join([
+            'function Main.fibonacci 0',
+            'push argument 0', 'push constant 2', 'lt',
+            'if-goto Main.fibonacci$BASE',
+            'push argument 0', 'push constant 2', 'sub',
+            'call Main.fibonacci 1',
+            'push argument 0', 'push constant 1', 'sub',
+            'call Main.fibonacci 1',
+            'add', 'return',
+            'label Main.fibonacci$BASE',
+            'push argument 0', 'return',
+        ]) + '\n',
+    }
+
+
+def generate_bubble_sort(scale):
+    """Fills an array in the heap in descending order and bubble sorts it."""
+    return {
+        'Sys': sys_file([f'push constant {20 * scale}', 'call Sort.run 1',
+                         'pop temp 0']),
+        'Sort': '\n'.join([
+            # Fill RAM[2048..2048+n) with n, n-1, ..., 1
+            'function Sort.run 3',
+            'label Sort.run$FILL',
+            'push local 0', 'push argument 0', 'lt', 'not',
+            'if-goto Sort.run$SORT',
+            'push constant 2048', 'push local 0', 'add', 'pop pointer 1',
+            'push argument 0', 'push local 0', 'sub', 'pop that 0',
+            'push local 0', 'push constant 1', 'add', 'pop local 0',
+            'goto Sort.run$FILL',
+            'label Sort.run$SORT',
+            'push argument 0', 'push constant 1', 'sub', 'pop local 0',
+            'label Sort.run$PASS',
+            'push local 0', 'push constant 0', 'gt', 'not',
+            'if-goto Sort.run$DONE',
+            'push constant 0', 'pop local 1',
+            'label Sort.run$SWEEP',
+            'push local 1', 'push local 0', 'lt', 'not',
+            'if-goto Sort.run$NEXT',
+            'push constant 2048', 'push local 1', 'add', 'pop pointer 1',
+            'push that 0', 'push that 1', 'gt', 'not',
+            'if-goto Sort.run$KEEP',
+            'push that 0', 'pop local 2',
+            'push that 1', 'pop that 0',
+            'push local 2', 'pop that 1',
+            'label Sort.run$KEEP',
+            'push local 1', 'push constant 1', 'add', 'pop local 1',
+            'goto Sort.run$SWEEP',
+            'label Sort.run$NEXT',
+            'push local 0', 'push constant 1', 'sub', 'pop local 0',
+            'goto Sort.run$PASS',
+            'label Sort.run$DONE',
+            'push constant 0', 'return',
+        ]) + '\n',
+    }
+
+
+# Generator of each benchmark program, given the scale factor
+PROGRAMS = {
+    'call_chain': generate_call_chain,
+    'loops': generate_loops,
+    'arithmetic': generate_arithmetic,
+    'many_files': generate_many_files,
+    'fibonacci': generate_fibonacci,
+    'bubble_sort': generate_bubble_sort,
+}
+
+
+def write_program_files(directory, files):
+    """Writes a generated program as one .vm file per class."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for file_name, text in sorted(files.items()):
+        path = os.path.join(directory, file_name + '.vm')
+        with open(path, 'w') as file:
+            file.write(text)
+        paths.append(path)
+    return paths
+
+
+def translate_timed(vm_paths, output_path, args):
+    """
+    Translates the .vm files to output_path, timing the parse, code
+    generation and write stages separately. Returns (assembly_text,
+    command_count, timings).
+    """
+    has_sys = any(os.path.basename(path).lower() == 'sys.vm'
+                  for path in vm_paths)
+
+    start = time.perf_counter()
+    interned = {}
+    programs = [(os.path.splitext(os.path.basename(path))[0],
+                 list(Parser(path, streaming=True).commands(interned)))
+                for path in vm_paths]
+    if args.profile_use:
+        apply_profile(args)
+    if uses_whole_program(args):
+        programs = run_whole_program_passes(programs, has_sys, args)[0]
+    parse_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    buffer = io.StringIO()
+    code_writer = new_code_writer(buffer, args)
+    write_program(code_writer,
+                  [(file_name, None, commands, args)
+                   for file_name, commands in programs],
+                  has_sys, args.jobs)
+    code_writer.flush()
+    assembly_text = buffer.getvalue()
+    codegen_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(output_path, 'w') as file:
+        file.write(assembly_text)
+    write_seconds = time.perf_counter() - start
+
+    command_count = sum(len(commands) for _, commands in programs)
+    return assembly_text, command_count, {
+        'parse_seconds': parse_seconds,
+        'codegen_seconds': codegen_seconds,
+        'write_seconds': write_seconds,
+    }
+
+
+def run_benchmark(name, files, work_dir, args, repeat, max_cycles):
+    """
+    Translates one generated program repeat times, keeping the fastest
+    time of each stage, and measures the ROM size of its output and, with
+    max_cycles, the cycles it runs for on the emulator if it fits in ROM.
+    """
+    program_dir = os.path.join(work_dir, name)
+    vm_paths = write_program_files(program_dir, files)
+    output_path = os.path.join(program_dir, name + '.asm')
+
+    best = None
+    for _ in range(repeat):
+        assembly_text, command_count, timings = translate_timed(
+            vm_paths, output_path, args)
+        if best is None:
+            best = timings
+        else:
+            best = {stage: min(seconds, timings[stage])
+                    for stage, seconds in best.items()}
+
+    words, _, _ = assemble(assembly_text.splitlines())
+    translate_seconds = best['parse_seconds'] + best['codegen_seconds']
+    result = {
+        'files': len(vm_paths),
+        'commands': command_count,
+        **best,
+        'commands_per_second': command_count / translate_seconds,
+        'rom_words': len(words),
+    }
+    if max_cycles and len(words) <= ROM_SIZE:
+        emulator = HackEmulator(words)
+        emulator.run(max_cycles, profile=False)
+        result['cycles'] = emulator.cycles
+        result['halted'] = emulator.halted
+    return result
+
+
+# Metrics where a larger value is a regression; timings are noisy and are
+# compared with a threshold, the code generation metrics are exact
+TIMING_METRICS = ('parse_seconds', 'codegen_seconds', 'write_seconds')
+CODEGEN_METRICS = ('rom_words', 'cycles')
+
+# Timing differences below this many seconds are treated as noise
+MIN_TIMING_DELTA = 0.001
+
+
+def compare_results(results, baseline, threshold):
+    """
+    Compares benchmark results with baseline results. Returns a list of
+    regression messages: stage timings more than threshold (a fraction)
+    slower than the baseline, and any growth in ROM size or cycles.
+    """
+    regressions = []
+    for setting in ('translator_args', 'scale'):
+        if results.get(setting) != baseline.get(setting):
+            regressions.append(
+                f'{setting} {results.get(setting)} differs from baseline '
+                f'{baseline.get(setting)}')
+    for name, result in results['programs'].items():
+        base = baseline['programs'].get(name)
+        if base is None:
+            continue
+        for metric in TIMING_METRICS + CODEGEN_METRICS:
+            if metric not in result or metric not in base:
+                continue
+            limit = base[metric]
+            if metric in TIMING_METRICS:
+                limit = max(limit * (1 + threshold),
+                            limit + MIN_TIMING_DELTA)
+            if result[metric] > limit:
+                regressions.append(
+                    f'{name}: {metric} {result[metric]:.6g} > baseline '
+                    f'{base[metric]:.6g}')
+    return regressions
+
+
+def compare_opt_levels(names, scale, levels, translator_args, work_dir,
+                       max_cycles):
+    """
+    Translates each program at each optimization level, once, and returns
+    the ROM size versus cycle count table as printable lines.
+    """
+    lines = ['Program      ' + ''.join(
+        f'{"-O" + level:>23}' for level in levels)]
+    lines.append(' ' * 13 + '         ROM     cycles' * len(levels))
+    for name in names:
+        files = PROGRAMS[name](scale)
+        row = f'{name:<12} '
+        for level in levels:
+            args = parse_args(['.', '-O', level] + translator_args)
+            result = run_benchmark(name, files, work_dir, args, 1,
+                                   max_cycles)
+            row += (f'{result["rom_words"]:>12} '
+                    f'{result.get("cycles", "-"):>10}')
+        lines.append(row)
+    return lines
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Benchmarks the translator on generated VM programs, '
+                    'timing parse, code generation and write separately '
+                    'and measuring ROM size and cycle counts.',
+        epilog='Arguments after -- are passed to the translator, e.g. '
+               '"-- -O1 --shared-calls".')
+    arg_parser.add_argument(
+        '--programs', nargs='+', choices=sorted(PROGRAMS),
+        default=list(PROGRAMS), help='programs to benchmark (default: all)')
+    arg_parser.add_argument(
+        '--scale', type=int, default=1,
+        help='size factor of the generated programs')
+    arg_parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='translations per program; the fastest time of each stage '
+             'is kept')
+    arg_parser.add_argument(
+        '--cycles', type=int, default=50_000_000,
+        help='maximum cycles to run each program on the emulator, 0 to '
+             'skip emulation')
+    arg_parser.add_argument(
+        '--output', help='write the results to this JSON file')
+    arg_parser.add_argument(
+        '--baseline', help='JSON results to compare against')
+    arg_parser.add_argument(
+        '--threshold', type=float, default=0.10,
+        help='allowed slowdown of each stage relative to the baseline, as '
+             'a fraction (default: 0.10)')
+    arg_parser.add_argument(
+        '--work-dir',
+        help='directory for the generated programs (default: a temporary '
+             'directory)')
+    arg_parser.add_argument(
+        '--opt-levels', nargs='+', choices=['0', '1', '2', 's'],
+        help='instead of timing, print the ROM size and cycle count of '
+             'each program at each of these optimization levels')
+    arg_parser.add_argument('translator_args', nargs=argparse.REMAINDER,
+                            help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    translator_args = [arg for arg in args.translator_args if arg != '--']
+    # The translator's own parser supplies the option defaults; the input
+    # path is unused
+    translate_args = parse_args(['.'] + translator_args)
+
+    if args.opt_levels:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            print('\n'.join(compare_opt_levels(
+                args.programs, args.scale, args.opt_levels, translator_args,
+                args.work_dir or temp_dir, args.cycles)))
+        return
+
+    results = {'translator_args': translator_args, 'scale': args.scale,
+               'programs': {}}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.work_dir or temp_dir
+        for name in args.programs:
+            result = run_benchmark(name, PROGRAMS[name](args.scale), work_dir,
+                                   translate_args, args.repeat, args.cycles)
+            results['programs'][name] = result
+            cycles = result.get('cycles', '-')
+            print(f'{name:<12} {result["commands"]:>8} commands  '
+                  f'parse {result["parse_seconds"] * 1000:8.2f} ms  '
+                  f'codegen {result["codegen_seconds"] * 1000:8.2f} ms  '
+                  f'write {result["write_seconds"] * 1000:6.2f} ms  '
+                  f'ROM {result["rom_words"]:>7}  cycles {cycles}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+            file.write('\n')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        regressions = compare_results(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline.')
+
+
+if __name__ == '__main__':
+    main()
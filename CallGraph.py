@@ -0,0 +1,93 @@
+from Parser import CommandType
+
+
+def split_functions(commands):
+    """
+    Splits a file's command list into (function_name, commands) chunks.
+    Commands before the first 'function' form a chunk named None.
+    """
+    chunks = []
+    name, body = None, []
+    for command in commands:
+        if command[0] == CommandType.C_FUNCTION:
+            if name is not None or body:
+                chunks.append((name, body))
+            name, body = command[1], []
+        body.append(command)
+    if name is not None or body:
+        chunks.append((name, body))
+    return chunks
+
+
+class CallGraph:
+    def __init__(self, programs):
+        """
+        Builds the function table and call edges of a whole program, given
+        as a list of (file_name, commands) pairs.
+        """
+        self.programs = programs
+        self.functions = {}     # Function name -> file name
+        self.calls = {}         # Function name (None: top level) -> callees
+        self.entry_points = set()
+        self.first_function = None
+        for file_name, commands in programs:
+            for name, body in split_functions(commands):
+                if name is not None:
+                    self.functions.setdefault(name, file_name)
+                    if self.first_function is None:
+                        self.first_function = name
+                callees = {command[1] for command in body
+                           if command[0] == CommandType.C_CALL}
+                self.calls.setdefault(name, set()).update(callees)
+
+    def reachable(self, roots):
+        """Returns the set of functions reachable from the given roots."""
+        seen = set()
+        pending = [root for root in roots if root in self.functions]
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            pending.extend(callee for callee in self.calls.get(name, ())
+                           if callee in self.functions and callee not in seen)
+        return seen
+
+    def entry_roots(self, has_sys):
+        """
+        Returns the functions execution can start in: Sys.init when the
+        bootstrap calls it, otherwise the first function (reached by
+        falling through from the top of the program). Calls made outside
+        any function are roots as well.
+        """
+        roots = set(self.calls.get(None, ()))
+        if has_sys:
+            roots.add('Sys.init')
+        elif self.first_function is not None:
+            roots.add(self.first_function)
+        return roots
+
+
+def eliminate_dead_functions(programs, has_sys, candidates=None):
+    """
+    Removes the functions that cannot be reached from the program's entry
+    point; if candidates is given, only those among them. Returns
+    (programs, removed), where removed lists the dropped functions as
+    (file_name, function_name, commands).
+    """
+    call_graph = CallGraph(programs)
+    live = call_graph.reachable(call_graph.entry_roots(has_sys))
+    if candidates is not None:
+        live |= call_graph.functions.keys() - set(candidates)
+
+    pruned_programs = []
+    removed = []
+    for file_name, commands in programs:
+        kept = []
+        for name, body in split_functions(commands):
+            if name is None or name in live:
+                kept.extend(body)
+            else:
+                removed.append((file_name, name, body))
+        pruned_programs.append((file_name, kept))
+    return pruned_programs, removed
@@ -1,13 +1,123 @@
+from collections import Counter
+
+from Optimizer import to_signed16
 from Parser import CommandType
+from Peephole import PeepholeOptimizer
+from SourceMap import NO_SOURCE, format_marker
+
+
+class BufferedOutput:
+    # Buffered text is written to the file in chunks of about this size
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, output_file):
+        """Collects text written to output_file and writes it in chunks."""
+        self.output_file = output_file
+        self.chunks = []
+        self.buffered_size = 0
+
+    def write(self, text):
+        """Adds text to the buffer, writing the buffer out once it is full."""
+        self.chunks.append(text)
+        self.buffered_size += len(text)
+        if self.buffered_size >= self.CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Writes out the buffered text."""
+        if self.chunks:
+            self.output_file.write(''.join(self.chunks))
+            self.chunks = []
+            self.buffered_size = 0
+
+    def close(self):
+        """Writes out the buffered text and closes the file."""
+        self.flush()
+        self.output_file.close()
 
 
 class CodeWriter:
-    def __init__(self, output_file_path):
+    # Hack computation of each binary operation on D (y) and M (x)
+    BINARY_OPERATIONS = {
+        'add': 'M=D+M', 'sub': 'M=M-D', 'and': 'M=D&M', 'or': 'M=D|M'
+    }
+    # The same with x in D and the constant operand y in A, leaving the
+    # result in D (add and sub are computed from D alone)
+    CONSTANT_OPERATIONS_TO_D = {'and': 'D=D&A', 'or': 'D=D|A'}
+    # Jump mnemonic of each comparison command
+    COMPARISON_JUMPS = {'eq': 'JEQ', 'lt': 'JLT', 'gt': 'JGT'}
+
+    # Largest segment index that -O1 addresses with an A=M+1 chain instead
+    # of '@index / D=A / A=D+M'. Pops get a higher limit because the chain
+    # also saves the R13 round-trip.
+    SMALL_PUSH_INDEX_LIMIT = 2
+    SMALL_POP_INDEX_LIMIT = 6
+    # Largest 'stack' segment offset addressed with an A=A-1 chain
+    STACK_SLOT_CHAIN_LIMIT = 4
+
+    # Placeholder for the unique label id in assembly templates
+    LABEL_ID_FIELD = '{label_id}'
+
+    # Entry points of the shared call/return subroutines
+    CALL_ROUTINE = '$CALL'
+    RETURN_ROUTINE = '$RETURN'
+    TAIL_CALL_ROUTINE = '$TAILCALL'
+    # Prefix of the shared comparison subroutine of each jump mnemonic
+    COMPARE_ROUTINE = '$COMPARE_'
+
+    def __init__(self, output_file_path, shared_calls=False, peephole=False,
+                 opt_level=0, comments=True, source_map=False,
+                 shared_compares=False, local_init_loop=None,
+                 hot_functions=None, templates=None):
         """
         Opens the output file for writing and prepares for code generation.
+        output_file_path may also be an open text stream, e.g. io.StringIO.
+        With shared_calls, 'call' and 'return' jump to one global $CALL and
+        $RETURN subroutine instead of inlining the frame handling. With
+        peephole, the instruction stream passes through a PeepholeOptimizer
+        before it reaches the file. An opt_level of 1 or more selects
+        index-specialized addressing for small segment indices. Without
+        comments, no '//' comment lines are emitted. With source_map,
+        write_source marks where the following instructions come from.
+        With shared_compares, eq/lt/gt jump to a shared $COMPARE_ routine
+        instead of inlining the comparison. Functions with at least
+        local_init_loop locals zero them in a loop instead of unrolling.
+        The functions in hot_functions, if given, are written with inline
+        calls, returns, comparisons and local initialization regardless of
+        those three options. templates is an optional dict of compiled
+        templates to share with other CodeWriters of the same options.
         """
-        self.output_file = open(output_file_path, 'w')
-        self.label_counter = 0  # To generate unique labels
+        if isinstance(output_file_path, str):
+            output_file = open(output_file_path, 'w')
+        else:
+            output_file = output_file_path  # An open text stream
+        self.output_file = BufferedOutput(output_file)
+        self.comments = comments
+        self.source_map = source_map
+        self.function_name = None   # Function being written, for markers
+        # Template key -> (text, instruction count)
+        self.templates = {} if templates is None else templates
+        self.other_templates = {}   # Templates of the other hot/cold mode
+        self.opt_level = opt_level
+        self.peephole = (PeepholeOptimizer(self.output_file)
+                         if peephole else None)
+        self.shared_calls = shared_calls
+        self.shared_compares = shared_compares
+        self.local_init_loop = local_init_loop
+        self.size_options = (shared_calls, shared_compares, local_init_loop)
+        self.hot_functions = hot_functions
+        self.hot = False        # Writing a function in hot_functions
+        self.compare_counts = Counter()  # Shared compare sites by mnemonic
+        self.constant_compare_count = 0  # Those comparing with a constant
+        self.init_loop_count = 0    # Functions zeroing locals in a loop
+        self.init_loop_locals = 0   # Locals zeroed by those loops
+        self.instruction_count = 0  # ROM words generated (before peephole)
+        self.call_count = 0     # Call sites written (incl. the bootstrap)
+        self.return_count = 0   # Return commands written
+        self.shared_call_count = 0  # Of those, written in shared_calls mode
+        self.shared_return_count = 0
+        self.tail_call_count = 0    # Tail calls written
+        self.label_counter = 0  # To generate unique labels within a file
         self.segment_registers = {  # Map segments to their base registers
             'local': 'LCL',
             'argument': 'ARG',
@@ -16,6 +126,87 @@ class CodeWriter:
         }
         self.file_name = ''
 
+    def _next_label_id(self):
+        """
+        Returns a new label id, namespaced by the current file so that the
+        labels of a file do not depend on the other files.
+        """
+        label_id = self.label_counter
+        self.label_counter += 1
+        if self.file_name:
+            return f'{self.file_name}.{label_id}'
+        return str(label_id)
+
+    def _write(self, assembly_code):
+        """Writes a list of assembly lines to the output file."""
+        if not self.comments:
+            assembly_code = [line for line in assembly_code
+                             if not line.startswith('//')]
+        self.instruction_count += self._count_instructions(assembly_code)
+        if self.peephole:
+            self.peephole.write_lines(assembly_code)
+        else:
+            self.output_file.write('\n'.join(assembly_code) + '\n')
+
+    def _write_marker(self, file_name, line_number, function_name, text):
+        """
+        Writes a source marker line, which is kept even without comments.
+        """
+        marker = format_marker(file_name, line_number, function_name, text)
+        if self.peephole:
+            self.peephole.write_lines([marker])
+        else:
+            self.output_file.write(marker + '\n')
+
+    def write_source(self, command):
+        """
+        In source_map mode, marks the instructions written next as coming
+        from the given SourceCommand of the current file.
+        """
+        if command.command_type == CommandType.C_FUNCTION:
+            self.function_name = command.arg1
+        self._write_marker(f'{self.file_name}.vm', command.line_number,
+                           self.function_name, command.text)
+
+    def _static_key(self, segment):
+        """
+        Returns the part of a template key that depends on the current
+        file: static symbols are named after it.
+        """
+        return self.file_name if segment == 'static' else None
+
+    def _write_template(self, key, build, label_id=None):
+        """
+        Writes the assembly of a command shape from a precompiled template.
+        build(label_id) returns the shape's assembly lines; it is only
+        called the first time key is written, with a placeholder that is
+        replaced by the given label_id on every write.
+        """
+        template = self.templates.get(key)
+        if template is None:
+            assembly_code = build(self.LABEL_ID_FIELD)
+            if not self.comments:
+                assembly_code = [line for line in assembly_code
+                                 if not line.startswith('//')]
+            template = ('\n'.join(assembly_code) + '\n',
+                        self._count_instructions(assembly_code))
+            self.templates[key] = template
+
+        text, instruction_count = template
+        if label_id is not None:
+            text = text.replace(self.LABEL_ID_FIELD, label_id)
+        self.instruction_count += instruction_count
+        if self.peephole:
+            self.peephole.write_lines(text[:-1].split('\n'))
+        else:
+            self.output_file.write(text)
+
+    @staticmethod
+    def _count_instructions(assembly_code):
+        """Counts the ROM words in a list of assembly lines."""
+        return sum(1 for line in assembly_code
+                   if line and not line.startswith(('//', '(')))
+
     def write_sp_init(self):
         """Writes assembly to initialize SP=256 (no Sys.init call)."""
         assembly_code = [
@@ -25,12 +216,108 @@ class CodeWriter:
             '@SP',
             'M=D'
         ]
-        self.output_file.write('\n'.join(assembly_code) + '\n')
+        if self.source_map:
+            self._write_marker(*NO_SOURCE, '$BOOTSTRAP', 'bootstrap')
+        self._write(assembly_code)
+
+    @staticmethod
+    def _small_index_address(base_reg, index):
+        """
+        Returns assembly that sets A = base + index for a small index
+        without touching D.
+        """
+        if index == 0:
+            return [f'@{base_reg}', 'A=M']
+        return [f'@{base_reg}', 'A=M+1'] + ['A=A+1'] * (index - 1)
+
+    @staticmethod
+    def _stack_slot_address(offset):
+        """
+        Returns assembly that sets A = SP - offset without touching D, for
+        offsets up to STACK_SLOT_CHAIN_LIMIT.
+        """
+        return ['@SP', 'A=M-1'] + ['A=A-1'] * (offset - 1)
+
+    def _stack_push_code(self, offset):
+        """
+        Returns the assembly for 'push stack offset', which pushes
+        RAM[SP - offset]; the inliner addresses a callee's arguments and
+        locals this way.
+        """
+        if offset <= self.STACK_SLOT_CHAIN_LIMIT:
+            address = self._stack_slot_address(offset)
+        else:
+            address = [f'@{offset}', 'D=A', '@SP', 'A=M-D']
+        return [
+            f'// push stack {offset}',
+            *address,
+            'D=M',
+            '@SP',
+            'A=M',
+            'M=D',
+            '@SP',
+            'M=M+1'
+        ]
+
+    def _stack_pop_code(self, offset):
+        """
+        Returns the assembly for 'pop stack offset', which pops into
+        RAM[SP - offset], SP being taken after the pop.
+        """
+        if offset <= self.STACK_SLOT_CHAIN_LIMIT:
+            return [
+                f'// pop stack {offset}',
+                '@SP',
+                'AM=M-1',       # SP--, A = SP
+                'D=M',
+                *['A=A-1'] * offset,
+                'M=D'
+            ]
+        return [
+            f'// pop stack {offset}',
+            f'@{offset}',
+            'D=A',
+            '@SP',
+            'D=M-D',
+            'D=D-1',            # D = SP - 1 - offset (SP after the pop)
+            '@R13',
+            'M=D',
+            '@SP',
+            'AM=M-1',
+            'D=M',
+            '@R13',
+            'A=M',
+            'M=D'
+        ]
+
+    def _write_small_index_pop(self, segment, index):
+        """
+        Helper to write code for popping to temp or to a small segment index
+        directly, without storing the target address in R13.
+        """
+        if segment == 'temp':
+            target = [f'@{5 + index}']
+        else:
+            target = self._small_index_address(
+                self.segment_registers[segment], index)
+        return [
+            f'// pop {segment} {index}',
+            '@SP',
+            'AM=M-1',           # SP--, A = SP
+            'D=M',              # D = *SP (value to pop)
+            *target,            # A = target address
+            'M=D'               # *address = value
+        ]
 
     def _write_pop(self, segment, index):
         """Helper to write code for popping to a memory segment."""
         assembly_code = []
-        if segment == 'temp':
+        if self.opt_level >= 1 and (
+                segment == 'temp' or
+                (segment in self.segment_registers and
+                 index <= self.SMALL_POP_INDEX_LIMIT)):
+            assembly_code.extend(self._write_small_index_pop(segment, index))
+        elif segment == 'temp':
             target_addr = 5 + index
             assembly_code.extend([
                 f'// pop temp {index}',
@@ -108,12 +395,8 @@ class CodeWriter:
             'M=M+1'
         ]
 
-    def _write_comparison_op(self, jump_mnemonic):
+    def _write_comparison_op(self, jump_mnemonic, label_id):
         """Helper for eq, lt, gt, which share the same structure."""
-        true_label = f'{jump_mnemonic}_TRUE_{self.label_counter}'
-        end_label = f'{jump_mnemonic}_END_{self.label_counter}'
-        self.label_counter += 1
-
         return [
             f'// {jump_mnemonic.lower()}',
             '@SP',
@@ -124,35 +407,146 @@ class CodeWriter:
             'M=M-1',
             'A=M',
             'D=M-D',
+            *self._compare_code(jump_mnemonic, label_id, to_d=True),
+            '@SP',
+            'A=M',
+            'M=D',
+            '@SP',
+            'M=M+1'
+        ]
+
+    @staticmethod
+    def _compare_code(jump_mnemonic, label_id, to_d=False):
+        """
+        Returns the branch of a comparison that turns x - y in D into its
+        result: in D with to_d, otherwise in x on top of the stack.
+        """
+        true_label = f'{jump_mnemonic}_TRUE_{label_id}'
+        end_label = f'{jump_mnemonic}_END_{label_id}'
+        if to_d:
+            set_false, set_true = ['D=0'], ['D=-1']
+        else:
+            set_false = ['@SP', 'A=M-1', 'M=0']
+            set_true = ['@SP', 'A=M-1', 'M=-1']
+        return [
             f'@{true_label}',
             f'D;{jump_mnemonic}',
-            'D=0',
+            *set_false,
             f'@{end_label}',
             '0;JMP',
             f'({true_label})',
-            'D=-1',
-            f'({end_label})',
+            *set_true,
+            f'({end_label})'
+        ]
+
+    def _shared_compare_code(self, jump_mnemonic, label_id):
+        """
+        Returns a comparison that calls the shared routine of its jump
+        mnemonic with D = return address.
+        """
+        return_label = f'{jump_mnemonic}_RET_{label_id}'
+        return [
+            f'// {jump_mnemonic.lower()} (shared)',
+            f'@{return_label}',
+            'D=A',
+            f'@{self.COMPARE_ROUTINE}{jump_mnemonic}',
+            '0;JMP',
+            f'({return_label})'
+        ]
+
+    def _shared_compare_constant_code(self, jump_mnemonic, value, label_id):
+        """
+        Returns a comparison of x on top of the stack with a constant that
+        calls the routine's _D entry with R13 = x - value and D = return
+        address.
+        """
+        return_label = f'{jump_mnemonic}_RET_{label_id}'
+        return [
+            f'// push constant {value} + {jump_mnemonic.lower()} (shared)',
             '@SP',
-            'A=M',
+            'A=M-1',
+            'D=M',
+            *self._subtract_constant_from_d(value),
+            '@R13',
             'M=D',
+            f'@{return_label}',
+            'D=A',
+            f'@{self.COMPARE_ROUTINE}{jump_mnemonic}_D',
+            '0;JMP',
+            f'({return_label})'
+        ]
+
+    def _compare_routine_code(self, jump_mnemonic):
+        """
+        Returns the shared routine of a comparison. The main entry pops y
+        and compares it with x; the _D entry takes x - y in R13. Both get
+        the return address in D and replace x with the result.
+        """
+        routine = f'{self.COMPARE_ROUTINE}{jump_mnemonic}'
+        return [
+            f'({routine}_D)',
+            '@R15',
+            'M=D',              # R15 = return address
+            '@R13',
+            'D=M',
+            f'@{routine}_TEST',
+            '0;JMP',
+            f'({routine})',
+            '@R15',
+            'M=D',              # R15 = return address
             '@SP',
-            'M=M+1'
+            'AM=M-1',
+            'D=M',
+            '@SP',
+            'A=M-1',
+            'D=M-D',            # D = x - y
+            f'({routine}_TEST)',
+            f'@{routine}_TRUE',
+            f'D;{jump_mnemonic}',
+            '@SP',
+            'A=M-1',
+            'M=0',
+            '@R15',
+            'A=M',
+            '0;JMP',
+            f'({routine}_TRUE)',
+            '@SP',
+            'A=M-1',
+            'M=-1',
+            '@R15',
+            'A=M',
+            '0;JMP'
         ]
 
     def write_arithmetic(self, command):
         """Writes the assembly code for the given arithmetic command."""
+        if command in self.COMPARISON_JUMPS:
+            if self.shared_compares:
+                self.compare_counts[self.COMPARISON_JUMPS[command]] += 1
+            self._write_template(('arithmetic', command),
+                                 lambda label_id: self._arithmetic_code(
+                                     command, label_id),
+                                 self._next_label_id())
+        else:
+            self._write_template(('arithmetic', command),
+                                 lambda label_id: self._arithmetic_code(
+                                     command, label_id))
+
+    def _arithmetic_code(self, command, label_id):
+        """Returns the assembly for the given arithmetic command."""
         assembly_code = []
-        if command in ['add', 'sub', 'and', 'or']:
-            op_map = {
-                'add': 'M=D+M', 'sub': 'M=M-D', 'and': 'M=D&M', 'or': 'M=D|M'
-            }
-            assembly_code.extend(self._write_binary_op(op_map[command]))
+        if command in self.BINARY_OPERATIONS:
+            assembly_code.extend(
+                self._write_binary_op(self.BINARY_OPERATIONS[command]))
+        elif command in self.COMPARISON_JUMPS and self.shared_compares:
+            assembly_code.extend(self._shared_compare_code(
+                self.COMPARISON_JUMPS[command], label_id))
         elif command == 'eq':
-            assembly_code.extend(self._write_comparison_op('JEQ'))
+            assembly_code.extend(self._write_comparison_op('JEQ', label_id))
         elif command == 'lt':
-            assembly_code.extend(self._write_comparison_op('JLT'))
+            assembly_code.extend(self._write_comparison_op('JLT', label_id))
         elif command == 'gt':
-            assembly_code.extend(self._write_comparison_op('JGT'))
+            assembly_code.extend(self._write_comparison_op('JGT', label_id))
         elif command == 'neg':
             assembly_code.extend([
                 '// neg',
@@ -173,8 +567,198 @@ class CodeWriter:
                 '@SP',
                 'M=M+1'
             ])
+        return assembly_code
+
+    @staticmethod
+    def _constant_to_d(value):
+        """Returns assembly that loads a 16-bit constant into D."""
+        if value >= 0:
+            return [f'@{value}', 'D=A']
+        if value == -32768:
+            return ['@32767', 'D=!A']   # !32767 == -32768
+        return [f'@{-value}', 'D=-A']
+
+    @staticmethod
+    def _subtract_constant_from_d(value):
+        """Returns assembly that computes D = D - value."""
+        if value == 0:
+            return []
+        if value > 0:
+            return [f'@{value}', 'D=D-A']
+        if value == -32768:
+            return ['@32767', 'A=!A', 'D=D-A']
+        return [f'@{-value}', 'D=D+A']
+
+    def write_arithmetic_constant(self, command, value):
+        """
+        Writes a binary arithmetic command whose operand y is the given
+        constant, updating x on top of the stack in place.
+        """
+        label_id = None
+        if command in self.COMPARISON_JUMPS:
+            label_id = self._next_label_id()
+            if self.shared_compares:
+                self.compare_counts[self.COMPARISON_JUMPS[command]] += 1
+                self.constant_compare_count += 1
+        self._write_template(('arithmetic_constant', command, value),
+                             lambda label_id: self._arithmetic_constant_code(
+                                 command, value, label_id),
+                             label_id)
+
+    def _arithmetic_constant_code(self, command, value, label_id,
+                                  to_d=False):
+        """
+        Returns the assembly for write_arithmetic_constant. With to_d, x is
+        taken from D and the result left there instead of in x on top of
+        the stack.
+        """
+        assembly_code = [f'// push constant {value} + {command}']
+        if command in ('add', 'sub') and to_d:
+            # x + value is x - (-value), also for -32768
+            subtrahend = value if command == 'sub' else to_signed16(-value)
+            if subtrahend in (1, -1):
+                assembly_code.append('D=D-1' if subtrahend == 1 else 'D=D+1')
+            else:
+                assembly_code.extend(
+                    self._subtract_constant_from_d(subtrahend))
+        elif command in ('add', 'sub') and value in (1, -1):
+            increment = (value == 1) == (command == 'add')
+            assembly_code.extend([
+                '@SP',
+                'A=M-1',
+                'M=M+1' if increment else 'M=M-1'
+            ])
+        elif command in self.BINARY_OPERATIONS and to_d:
+            if value >= 0:
+                assembly_code.append(f'@{value}')
+            elif value == -32768:
+                assembly_code.extend(['@32767', 'A=!A'])
+            else:
+                assembly_code.extend([f'@{-value}', 'A=-A'])
+            assembly_code.append(self.CONSTANT_OPERATIONS_TO_D[command])
+        elif command in self.BINARY_OPERATIONS:
+            assembly_code.extend([
+                *self._constant_to_d(value),
+                '@SP',
+                'A=M-1',
+                self.BINARY_OPERATIONS[command]
+            ])
+        elif command in self.COMPARISON_JUMPS and self.shared_compares:
+            assembly_code = self._shared_compare_constant_code(
+                self.COMPARISON_JUMPS[command], value, label_id)
+        elif command in self.COMPARISON_JUMPS:
+            assembly_code.extend(self._compare_constant_code(
+                self.COMPARISON_JUMPS[command], value, label_id, to_d))
+        else:
+            raise ValueError(
+                f'Unsupported command with constant operand: {command}')
+        return assembly_code
+
+    def _compare_constant_code(self, jump_mnemonic, value, label_id,
+                               to_d=False):
+        """
+        Returns the inline comparison of x with a constant, which replaces
+        x on top of the stack or, with to_d, in D.
+        """
+        load_x = [] if to_d else ['@SP', 'A=M-1', 'D=M']
+        return [
+            *load_x,
+            *self._subtract_constant_from_d(value),
+            *self._compare_code(jump_mnemonic, label_id, to_d)
+        ]
 
-        self.output_file.write('\n'.join(assembly_code) + '\n')
+    def write_pop_constant(self, segment, index, value):
+        """
+        Writes 'push constant value' + 'pop segment index' as a direct store
+        that does not touch the stack.
+        """
+        self._write_template(
+            ('pop_constant', segment, index, value, self._static_key(segment)),
+            lambda label_id: self._pop_constant_code(segment, index, value))
+
+    def _pop_constant_code(self, segment, index, value):
+        """Returns the assembly for write_pop_constant."""
+        assembly_code = [f'// push constant {value} + pop {segment} {index}']
+        if segment in ('static', 'pointer', 'temp'):
+            if segment == 'static':
+                address = f'{self.file_name}.{index}'
+            elif segment == 'pointer':
+                address = 3 + index
+            else:
+                address = 5 + index
+            if value in (-1, 0, 1):
+                assembly_code.extend([f'@{address}', f'M={value}'])
+            else:
+                assembly_code.extend([
+                    *self._constant_to_d(value),
+                    f'@{address}',
+                    'M=D'
+                ])
+        elif segment == 'stack':
+            # The constant is never pushed, so SP is already the SP after
+            # the pop
+            if index <= self.STACK_SLOT_CHAIN_LIMIT:
+                if value in (-1, 0, 1):
+                    assembly_code.extend([
+                        *self._stack_slot_address(index), f'M={value}'])
+                else:
+                    assembly_code.extend([
+                        *self._constant_to_d(value),
+                        *self._stack_slot_address(index),
+                        'M=D'
+                    ])
+            else:
+                assembly_code.extend([
+                    f'@{index}',
+                    'D=A',
+                    '@SP',
+                    'D=M-D',
+                    '@R13',
+                    'M=D',          # R13 = SP - index
+                    *self._constant_to_d(value),
+                    '@R13',
+                    'A=M',
+                    'M=D'
+                ])
+        elif segment in self.segment_registers:
+            base_reg = self.segment_registers[segment]
+            if (self.opt_level >= 1 and
+                    index <= self.SMALL_POP_INDEX_LIMIT):
+                if value in (-1, 0, 1):
+                    assembly_code.extend([
+                        *self._small_index_address(base_reg, index),
+                        f'M={value}'
+                    ])
+                else:
+                    assembly_code.extend([
+                        *self._constant_to_d(value),
+                        *self._small_index_address(base_reg, index),
+                        'M=D'
+                    ])
+            elif value in (-1, 0, 1):
+                assembly_code.extend([
+                    f'@{index}',
+                    'D=A',
+                    f'@{base_reg}',
+                    'A=D+M',        # A = base + index
+                    f'M={value}'
+                ])
+            else:
+                assembly_code.extend([
+                    f'@{index}',
+                    'D=A',
+                    f'@{base_reg}',
+                    'D=D+M',
+                    '@R13',
+                    'M=D',          # R13 = base + index
+                    *self._constant_to_d(value),
+                    '@R13',
+                    'A=M',
+                    'M=D'
+                ])
+        else:
+            raise ValueError(f'Unsupported segment for pop: {segment}')
+        return assembly_code
 
     def _write_pointer_push(self, index):
         """Helper to write code for pushing from pointer segment."""
@@ -209,13 +793,20 @@ class CodeWriter:
 
     def write_push_pop(self, command, segment, index):
         """Writes the assembly code for C_PUSH or C_POP commands."""
+        self._write_template(
+            ('push_pop', command, segment, index, self._static_key(segment)),
+            lambda label_id: self._push_pop_code(command, segment, index))
+
+    def _push_pop_code(self, command, segment, index):
+        """Returns the assembly for C_PUSH or C_POP commands."""
         assembly_code = []
         if command == CommandType.C_PUSH:
             if segment == 'constant':
                 assembly_code.extend([
                     f'// push constant {index}',
-                    f'@{index}',    # Load the constant into the A register
-                    'D=A',          # Store the constant in the D register
+                    # Load the constant into the D register (folded
+                    # constants may be negative)
+                    *self._constant_to_d(index),
                     '@SP',          # Get the stack pointer address
                     'A=M',          # Set A to the top of the stack
                     'M=D',          # Write the constant to the top of the
@@ -227,6 +818,22 @@ class CodeWriter:
                 assembly_code.extend(self._write_static_push(index))
             elif segment == 'pointer':
                 assembly_code.extend(self._write_pointer_push(index))
+            elif segment == 'stack':
+                assembly_code.extend(self._stack_push_code(index))
+            elif (segment in self.segment_registers and
+                  self.opt_level >= 1 and
+                  index <= self.SMALL_PUSH_INDEX_LIMIT):
+                base_reg = self.segment_registers[segment]
+                assembly_code.extend([
+                    f'// push {segment} {index}',
+                    *self._small_index_address(base_reg, index),
+                    'D=M',          # D = value at RAM[base + index]
+                    '@SP',
+                    'A=M',
+                    'M=D',          # *SP = D
+                    '@SP',
+                    'M=M+1'         # SP++
+                ])
             elif segment in self.segment_registers:
                 base_reg = self.segment_registers.get(segment)
                 assembly_code.extend([
@@ -260,14 +867,15 @@ class CodeWriter:
                 assembly_code.extend(self._write_pointer_pop(index))
             elif segment == 'static':
                 assembly_code.extend(self._write_static_pop(index))
+            elif segment == 'stack':
+                assembly_code.extend(self._stack_pop_code(index))
             else:
                 assembly_code.extend(self._write_pop(segment, index))
-
-        self.output_file.write('\n'.join(assembly_code) + '\n')
+        return assembly_code
 
     def write_label(self, symbol):
         """Writes the assembly code for a C_LABEL command."""
-        self.output_file.write(f'\n({symbol})\n')
+        self._write(['', f'({symbol})'])
 
     def write_if(self, label):
         """Writes the assembly code for a C_IF command."""
@@ -280,7 +888,50 @@ class CodeWriter:
             f'@{label}',
             'D;JNE'     # Jump to label if D is not equal to 0
         ]
-        self.output_file.write('\n'.join(assembly_code) + '\n')
+        self._write(assembly_code)
+
+    def write_fused_if(self, jump_mnemonic, label, constant=None):
+        """
+        Writes a comparison fused with the following if-goto: pops y and x
+        and jumps to label if 'x - y' satisfies jump_mnemonic. With a
+        constant, y is that constant and only x is popped. Without a
+        jump_mnemonic this is 'not' + 'if-goto': pops x and jumps to label
+        unless x is -1 (true).
+        """
+        if jump_mnemonic is None:
+            self._write([
+                f'// not + if-goto {label}',
+                '@SP',
+                'AM=M-1',
+                'D=M+1',    # D = x + 1, zero only if x == -1
+                f'@{label}',
+                'D;JNE'
+            ])
+            return
+
+        if constant is not None:
+            self._write([
+                f'// {jump_mnemonic.lower()} {constant} + if-goto {label}',
+                '@SP',
+                'AM=M-1',
+                'D=M',      # D = x
+                *self._subtract_constant_from_d(constant),
+                f'@{label}',
+                f'D;{jump_mnemonic}'
+            ])
+            return
+
+        self._write([
+            f'// {jump_mnemonic.lower()} + if-goto {label}',
+            '@SP',
+            'AM=M-1',
+            'D=M',      # D = y
+            '@SP',
+            'AM=M-1',
+            'D=M-D',    # D = x - y
+            f'@{label}',
+            f'D;{jump_mnemonic}'
+        ])
 
     def write_goto(self, label):
         """Writes the assembly code for a C_GOTO command."""
@@ -289,27 +940,71 @@ class CodeWriter:
             f'@{label}',
             '0;JMP'
         ]
-        self.output_file.write('\n'.join(assembly_code) + '\n')
+        self._write(assembly_code)
 
     def write_function(self, function_name, n_vars):
         """Writes assembly for the 'function' command."""
+        if self.hot_functions is not None:
+            self._set_hot(function_name in self.hot_functions)
+        if self._uses_init_loop(n_vars):
+            self.init_loop_count += 1
+            self.init_loop_locals += n_vars
+        self._write_template(
+            ('function', function_name, n_vars),
+            lambda label_id: self._function_code(function_name, n_vars))
+
+    def _function_code(self, function_name, n_vars):
+        """Returns the assembly for the 'function' command."""
         assembly_code = [
             f'({function_name})'    # Create the function label
         ]
+        if self._uses_init_loop(n_vars):
+            return assembly_code + self._init_loop_code(function_name,
+                                                        n_vars)
         # Push 0 n_vars times
         for _ in range(n_vars):
-            assembly_code.extend([
-                '@SP',
-                'A=M',
-                'M=0',
-                '@SP',
-                'M=M+1'
-            ])
-        self.output_file.write('\n'.join(assembly_code) + '\n')
+            assembly_code.extend(self._zero_local_code())
+        return assembly_code
 
-    def write_return(self):
-        """Writes assembly for the 'return' command."""
-        assembly_code = [
+    @staticmethod
+    def _zero_local_code():
+        """Returns the assembly that pushes one zeroed local."""
+        return [
+            '@SP',
+            'A=M',
+            'M=0',
+            '@SP',
+            'M=M+1'
+        ]
+
+    @staticmethod
+    def _init_loop_code(function_name, n_vars):
+        """
+        Returns a loop that pushes n_vars zeroed locals, counting down in
+        D: 6 cycles per local instead of 5, in a constant 8 words.
+        """
+        loop_label = f'{function_name}$init'
+        return [
+            f'@{n_vars}',
+            'D=A',
+            f'({loop_label})',
+            '@SP',
+            'AM=M+1',
+            'A=A-1',
+            'M=0',
+            'D=D-1',
+            f'@{loop_label}',
+            'D;JGT'
+        ]
+
+    def _uses_init_loop(self, n_vars):
+        """Returns whether a function's locals are zeroed in a loop."""
+        return (self.local_init_loop is not None and
+                n_vars >= max(self.local_init_loop, 1))
+
+    def _return_code(self):
+        """Returns the inline assembly for the 'return' command."""
+        return [
             '// return',
             '@LCL',
             'D=M',
@@ -351,14 +1046,10 @@ class CodeWriter:
             'A=M',
             '0;JMP'
         ]
-        self.output_file.write('\n'.join(assembly_code) + '\n')
-
-    def write_call(self, function_name, n_args):
-        """Writes assembly code for the 'call' command."""
-        return_label = f'{function_name}$ret.{self.label_counter}'
-        self.label_counter += 1
 
-        assembly_code = [
+    def _call_code(self, function_name, n_args, return_label):
+        """Returns the inline assembly for the 'call' command."""
+        return [
             f'// call {function_name} {n_args}',
             # --- Push return-address ---
             f'@{return_label}',
@@ -384,15 +1075,439 @@ class CodeWriter:
             # --- Declare return-address label ---
             f'({return_label})'
         ]
-        self.output_file.write('\n'.join(assembly_code) + '\n')
+
+    def _shared_call_code(self, function_name, n_args, return_label):
+        """
+        Returns the assembly for a call site that jumps to the shared $CALL
+        routine with R13 = target, R14 = n_args and R15 = return address.
+        """
+        return [
+            f'// call {function_name} {n_args} (shared)',
+            f'@{return_label}',
+            'D=A',
+            '@R15',
+            'M=D',              # R15 = return address
+            f'@{n_args}',
+            'D=A',
+            '@R14',
+            'M=D',              # R14 = n_args
+            f'@{function_name}',
+            'D=A',
+            '@R13',
+            'M=D',              # R13 = target function
+            f'@{self.CALL_ROUTINE}',
+            '0;JMP',
+            f'({return_label})'
+        ]
+
+    def _shared_return_code(self):
+        """Returns the assembly for a return that jumps to $RETURN."""
+        return [
+            '// return (shared)',
+            f'@{self.RETURN_ROUTINE}',
+            '0;JMP'
+        ]
+
+    def _call_routine_code(self):
+        """Returns the body of the shared $CALL subroutine."""
+        return [
+            f'({self.CALL_ROUTINE})',
+            # --- Push return-address (R15) ---
+            '@R15', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            # --- Push LCL, ARG, THIS, THAT ---
+            '@LCL', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            '@ARG', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            '@THIS', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            '@THAT', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            # --- Reposition ARG = SP - 5 - n_args (R14) ---
+            '@SP', 'D=M',
+            '@5', 'D=D-A',
+            '@R14', 'D=D-M',
+            '@ARG', 'M=D',
+            # --- Reposition LCL = SP ---
+            '@SP', 'D=M',
+            '@LCL', 'M=D',
+            # --- Goto function (R13) ---
+            '@R13',
+            'A=M',
+            '0;JMP'
+        ]
+
+    def write_inline_return(self, depth):
+        """
+        Writes the end of an inlined function body: moves the return value
+        from the top of the stack to the callee's frame base, depth words
+        below SP, and sets SP just above it.
+        """
+        # With a depth of 1, the return value already sits at the frame base
+        if depth > 1:
+            self._write_template(
+                ('inline_return', depth),
+                lambda label_id: self._inline_return_code(depth))
+
+    def _inline_return_code(self, depth):
+        """Returns the assembly for write_inline_return."""
+        if depth == 2:
+            return [
+                '// inline return 2',
+                '@SP',
+                'AM=M-1',
+                'D=M',
+                'A=A-1',
+                'M=D'
+            ]
+        return [
+            f'// inline return {depth}',
+            f'@{depth - 1}',
+            'D=A',
+            '@SP',
+            'M=M-D',            # SP = frame base + 1
+            'D=M',
+            f'@{depth - 2}',
+            'A=D+A',            # A = old SP - 1, the return value
+            'D=M',
+            '@SP',
+            'A=M-1',
+            'M=D'
+        ]
+
+    def write_return(self):
+        """Writes assembly for the 'return' command."""
+        self.return_count += 1
+        if self.shared_calls:
+            self.shared_return_count += 1
+            self._write_template(('return',),
+                                 lambda label_id: self._shared_return_code())
+        else:
+            self._write_template(('return',),
+                                 lambda label_id: self._return_code())
+
+    def write_call(self, function_name, n_args):
+        """Writes assembly code for the 'call' command."""
+        self.call_count += 1
+        if self.shared_calls:
+            self.shared_call_count += 1
+            build_call = self._shared_call_code
+        else:
+            build_call = self._call_code
+        self._write_template(
+            ('call', function_name, n_args),
+            lambda label_id: build_call(
+                function_name, n_args, f'{function_name}$ret.{label_id}'),
+            self._next_label_id())
+
+    def write_tail_call(self, function_name, n_args):
+        """
+        Writes 'call function_name n_args' directly followed by 'return':
+        the callee reuses the current frame, so it returns straight to the
+        current function's caller and the stack does not grow.
+        """
+        self.tail_call_count += 1
+        self._write_template(
+            ('tail_call', function_name, n_args),
+            lambda label_id: self._tail_call_code(function_name, n_args))
+
+    def _tail_call_code(self, function_name, n_args):
+        """Returns the assembly of a tail call site."""
+        return [
+            f'// call {function_name} {n_args} + return (tail call)',
+            f'@{n_args}',
+            'D=A',
+            '@R14',
+            'M=D',              # R14 = nArgs
+            f'@{function_name}',
+            'D=A',
+            '@R13',
+            'M=D',              # R13 = target
+            f'@{self.TAIL_CALL_ROUTINE}',
+            '0;JMP'
+        ]
+
+    def _tail_call_routine_code(self):
+        """
+        Returns the $TAILCALL routine: with R13 = target and R14 = nArgs,
+        it moves the arguments on top of the stack down to ARG, keeps the
+        current frame's saved return address, LCL, ARG, THIS and THAT
+        below the callee's LCL, and jumps to the target. When the current
+        function got as many arguments, the saved frame is already in
+        place and only the arguments move.
+        """
+        routine = self.TAIL_CALL_ROUTINE
+        return [
+            '// Tail call routine',
+            f'({routine})',
+            '@LCL',
+            'D=M',
+            '@ARG',
+            'D=D-M',
+            '@5',
+            'D=D-A',            # D = the current function's nArgs
+            '@R14',
+            'D=D-M',
+            f'@{routine}_SLOW',
+            'D;JNE',
+            '@R14',
+            'D=M',
+            f'@{routine}_JUMP',
+            'D;JEQ',
+            '@SP',
+            'D=M',
+            '@R14',
+            'D=D-M',
+            '@R15',
+            'M=D',              # R15 = first argument
+            '@ARG',
+            'D=M',
+            '@SP',
+            'M=D',              # SP = ARG, the destination
+            f'({routine}_COPY)',
+            '@R15',
+            'M=M+1',
+            'A=M-1',
+            'D=M',
+            '@SP',
+            'M=M+1',
+            'A=M-1',
+            'M=D',
+            '@R14',
+            'MD=M-1',
+            f'@{routine}_COPY',
+            'D;JGT',
+            f'({routine}_JUMP)',
+            '@LCL',
+            'D=M',
+            '@SP',
+            'M=D',              # SP = LCL
+            '@R13',
+            'A=M',
+            '0;JMP',
+            # The frame moves: push a copy of it above the arguments, then
+            # move arguments and frame down to ARG together
+            f'({routine}_SLOW)',
+            '@5',
+            'D=A',
+            '@R15',
+            'M=D',
+            f'({routine}_FRAME)',
+            '@R15',
+            'D=M',
+            '@LCL',
+            'A=M-D',
+            'D=M',              # D = *(LCL - R15)
+            '@SP',
+            'M=M+1',
+            'A=M-1',
+            'M=D',
+            '@R15',
+            'MD=M-1',
+            f'@{routine}_FRAME',
+            'D;JGT',
+            '@R14',
+            'D=M',
+            '@5',
+            'D=D+A',
+            '@R15',
+            'M=D',              # R15 = nArgs + 5 words to move
+            '@SP',
+            'D=M',
+            '@R15',
+            'D=D-M',
+            '@R14',
+            'M=D',              # R14 = first argument
+            '@ARG',
+            'D=M',
+            '@LCL',
+            'M=D',              # LCL = ARG, the destination
+            f'({routine}_MOVE)',
+            '@R14',
+            'M=M+1',
+            'A=M-1',
+            'D=M',
+            '@LCL',
+            'M=M+1',
+            'A=M-1',
+            'M=D',
+            '@R15',
+            'MD=M-1',
+            f'@{routine}_MOVE',
+            'D;JGT',
+            f'@{routine}_JUMP',  # LCL = ARG + nArgs + 5
+            '0;JMP'
+        ]
+
+    def write_shared_routines(self):
+        """
+        Writes the shared subroutines used by the code written so far: the
+        $CALL and $RETURN routines in shared_calls mode, the $TAILCALL
+        routine and the $COMPARE_ routines. Must be written once, after all
+        other code.
+        """
+        assembly_code = []
+        if self.shared_call_count or self.shared_return_count:
+            assembly_code = self._shared_routines_code()
+        routines = []
+        if self.tail_call_count:
+            routines += self._tail_call_routine_code()
+        for jump_mnemonic in sorted(self.compare_counts):
+            routines += self._compare_routine_code(jump_mnemonic)
+        if routines:
+            if not assembly_code:
+                assembly_code = ['// Shared routines',
+                                 *self._halt_guard_code()]
+            assembly_code += routines
+        if assembly_code:
+            if self.source_map:
+                self._write_marker(*NO_SOURCE, '$SHARED', 'shared routines')
+            self._write(assembly_code)
+
+    @staticmethod
+    def _halt_guard_code():
+        """Returns a halt loop that guards against falling through."""
+        return ['($SHARED_HALT)', '@$SHARED_HALT', '0;JMP']
+
+    def _shared_routines_code(self):
+        """Returns the halt guard plus the $CALL and $RETURN routines."""
+        return [
+            '// Shared call/return routines',
+            *self._halt_guard_code(),
+            *self._call_routine_code(),
+            f'({self.RETURN_ROUTINE})',
+            *self._return_code()[1:]
+        ]
+
+    def shared_call_savings(self, call_count=None, return_count=None):
+        """
+        Returns the number of ROM words saved by shared_calls mode compared
+        to inlining every call and return, for the calls and returns
+        written so far or for the given numbers of them.
+        """
+        if call_count is None:
+            call_count = self.shared_call_count
+            return_count = self.shared_return_count
+        if not (call_count or return_count):
+            return 0
+        count = self._count_instructions
+        call_saving = (count(self._call_code('f', 0, 'r')) -
+                       count(self._shared_call_code('f', 0, 'r')))
+        return_saving = (count(self._return_code()) -
+                         count(self._shared_return_code()))
+        return (call_count * call_saving +
+                return_count * return_saving -
+                count(self._shared_routines_code()))
+
+    def shared_compare_savings(self):
+        """
+        Returns the number of ROM words saved by shared_compares mode
+        compared to inlining every comparison.
+        """
+        if not self.compare_counts:
+            return 0
+        count = self._count_instructions
+        saving = (count(self._write_comparison_op('JEQ', 'x')) -
+                  count(self._shared_compare_code('JEQ', 'x')))
+        constant_saving = (
+            count(self._compare_constant_code('JEQ', 2, 'x')) -
+            count(self._shared_compare_constant_code('JEQ', 2, 'x')))
+        sites = sum(self.compare_counts.values())
+        return ((sites - self.constant_compare_count) * saving +
+                self.constant_compare_count * constant_saving -
+                sum(count(self._compare_routine_code(jump_mnemonic))
+                    for jump_mnemonic in self.compare_counts))
+
+    def init_loop_savings(self):
+        """
+        Returns the number of ROM words saved by zeroing locals in a loop
+        compared to unrolling every local, and the cycles the loops add
+        per call of every function that uses one.
+        """
+        count = self._count_instructions
+        words_saved = (self.init_loop_locals * count(self._zero_local_code()) -
+                       self.init_loop_count * count(
+                           self._init_loop_code('f', 1)))
+        # One more cycle per local, plus the two that load the count
+        return words_saved, self.init_loop_locals + 2 * self.init_loop_count
 
     def set_file_name(self, file_name):
         """
         Informs the code writer that the translation of a new VM file has
         started.
         """
+        # Nothing is optimized across files, so a file's output is the same
+        # whether it is written here or translated on its own
+        self.flush()
         self.file_name = file_name
+        self.label_counter = 0
+        self.function_name = None
+        self._set_hot(False)
+
+    def _set_hot(self, hot):
+        """
+        Switches between the inline forms used for hot functions and the
+        forms selected by the size options.
+        """
+        if hot == self.hot:
+            return
+        self.hot = hot
+        self.templates, self.other_templates = (self.other_templates,
+                                                self.templates)
+        if hot:
+            self.shared_calls = self.shared_compares = False
+            self.local_init_loop = None
+        else:
+            (self.shared_calls, self.shared_compares,
+             self.local_init_loop) = self.size_options
+
+    def stats(self):
+        """Returns the counters accumulated by this code writer."""
+        stats = {
+            'instruction_count': self.instruction_count,
+            'call_count': self.call_count,
+            'return_count': self.return_count,
+            'shared_call_count': self.shared_call_count,
+            'shared_return_count': self.shared_return_count,
+            'tail_call_count': self.tail_call_count,
+            'compare_counts': dict(self.compare_counts),
+            'constant_compare_count': self.constant_compare_count,
+            'init_loop_count': self.init_loop_count,
+            'init_loop_locals': self.init_loop_locals,
+        }
+        if self.peephole:
+            stats['peephole_hits'] = dict(self.peephole.hits)
+            stats['peephole_words_saved'] = self.peephole.words_saved
+        return stats
+
+    def write_fragment(self, assembly_text, stats):
+        """
+        Appends assembly translated by another CodeWriter with the same
+        options, and merges the counters it reported through stats().
+        """
+        self.flush()
+        self.output_file.write(assembly_text)
+        self.instruction_count += stats['instruction_count']
+        self.call_count += stats['call_count']
+        self.return_count += stats['return_count']
+        self.shared_call_count += stats['shared_call_count']
+        self.shared_return_count += stats['shared_return_count']
+        self.tail_call_count += stats['tail_call_count']
+        self.compare_counts.update(stats['compare_counts'])
+        self.constant_compare_count += stats['constant_compare_count']
+        self.init_loop_count += stats['init_loop_count']
+        self.init_loop_locals += stats['init_loop_locals']
+        if self.peephole:
+            for name, hits in stats['peephole_hits'].items():
+                self.peephole.hits[name] += hits
+            self.peephole.words_saved += stats['peephole_words_saved']
+
+    def flush(self):
+        """
+        Writes out any instructions held back by the peephole window or the
+        output buffer.
+        """
+        if self.peephole:
+            self.peephole.flush()
+        self.output_file.flush()
 
     def close(self):
         """Closes the output file."""
+        self.flush()
         self.output_file.close()
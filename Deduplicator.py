@@ -0,0 +1,85 @@
+from Parser import Command, CommandType
+from CallGraph import split_functions
+
+
+# Commands whose first argument is a label
+LABEL_COMMANDS = {CommandType.C_LABEL, CommandType.C_GOTO, CommandType.C_IF}
+
+# Commands a function body may end with, so that it never falls through
+# into the code written after it
+FINAL_COMMANDS = {CommandType.C_RETURN, CommandType.C_GOTO}
+
+
+def normalize_body(function_name, body, file_name):
+    """
+    Returns a hashable form of a function body (with its 'function'
+    command) that is equal for bodies which translate to the same code up
+    to the function's name: the labels the body defines are numbered in
+    order of first use, recursive calls name no function and a body that
+    uses statics is tied to its file, since statics resolve per file.
+    """
+    defined_labels = {arg1 for cmd_type, arg1, *_ in body
+                      if cmd_type == CommandType.C_LABEL}
+    labels = {}
+    uses_statics = False
+    normalized = []
+    for command in body[1:]:
+        cmd_type, arg1, arg2, *_ = command
+        if cmd_type in LABEL_COMMANDS and arg1 in defined_labels:
+            arg1 = labels.setdefault(arg1, len(labels))
+        elif cmd_type == CommandType.C_CALL and arg1 == function_name:
+            arg1 = None
+        elif (cmd_type in (CommandType.C_PUSH, CommandType.C_POP) and
+              arg1 == 'static'):
+            uses_statics = True
+        if arg1 is command[1] and type(command) is Command:
+            # Unchanged, so the command itself serves, as Commands equal
+            # and hash like the tuple of their fields
+            normalized.append(command)
+        else:
+            normalized.append((cmd_type, arg1, arg2))
+    return (body[0][2], file_name if uses_statics else None,
+            tuple(normalized))
+
+
+def deduplicate_functions(programs, hot_functions=None):
+    """
+    Writes each distinct function body of a whole program, given as a list
+    of (file_name, commands) pairs, only once: a function whose normalized
+    body equals that of an earlier function is dropped, and its name
+    becomes a label in front of the earlier function. Functions in and
+    out of hot_functions, which are written differently, are not merged.
+    Returns (programs, merged), where merged lists the dropped functions
+    as (file_name, function_name, kept_function_name, commands).
+    """
+    hot_functions = hot_functions or ()
+    kept = {}       # Normalized body -> name of the function written
+    aliases = {}    # Function written -> names of its duplicates
+    merged = []
+    for file_name, commands in programs:
+        for name, body in split_functions(commands):
+            if name is None or body[-1][0] not in FINAL_COMMANDS:
+                continue
+            key = (name in hot_functions,
+                   normalize_body(name, body, file_name))
+            kept_name = kept.setdefault(key, name)
+            if kept_name != name:
+                aliases.setdefault(kept_name, []).append(name)
+                merged.append((file_name, name, kept_name, body))
+
+    if not merged:
+        return programs, merged
+    dropped = {name for _, name, _, _ in merged}
+    deduplicated_programs = []
+    for file_name, commands in programs:
+        new_commands = []
+        for name, body in split_functions(commands):
+            if name in dropped:
+                continue
+            # The labels go in front of the function, so that calls to a
+            # duplicate run the kept function's local initialization
+            new_commands.extend(Command(CommandType.C_LABEL, alias, None)
+                                for alias in aliases.get(name, ()))
+            new_commands.extend(body)
+        deduplicated_programs.append((file_name, new_commands))
+    return deduplicated_programs, merged
@@ -0,0 +1,165 @@
+import sys
+from array import array
+
+
+PREDEFINED_SYMBOLS = {
+    'SP': 0, 'LCL': 1, 'ARG': 2, 'THIS': 3, 'THAT': 4,
+    **{f'R{i}': i for i in range(16)},
+    'SCREEN': 16384, 'KBD': 24576,
+}
+
+# First RAM address given to variables such as the static 'File.i' symbols
+VARIABLE_BASE = 16
+
+# Computation bits (a c1..c6) of each Hack comp mnemonic
+COMP_CODES = {
+    '0': 0b0101010, '1': 0b0111111, '-1': 0b0111010,
+    'D': 0b0001100, 'A': 0b0110000, 'M': 0b1110000,
+    '!D': 0b0001101, '!A': 0b0110001, '!M': 0b1110001,
+    '-D': 0b0001111, '-A': 0b0110011, '-M': 0b1110011,
+    'D+1': 0b0011111, 'A+1': 0b0110111, 'M+1': 0b1110111,
+    'D-1': 0b0001110, 'A-1': 0b0110010, 'M-1': 0b1110010,
+    'D+A': 0b0000010, 'D+M': 0b1000010, 'A+D': 0b0000010, 'M+D': 0b1000010,
+    'D-A': 0b0010011, 'D-M': 0b1010011,
+    'A-D': 0b0000111, 'M-D': 0b1000111,
+    'D&A': 0b0000000, 'D&M': 0b1000000, 'A&D': 0b0000000, 'M&D': 0b1000000,
+    'D|A': 0b0010101, 'D|M': 0b1010101, 'A|D': 0b0010101, 'M|D': 0b1010101,
+}
+JUMP_CODES = {
+    '': 0, 'JGT': 1, 'JEQ': 2, 'JGE': 3, 'JLT': 4, 'JNE': 5, 'JLE': 6,
+    'JMP': 7,
+}
+
+
+def encode_c_instruction(instruction):
+    """Returns the 16-bit word of a C-instruction, e.g. 'AM=M-1' or 'D;JGT'."""
+    dest, _, rest = instruction.rpartition('=')
+    comp, _, jump = rest.partition(';')
+    if comp not in COMP_CODES or jump not in JUMP_CODES:
+        raise ValueError(f'Invalid instruction: {instruction}')
+    dest_bits = (('A' in dest) << 2) | (('D' in dest) << 1) | ('M' in dest)
+    return (0b111 << 13) | (COMP_CODES[comp] << 6) | (dest_bits << 3) | \
+        JUMP_CODES[jump]
+
+
+def clean_lines(lines):
+    """Yields the instructions and labels of assembly lines."""
+    for line in lines:
+        line = line.split('//')[0].strip()
+        if line:
+            yield line
+
+
+class HackWriter:
+    def __init__(self, output_file=None, binary=False):
+        """
+        An assembler that takes Hack assembly text as it is written, e.g. as
+        the output stream of a CodeWriter, and keeps each instruction as an
+        integer word. Numbers and labels that are already defined resolve on
+        the spot; the other symbols resolve in close, which also writes the
+        words to output_file: one 16-character binary line per word as in a
+        .hack file, or with binary, packed big-endian 16-bit words.
+        """
+        self.output_file = output_file
+        self.binary = binary
+        self.words = []
+        self.labels = {}
+        self.variables = {}
+        self.unresolved = []    # (word index, symbol) of forward references
+        # Word of each instruction line whose word is known for good: the
+        # C-instructions, numbers and predefined and defined label symbols
+        self.line_words = {}
+
+    def write(self, text):
+        """Assembles text, which ends at a line boundary."""
+        line_words = self.line_words
+        append = self.words.append
+        for line in text.split('\n'):
+            word = line_words.get(line)
+            if word is not None:
+                append(word)
+            elif line and not line.startswith('//'):
+                if '//' in line or line[0] == ' ' or line[-1] == ' ':
+                    line = line.split('//')[0].strip()
+                    if not line:
+                        continue
+                self.write_instruction(line)
+
+    def write_instruction(self, line):
+        """Assembles one instruction or label declaration."""
+        word = self.line_words.get(line)
+        if word is not None:
+            self.words.append(word)
+            return
+
+        if line[0] == '@':
+            symbol = line[1:]
+            if symbol.isdigit():
+                word = int(symbol)
+            else:
+                word = self.labels.get(symbol)
+                if word is None:
+                    word = PREDEFINED_SYMBOLS.get(symbol)
+                if word is None:
+                    self.unresolved.append((len(self.words), symbol))
+                    self.words.append(0)
+                    return
+        elif line[0] == '(':
+            label = line[1:-1]
+            if label in self.labels or label in PREDEFINED_SYMBOLS:
+                raise ValueError(f'Duplicate label: {label}')
+            self.labels[label] = len(self.words)
+            return
+        else:
+            word = encode_c_instruction(line)
+        self.line_words[line] = word
+        self.words.append(word)
+
+    def resolve(self):
+        """
+        Resolves the remaining symbols to labels, or else to variables,
+        which get RAM addresses from VARIABLE_BASE in order of first use,
+        as in a separate two-pass assembler. Returns the words.
+        """
+        words = self.words
+        labels = self.labels
+        variables = self.variables
+        for index, symbol in self.unresolved:
+            address = labels.get(symbol)
+            if address is None:
+                address = variables.get(symbol)
+                if address is None:
+                    address = variables[symbol] = (
+                        VARIABLE_BASE + len(variables))
+            words[index] = address
+        self.unresolved = []
+        return words
+
+    def flush(self):
+        """Nothing to write before all symbols are resolved."""
+
+    def close(self):
+        """Resolves the symbols, writes the words and closes the file."""
+        words = self.resolve()
+        if self.binary:
+            packed = array('H', words)
+            if sys.byteorder == 'little':
+                packed.byteswap()
+            self.output_file.write(packed.tobytes())
+        else:
+            # Programs reuse few distinct words, so each is formatted once
+            lines = {word: f'{word:016b}\n' for word in set(words)}
+            self.output_file.write(''.join(map(lines.__getitem__, words)))
+        self.output_file.close()
+
+
+def assemble(lines):
+    """
+    Assembles Hack assembly lines in two passes. Returns (words, labels,
+    variables): the 16-bit instruction words and the addresses of the
+    label and variable symbols.
+    """
+    assembler = HackWriter()
+    for line in clean_lines(lines):
+        assembler.write_instruction(line)
+    return assembler.resolve(), assembler.labels, assembler.variables
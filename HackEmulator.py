@@ -0,0 +1,247 @@
+import argparse
+import json
+import sys
+from HackAssembler import assemble
+
+
+RAM_SIZE = 32768
+
+# Hack ALU computation for each (a c1..c6) code, given D, A and M as
+# unsigned 16-bit values; results are masked to 16 bits by the caller
+COMPUTATIONS = {
+    0b0101010: lambda d, a, m: 0,
+    0b0111111: lambda d, a, m: 1,
+    0b0111010: lambda d, a, m: 0xFFFF,
+    0b0001100: lambda d, a, m: d,
+    0b0110000: lambda d, a, m: a,
+    0b1110000: lambda d, a, m: m,
+    0b0001101: lambda d, a, m: ~d,
+    0b0110001: lambda d, a, m: ~a,
+    0b1110001: lambda d, a, m: ~m,
+    0b0001111: lambda d, a, m: -d,
+    0b0110011: lambda d, a, m: -a,
+    0b1110011: lambda d, a, m: -m,
+    0b0011111: lambda d, a, m: d + 1,
+    0b0110111: lambda d, a, m: a + 1,
+    0b1110111: lambda d, a, m: m + 1,
+    0b0001110: lambda d, a, m: d - 1,
+    0b0110010: lambda d, a, m: a - 1,
+    0b1110010: lambda d, a, m: m - 1,
+    0b0000010: lambda d, a, m: d + a,
+    0b1000010: lambda d, a, m: d + m,
+    0b0010011: lambda d, a, m: d - a,
+    0b1010011: lambda d, a, m: d - m,
+    0b0000111: lambda d, a, m: a - d,
+    0b1000111: lambda d, a, m: m - d,
+    0b0000000: lambda d, a, m: d & a,
+    0b1000000: lambda d, a, m: d & m,
+    0b0010101: lambda d, a, m: d | a,
+    0b1010101: lambda d, a, m: d | m,
+}
+
+
+def to_signed(word):
+    """Returns a 16-bit word as a signed integer."""
+    return word - 0x10000 if word & 0x8000 else word
+
+
+class HackEmulator:
+    def __init__(self, words, labels=None, ram=None):
+        """
+        Loads a program of 16-bit instruction words and pre-decodes it.
+        labels maps label names to ROM addresses, for per-label execution
+        counts; ram optionally maps RAM addresses to initial values.
+        """
+        self.labels = labels or {}
+        self.ram = [0] * RAM_SIZE
+        for address, value in (ram or {}).items():
+            self.ram[address] = value & 0xFFFF
+        self.pc = 0
+        self.a = 0
+        self.d = 0
+        self.cycles = 0
+        self.halted = False
+        self.execution_counts = [0] * len(words)
+        self._decode(words)
+
+    @classmethod
+    def from_asm(cls, lines, ram=None):
+        """Assembles Hack assembly lines and loads the result."""
+        words, labels, _ = assemble(lines)
+        return cls(words, labels, ram)
+
+    def _decode(self, words):
+        """
+        Splits each instruction into parallel arrays, so the run loop only
+        does list lookups: the A-instruction value (None for C-instructions),
+        the computation, the dest and jump bits and whether M is read.
+        """
+        self.a_values = []
+        self.computations = []
+        self.dests = []
+        self.jumps = []
+        self.reads_m = []
+        for word in words:
+            if word & 0x8000 == 0:
+                self.a_values.append(word)
+                self.computations.append(None)
+                self.dests.append(0)
+                self.jumps.append(0)
+                self.reads_m.append(False)
+                continue
+            comp = (word >> 6) & 0x7F
+            if comp not in COMPUTATIONS:
+                raise ValueError(f'Invalid instruction word: {word:016b}')
+            self.a_values.append(None)
+            self.computations.append(COMPUTATIONS[comp])
+            self.dests.append((word >> 3) & 0b111)
+            self.jumps.append(word & 0b111)
+            self.reads_m.append(bool(comp & 0x40))
+
+        # An unconditional jump to the A-instruction right before it, as in
+        # '(END) @END 0;JMP', is the conventional end of a Hack program
+        self.halt_addresses = {
+            pc for pc in range(1, len(words))
+            if self.jumps[pc] == 0b111 and self.a_values[pc - 1] == pc - 1
+        }
+
+    def run(self, max_cycles=None, profile=True):
+        """
+        Runs the program until it reaches a halt loop, runs past the end of
+        the ROM or has executed max_cycles instructions. With profile, the
+        executions of each ROM address are counted. Returns the number of
+        cycles run by this call.
+        """
+        ram = self.ram
+        a_values = self.a_values
+        computations = self.computations
+        dests = self.dests
+        jumps = self.jumps
+        reads_m = self.reads_m
+        halt_addresses = self.halt_addresses
+        counts = self.execution_counts if profile else None
+        rom_size = len(a_values)
+        limit = max_cycles if max_cycles is not None else float('inf')
+
+        pc, a, d = self.pc, self.a, self.d
+        cycles = 0
+        while cycles < limit:
+            if pc >= rom_size or pc in halt_addresses:
+                self.halted = True
+                break
+            cycles += 1
+            if counts is not None:
+                counts[pc] += 1
+
+            value = a_values[pc]
+            if value is not None:
+                a = value
+                pc += 1
+                continue
+
+            value = computations[pc](
+                d, a, ram[a & 0x7FFF] if reads_m[pc] else 0) & 0xFFFF
+            dest = dests[pc]
+            target = a
+            if dest & 0b001:
+                ram[a & 0x7FFF] = value
+            if dest & 0b100:
+                a = value
+            if dest & 0b010:
+                d = value
+
+            jump = jumps[pc]
+            if jump and (
+                    (jump & 0b010 and value == 0) or
+                    (jump & 0b100 and value & 0x8000) or
+                    (jump & 0b001 and 0 < value < 0x8000)):
+                pc = target
+            else:
+                pc += 1
+
+        self.pc, self.a, self.d = pc, a, d
+        self.cycles += cycles
+        return cycles
+
+    def label_counts(self):
+        """
+        Returns the instructions executed under each label: the executions
+        of every ROM address from the label up to the next label at a
+        higher address. Labels at the same address share their count.
+        """
+        addresses = sorted(set(self.labels.values()))
+        next_address = dict(zip(addresses,
+                                addresses[1:] + [len(self.execution_counts)]))
+        return {
+            label: sum(self.execution_counts[address:next_address[address]])
+            for label, address in self.labels.items()
+        }
+
+    def read_ram(self, start, end):
+        """Returns RAM[start:end] as signed integers."""
+        return [to_signed(word) for word in self.ram[start:end]]
+
+
+def parse_assignment(text):
+    """Parses an 'address=value' command-line argument."""
+    address, value = text.split('=')
+    return int(address), int(value)
+
+
+def parse_range(text):
+    """Parses a 'start-end' (inclusive) or 'address' RAM range argument."""
+    start, _, end = text.partition('-')
+    return int(start), int(end or start) + 1
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Runs a Hack assembly program and reports its cycle '
+                    'count, final RAM state and per-label execution counts.')
+    arg_parser.add_argument('asm_path', help='path to a .asm file')
+    arg_parser.add_argument(
+        '--cycles', type=int,
+        help='maximum number of cycles to run (default: until halted)')
+    arg_parser.add_argument(
+        '--set', type=parse_assignment, action='append', default=[],
+        metavar='ADDRESS=VALUE', help='initial RAM value, may be repeated')
+    arg_parser.add_argument(
+        '--ram', type=parse_range, action='append', default=[],
+        metavar='START-END',
+        help='RAM range to print in addition to RAM[0-15], may be repeated')
+    arg_parser.add_argument(
+        '--labels', type=int, default=20,
+        help='number of most executed labels to print')
+    arg_parser.add_argument(
+        '--counts', metavar='PATH',
+        help='write the execution count of each ROM address to PATH as a '
+             'JSON list, e.g. for SourceMap.py')
+    args = arg_parser.parse_args()
+
+    with open(args.asm_path, 'r') as file:
+        emulator = HackEmulator.from_asm(file, dict(args.set))
+    emulator.run(args.cycles)
+
+    state = 'halted' if emulator.halted else 'stopped'
+    print(f'{state} after {emulator.cycles} cycles at PC={emulator.pc}')
+    for start, end in [(0, 16)] + args.ram:
+        for address, value in zip(range(start, end),
+                                  emulator.read_ram(start, end)):
+            print(f'RAM[{address}] = {value}')
+    if args.counts:
+        with open(args.counts, 'w') as file:
+            json.dump(emulator.execution_counts, file)
+    label_counts = sorted(emulator.label_counts().items(),
+                          key=lambda item: item[1], reverse=True)
+    if label_counts:
+        print('Most executed labels:')
+        for label, count in label_counts[:args.labels]:
+            print(f'  {count:>10}  {label}')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (FileNotFoundError, ValueError) as e:
+        print(f'Emulation Error: {e}')
+        sys.exit(1)
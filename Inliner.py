@@ -0,0 +1,216 @@
+from Parser import Command, CommandType, with_source
+from CallGraph import split_functions
+
+
+# Default limits on the functions that are inlined: commands in the body
+# (not counting 'function') and local variables
+DEFAULT_MAX_SIZE = 12
+DEFAULT_MAX_LOCALS = 2
+
+# Stack effect of each command type an inlinable body may contain
+STACK_EFFECTS = {
+    CommandType.C_PUSH: 1,
+    CommandType.C_POP: -1,
+    CommandType.C_LABEL: 0,
+    CommandType.C_GOTO: 0,
+    CommandType.C_IF: -1,
+    CommandType.C_RETURN: 0,
+}
+UNARY_COMMANDS = {'neg', 'not'}
+
+
+def frame_depths(body, entry_depth):
+    """
+    Returns the stack depth above the frame base before each command of a
+    function body (without its 'function' command), given the depth on
+    entry, or None if the depth is not the same on every path to a label,
+    the body pops into its frame or can fall off its end. Unreachable
+    commands get a depth of None.
+    """
+    depths = []
+    depth = entry_depth
+    label_depths = {}
+    jump_depths = {}
+    for cmd_type, arg1, *_ in body:
+        if cmd_type == CommandType.C_LABEL:
+            expected = jump_depths.get(arg1)
+            if depth is None:
+                depth = expected
+            elif expected is not None and expected != depth:
+                return None
+            if depth is None:
+                # Only reached by a later backward jump
+                return None
+            label_depths[arg1] = depth
+        depths.append(depth)
+        if depth is None:
+            continue
+
+        if cmd_type == CommandType.C_ARITHMETIC:
+            depth += 0 if arg1 in UNARY_COMMANDS else -1
+        elif cmd_type in STACK_EFFECTS:
+            depth += STACK_EFFECTS[cmd_type]
+        else:
+            return None
+        if cmd_type in (CommandType.C_GOTO, CommandType.C_IF):
+            known = label_depths.get(arg1, jump_depths.get(arg1))
+            if known is not None and known != depth:
+                return None
+            jump_depths[arg1] = depth
+        if depth < entry_depth and cmd_type != CommandType.C_RETURN:
+            return None
+        if cmd_type in (CommandType.C_GOTO, CommandType.C_RETURN):
+            depth = None
+
+    if depth is not None or not set(jump_depths) <= set(label_depths):
+        return None
+    return depths
+
+
+class InlineCandidate:
+    def __init__(self, file_name, n_locals, body):
+        """
+        A leaf function that may be inlined: its file, local count and body
+        without the 'function' command.
+        """
+        self.file_name = file_name
+        self.n_locals = n_locals
+        self.body = body
+        self.uses_statics = any(command[1] == 'static' for command in body
+                                if command[0] in (CommandType.C_PUSH,
+                                                  CommandType.C_POP))
+        self.n_arguments = 1 + max(
+            (command[2] for command in body
+             if command[0] in (CommandType.C_PUSH, CommandType.C_POP) and
+             command[1] == 'argument'), default=-1)
+        # Pointers the body sets, which a real return would restore
+        self.saved_pointers = sorted({
+            command[2] for command in body
+            if command[0] == CommandType.C_POP and command[1] == 'pointer'})
+
+
+def find_candidates(programs, max_size, max_locals):
+    """
+    Returns the functions small enough to inline, by name: leaf functions
+    of at most max_size commands and max_locals locals.
+    """
+    candidates = {}
+    for file_name, commands in programs:
+        for name, body in split_functions(commands):
+            if name is None or name in candidates:
+                continue
+            n_locals = body[0][2]
+            if len(body) - 1 > max_size or n_locals > max_locals:
+                continue
+            if any(command[0] not in STACK_EFFECTS and
+                   command[0] != CommandType.C_ARITHMETIC
+                   for command in body[1:]):
+                continue
+            candidates[name] = InlineCandidate(file_name, n_locals, body[1:])
+    return candidates
+
+
+def expand_call(candidate, n_args, prefix):
+    """
+    Returns the commands that replace 'call f n_args' with the body of f,
+    or None if the body cannot be inlined there. The callee's frame lives
+    on the caller's stack: its arguments are already there, its locals and
+    the pointers it sets are pushed after them, and every argument and
+    local access becomes a 'stack' access relative to SP. Labels are
+    renamed with the given prefix.
+    """
+    if candidate.n_arguments > n_args:
+        return None
+    n_locals = candidate.n_locals
+    pointer_slots = {pointer: n_args + n_locals + i
+                     for i, pointer in enumerate(candidate.saved_pointers)}
+    entry_depth = n_args + n_locals + len(pointer_slots)
+    depths = frame_depths(candidate.body, entry_depth)
+    if depths is None:
+        return None
+
+    expanded = [Command(CommandType.C_PUSH, 'constant', 0)] * n_locals
+    expanded += [Command(CommandType.C_PUSH, 'pointer', pointer)
+                 for pointer in candidate.saved_pointers]
+    # The renamed labels all extend the prefix, so it is free as a label
+    end_label = prefix
+    last = len(candidate.body) - 1
+    needs_end_label = False
+    for i, (command, depth) in enumerate(zip(candidate.body, depths)):
+        if depth is None:
+            continue
+        cmd_type, arg1, arg2, *_ = command
+        if cmd_type in (CommandType.C_PUSH, CommandType.C_POP) and \
+                arg1 in ('argument', 'local'):
+            slot = arg2 if arg1 == 'argument' else n_args + arg2
+            if cmd_type == CommandType.C_PUSH:
+                offset = depth - slot
+            else:
+                offset = depth - 1 - slot
+            expanded.append(with_source(Command(cmd_type, 'stack', offset),
+                                        command))
+        elif cmd_type in (CommandType.C_LABEL, CommandType.C_GOTO,
+                          CommandType.C_IF):
+            expanded.append(with_source(
+                Command(cmd_type, f'{prefix}${arg1}', None), command))
+        elif cmd_type == CommandType.C_RETURN:
+            for pointer, slot in pointer_slots.items():
+                expanded.append(Command(CommandType.C_PUSH, 'stack',
+                                        depth - slot))
+                expanded.append(Command(CommandType.C_POP, 'pointer',
+                                        pointer))
+            expanded.append(with_source(
+                Command(CommandType.C_INLINE_RETURN, None, depth), command))
+            if i != last:
+                expanded.append(Command(CommandType.C_GOTO, end_label, None))
+                needs_end_label = True
+        else:
+            expanded.append(command)
+    if needs_end_label:
+        expanded.append(Command(CommandType.C_LABEL, end_label, None))
+    return expanded
+
+
+def inline_functions(programs, max_size=DEFAULT_MAX_SIZE,
+                     max_locals=DEFAULT_MAX_LOCALS, sites=None):
+    """
+    Inlines the calls to small leaf functions across a whole program,
+    given as a list of (file_name, commands) pairs. Functions that use
+    statics are only inlined within their own file. The inlined functions
+    themselves are kept; dead-function elimination drops them once no
+    calls are left. If sites is given, only the call sites in it are
+    inlined, as (caller, n) for the n-th call in the caller. Returns
+    (programs, inlined), where inlined counts the inlined call sites per
+    function.
+    """
+    candidates = find_candidates(programs, max_size, max_locals)
+    inlined = {}
+    inlined_programs = []
+    for file_name, commands in programs:
+        new_commands = []
+        caller = file_name
+        site_count = 0
+        call_count = 0
+        for command in commands:
+            cmd_type, arg1, arg2, *_ = command
+            if cmd_type == CommandType.C_FUNCTION:
+                caller = arg1
+                site_count = call_count = 0
+            candidate = None
+            if cmd_type == CommandType.C_CALL:
+                if sites is None or (caller, call_count) in sites:
+                    candidate = candidates.get(arg1)
+                call_count += 1
+            if candidate is not None and (
+                    not candidate.uses_statics or
+                    candidate.file_name == file_name):
+                expanded = expand_call(candidate, arg2,
+                                       f'{caller}$inline.{site_count}')
+                if expanded is not None:
+                    site_count += 1
+                    inlined[arg1] = inlined.get(arg1, 0) + 1
+                    new_commands.extend(expanded)
+                    continue
+            new_commands.append(command)
+        inlined_programs.append((file_name, new_commands))
+    return inlined_programs, inlined
@@ -0,0 +1,112 @@
+from Parser import Command, CommandType, with_source
+
+
+def to_signed16(value):
+    """Wraps an integer to the signed 16-bit range of the Hack word."""
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+# Translate-time evaluation of each command on constant operands, matching
+# the 16-bit arithmetic of the generated code (comparisons test x - y)
+BINARY_FOLDS = {
+    'add': lambda x, y: x + y,
+    'sub': lambda x, y: x - y,
+    'and': lambda x, y: x & y,
+    'or': lambda x, y: x | y,
+    'eq': lambda x, y: -1 if to_signed16(x - y) == 0 else 0,
+    'lt': lambda x, y: -1 if to_signed16(x - y) < 0 else 0,
+    'gt': lambda x, y: -1 if to_signed16(x - y) > 0 else 0,
+}
+UNARY_FOLDS = {
+    'neg': lambda x: -x,
+    'not': lambda x: ~x,
+}
+
+
+class ConstantFolder:
+    def __init__(self):
+        """Prepares the per-rewrite hit counters."""
+        self.hits = {'fold': 0, 'identity': 0, 'constant_operand': 0,
+                     'direct_store': 0}
+
+    @staticmethod
+    def _constant(command):
+        """Returns the value pushed by 'push constant', else None."""
+        if command[0] == CommandType.C_PUSH and command[1] == 'constant':
+            return command[2]
+        return None
+
+    def optimize(self, commands):
+        """
+        Yields the commands with arithmetic on constants evaluated at
+        translate time, 'push constant k' + binary command lowered to a
+        C_ARITHMETIC_CONSTANT superinstruction and 'push constant k' +
+        'pop' to a C_POP_CONSTANT direct store. Works on a stream: only the
+        trailing run of constant pushes, which may still fold, is held back.
+        """
+        pending = []
+        for command in commands:
+            pending.append(command)
+            while self._rewrite_tail(pending):
+                pass
+
+            # Rewrites only consume constant pushes at the end of pending,
+            # so everything before them is final
+            keep = len(pending)
+            while keep > 0 and self._constant(pending[keep - 1]) is not None:
+                keep -= 1
+            if keep:
+                yield from pending[:keep]
+                del pending[:keep]
+        yield from pending
+
+    def _rewrite_tail(self, commands):
+        """
+        Applies one rewrite to the end of the command list.
+        Returns True if the list was rewritten.
+        """
+        if len(commands) < 2:
+            return False
+        cmd_type, arg1, arg2, *_ = commands[-1]
+        y = self._constant(commands[-2])
+        if y is None:
+            return False
+
+        if cmd_type == CommandType.C_ARITHMETIC:
+            if arg1 in UNARY_FOLDS:
+                commands[-2:] = [with_source(
+                    Command(CommandType.C_PUSH, 'constant',
+                            to_signed16(UNARY_FOLDS[arg1](y))),
+                    commands[-1])]
+                self.hits['fold'] += 1
+                return True
+
+            x = self._constant(commands[-3]) if len(commands) > 2 else None
+            if x is not None:
+                commands[-3:] = [with_source(
+                    Command(CommandType.C_PUSH, 'constant',
+                            to_signed16(BINARY_FOLDS[arg1](x, y))),
+                    commands[-1])]
+                self.hits['fold'] += 1
+            elif arg1 in ('add', 'sub') and y == 0:
+                del commands[-2:]
+                self.hits['identity'] += 1
+            else:
+                commands[-2:] = [with_source(
+                    Command(CommandType.C_ARITHMETIC_CONSTANT, arg1, y),
+                    commands[-1])]
+                self.hits['constant_operand'] += 1
+            return True
+
+        if cmd_type == CommandType.C_POP:
+            commands[-2:] = [with_source(
+                Command(CommandType.C_POP_CONSTANT, arg1, (arg2, y)),
+                commands[-1])]
+            self.hits['direct_store'] += 1
+            return True
+        return False
+
+    def report(self):
+        """Returns a one-line summary of the rewrite hit counts."""
+        return ', '.join(f'{name}={hits}' for name, hits in self.hits.items())
@@ -1,4 +1,6 @@
+from collections import namedtuple
 from enum import Enum, auto
+import sys
 
 
 class CommandType(Enum):
@@ -11,32 +13,81 @@ class CommandType(Enum):
     C_FUNCTION = auto()
     C_RETURN = auto()
     C_CALL = auto()
+    # Superinstructions produced by Optimizer, never by the Parser
+    C_ARITHMETIC_CONSTANT = auto()  # <arg1> with constant arg2 as operand y
+    # pop constant value to arg1 segment, arg2 is (index, value)
+    C_POP_CONSTANT = auto()
+    # Produced by the Inliner: the end of an inlined function body, whose
+    # frame is arg2 words deep
+    C_INLINE_RETURN = auto()
+
+
+# A tokenized command; arguments a command type does not have are None
+Command = namedtuple('Command', ['command_type', 'arg1', 'arg2'])
+
+
+# A Command with where it was parsed from, for source maps: line_number is
+# the 1-based .vm line and text the cleaned command. Passes read its first
+# three fields as they read a Command's; two SourceCommands are equal only
+# if their locations are too.
+SourceCommand = namedtuple('SourceCommand', Command._fields +
+                           ('line_number', 'text'))
+
+
+def with_source(command, source):
+    """
+    Returns command located at the line of source when source is a
+    SourceCommand, e.g. for a command that a rewrite put in its place.
+    """
+    if isinstance(source, SourceCommand):
+        return SourceCommand(*command, source.line_number, source.text)
+    return command
 
 
 class Parser:
     ARITHMETIC_COMMANDS = {
         'add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not'
     }
+    COMMAND_TYPES = {
+        **{command: CommandType.C_ARITHMETIC
+           for command in ARITHMETIC_COMMANDS},
+        'push': CommandType.C_PUSH,
+        'pop': CommandType.C_POP,
+        'label': CommandType.C_LABEL,
+        'if-goto': CommandType.C_IF,
+        'goto': CommandType.C_GOTO,
+        'function': CommandType.C_FUNCTION,
+        'return': CommandType.C_RETURN,
+        'call': CommandType.C_CALL,
+    }
+    # Command types with an integer second argument
+    TWO_ARGUMENT_COMMANDS = {
+        CommandType.C_PUSH, CommandType.C_POP,
+        CommandType.C_FUNCTION, CommandType.C_CALL
+    }
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, streaming=False):
         """
         Opens the input file, cleans it of all comments and whitespace, and
-        stores a list of pure commands.
+        stores a list of pure commands. With streaming, nothing is read up
+        front and commands() reads the file lazily instead, so memory use
+        does not grow with the file size.
         """
-        with open(file_path, 'r') as file:
-            raw_lines = file.readlines()
-
-        cleaned_lines = []
-        for line in raw_lines:
-            cleaned_line = line.split('//')[0].strip()
-
-            if cleaned_line:
-                cleaned_lines.append(cleaned_line)
-
-        self.lines = cleaned_lines
+        self.file_path = file_path
+        self.streaming = streaming
+        self.lines = [] if streaming else list(self._clean_lines())
         self.current_line_index = -1
         self.current_command = ''
 
+    def _clean_lines(self):
+        """Yields the input's lines without comments and whitespace."""
+        with open(self.file_path, 'r') as file:
+            for line in file:
+                cleaned_line = line.split('//')[0].strip()
+
+                if cleaned_line:
+                    yield cleaned_line
+
     def has_more_commands(self):
         """Returns True if there are any more commands in the input."""
         return self.current_line_index < len(self.lines) - 1
@@ -52,27 +103,11 @@ class Parser:
         """Returns the type of the current VM command."""
         first_word = self.current_command.split()[0]
 
-        if first_word in self.ARITHMETIC_COMMANDS:
-            return CommandType.C_ARITHMETIC
-        elif first_word == 'push':
-            return CommandType.C_PUSH
-        elif first_word == 'pop':
-            return CommandType.C_POP
-        elif first_word == 'label':
-            return CommandType.C_LABEL
-        elif first_word == 'if-goto':
-            return CommandType.C_IF
-        elif first_word == 'goto':
-            return CommandType.C_GOTO
-        elif first_word == 'function':
-            return CommandType.C_FUNCTION
-        elif first_word == 'return':
-            return CommandType.C_RETURN
-        elif first_word == 'call':
-            return CommandType.C_CALL
-        else:
+        cmd_type = self.COMMAND_TYPES.get(first_word)
+        if cmd_type is None:
             raise ValueError(
                 f'Unknown command type for: {self.current_command}')
+        return cmd_type
 
     def arg1(self):
         """
@@ -96,3 +131,60 @@ class Parser:
         # The second argument is the third word in the command, returned as an
         # int
         return int(self.current_command.split()[2])
+
+    @classmethod
+    def parse_command(cls, line):
+        """
+        Tokenizes a cleaned line, exactly once, into a Command. The command
+        and argument strings are interned, so the many commands naming the
+        same segment, label or function share one string.
+        """
+        words = line.split()
+        cmd_type = cls.COMMAND_TYPES.get(words[0])
+        if cmd_type is None:
+            raise ValueError(f'Unknown command type for: {line}')
+
+        if cmd_type == CommandType.C_ARITHMETIC:
+            return Command(cmd_type, sys.intern(words[0]), None)
+        elif cmd_type == CommandType.C_RETURN:
+            return Command(cmd_type, None, None)
+        elif len(words) < (3 if cmd_type in cls.TWO_ARGUMENT_COMMANDS
+                           else 2):
+            raise ValueError(f'Missing argument for: {line}')
+        elif cmd_type in cls.TWO_ARGUMENT_COMMANDS:
+            return Command(cmd_type, sys.intern(words[1]), int(words[2]))
+        return Command(cmd_type, sys.intern(words[1]), None)
+
+    def commands(self, interned=None):
+        """
+        Yields the remaining commands as Command records. In streaming mode
+        the file is read lazily, one line at a time. Given a dict for
+        interned, equal lines yield the one Command kept in it, so a caller
+        that holds many commands stores each distinct one once.
+        """
+        if self.streaming:
+            lines = self._clean_lines()
+        else:
+            lines = self.lines[self.current_line_index + 1:]
+            self.current_line_index = len(self.lines) - 1
+        if interned is None:
+            for line in lines:
+                yield self.parse_command(line)
+            return
+        for line in lines:
+            command = interned.get(line)
+            if command is None:
+                command = interned[line] = self.parse_command(line)
+            yield command
+
+    def source_commands(self):
+        """
+        Yields all commands of the file as SourceCommand records, reading
+        it lazily, for translations that write a source map.
+        """
+        with open(self.file_path, 'r') as file:
+            for line_number, line in enumerate(file, 1):
+                cleaned_line = line.split('//')[0].strip()
+                if cleaned_line:
+                    yield SourceCommand(*self.parse_command(cleaned_line),
+                                        line_number, cleaned_line)
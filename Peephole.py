@@ -0,0 +1,232 @@
+import re
+from collections import deque
+
+
+# Rewrite rules as (name, pattern, replacement). A pattern is a tuple of
+# regexes, one per consecutive instruction (comments are skipped); a named
+# group used on several lines must capture the same text on each. The
+# replacement lines are str.format templates over the named groups.
+# Every rule must preserve the values of A, D and RAM that the following
+# code can observe.
+DEFAULT_RULES = [
+    # An increment immediately undone by a decrement of the same address,
+    # e.g. SP++ of a push and SP-- of the following pop once the second
+    # '@SP' is gone
+    ('inc_dec', (r'M=M\+1', 'M=M-1'), ()),
+    # Updating a pointer and then following it
+    ('fold_dec_load', ('M=M-1', 'A=M'), ('AM=M-1',)),
+    ('fold_inc_load', (r'M=M\+1', 'A=M'), ('AM=M+1',)),
+    # Storing D and loading it straight back from the same address
+    ('store_reload', ('M=D', 'D=M'), ('M=D',)),
+    # Reloading an address that A still holds
+    ('redundant_a_reload',
+     ('(?P<a>@.+)', '(?P<c>(?:M|D|MD|DM)=[^;]*)', '(?P<a>@.+)'),
+     ('{a}', '{c}')),
+]
+
+
+# A pattern line that is one named group spanning the whole line
+WHOLE_LINE_GROUP = re.compile(r'\(\?P<(\w+)>[^()]*\)')
+
+
+def literal_line(pattern):
+    """
+    Returns the only line a pattern line matches, or None if the regex has
+    any metacharacter and so may match several lines.
+    """
+    if re.search(r'[.^$*+?{}\[\]|()]', re.sub(r'\\.', '', pattern)):
+        return None
+    return re.sub(r'\\(.)', r'\1', pattern)
+
+
+class PeepholeOptimizer:
+    # Distinct instructions whose rules are remembered, beyond which the
+    # memo starts over, e.g. for the many distinct return labels
+    MAX_REMEMBERED_LINES = 4096
+
+    def __init__(self, output_file, rules=None, window_size=8):
+        """
+        Buffers the instruction stream written by the CodeWriter, rewrites
+        it with the given rules and passes the result on to output_file.
+        """
+        self.output_file = output_file
+        # Each pattern line is kept as the literal line it matches, which
+        # is compared as a string, or else as a compiled regex
+        self.rules = [
+            (name, [literal_line(line) or re.compile(line)
+                    for line in pattern], replacement)
+            for name, pattern, replacement in (rules or DEFAULT_RULES)
+        ]
+        # The rules that may end at each instruction seen so far, filled in
+        # by _rules_ending
+        self.rules_by_last_line = {}
+        self.window_size = window_size
+        self.instructions = deque()     # Pending instructions
+        self.comments = deque()     # Comment lines in front of each
+        self.trailing_comments = []     # Comments after the last one
+        self.hits = {rule[0]: 0 for rule in self.rules}
+        self.words_saved = 0
+
+    def write_lines(self, lines):
+        """Feeds assembly lines into the optimization window."""
+        instructions = self.instructions
+        comments = self.comments
+        rules_by_last_line = self.rules_by_last_line
+        window_size = self.window_size
+        output = []     # Lines that left the window, written at the end
+        for line in lines:
+            if not line or line[0] == '(':
+                # A label is a jump target, so nothing may be rewritten
+                # across it
+                self._drain(output)
+                output.append(line)
+                continue
+
+            if line[0] == '/':
+                self.trailing_comments.append(line)
+                continue
+            if self.trailing_comments:
+                comments.append(self.trailing_comments)
+                self.trailing_comments = []
+            else:
+                comments.append(())
+            instructions.append(line)
+            rules = rules_by_last_line.get(line)
+            if rules is None:
+                rules = self._rules_ending(line)
+            # Most instructions end no rule
+            if rules and self._apply_rules(rules):
+                while self._apply_rules():
+                    pass
+            while len(instructions) > window_size:
+                output.extend(comments.popleft())
+                output.append(instructions.popleft())
+        if output:
+            self.output_file.write('\n'.join(output) + '\n')
+
+    def _apply_rules(self, rules=None):
+        """
+        Applies the first rule that matches the end of the window, out of
+        the given rules ending at its last instruction, if they are known.
+        Returns True if the window was rewritten.
+        """
+        instructions = self.instructions
+        if not instructions:
+            return False
+        if rules is None:
+            rules = self.rules_by_last_line.get(instructions[-1])
+        if rules is None:
+            rules = self._rules_ending(instructions[-1])
+        for name, length, checks, replacement, groups in rules:
+            if length > len(instructions):
+                continue
+            # Most candidates already fail on their first, literal check
+            if checks:
+                offset, check = checks[0]
+                if check.__class__ is str and instructions[-offset] != check:
+                    continue
+            groups = self._match(checks, instructions, groups)
+            if groups is None:
+                continue
+
+            # The comments of the replaced instructions stay in front of
+            # the replacement
+            comments = self.trailing_comments
+            for _ in range(length):
+                instructions.pop()
+                comments = [*self.comments.pop(), *comments]
+            new_lines = [line.format(**groups) for line in replacement]
+            if new_lines:
+                self.comments.append(comments)
+                self.comments.extend(() for _ in new_lines[1:])
+                instructions.extend(new_lines)
+                comments = []
+            self.trailing_comments = comments
+            self.hits[name] += 1
+            self.words_saved += length - len(new_lines)
+            return True
+        return False
+
+    def _rules_ending(self, line):
+        """
+        Returns the rules whose last pattern line matches the given
+        instruction, in rule order, as (name, length, checks, replacement,
+        groups): groups holds what the last line captured and checks pairs
+        the offsets from the end still to match with their pattern lines,
+        the literal ones first. A pattern line that is a single named group
+        the last line already captured becomes that literal text. The
+        result is remembered for the next time.
+        """
+        rules = []
+        for name, pattern, replacement in self.rules:
+            last_line = pattern[-1]
+            groups = {}
+            if isinstance(last_line, str):
+                if last_line != line:
+                    continue
+            else:
+                match = last_line.fullmatch(line)
+                if match is None:
+                    continue
+                groups = match.groupdict()
+            checks = []
+            for offset, check in enumerate(reversed(pattern[:-1]), 2):
+                if not isinstance(check, str):
+                    group = WHOLE_LINE_GROUP.fullmatch(check.pattern)
+                    if group and group[1] in groups:
+                        check = groups[group[1]]
+                checks.append((offset, check))
+            checks.sort(key=lambda offset_check: not isinstance(
+                offset_check[1], str))
+            rules.append((name, len(pattern), checks, replacement, groups))
+        rules = tuple(rules)
+        if len(self.rules_by_last_line) >= self.MAX_REMEMBERED_LINES:
+            self.rules_by_last_line.clear()
+        self.rules_by_last_line[line] = rules
+        return rules
+
+    @staticmethod
+    def _match(checks, instructions, groups):
+        """
+        Matches the last instructions against the (offset from the end,
+        pattern line) pairs of a rule, given the groups the last line
+        captured. Returns all named groups, or None if the lines do not
+        match.
+        """
+        groups = dict(groups)
+        for offset, check in checks:
+            line = instructions[-offset]
+            if check.__class__ is str:
+                if line != check:
+                    return None
+                continue
+            match = check.fullmatch(line)
+            if match is None:
+                return None
+            for name, value in match.groupdict().items():
+                if groups.setdefault(name, value) != value:
+                    return None
+        return groups
+
+    def _drain(self, output):
+        """Moves all buffered lines to the end of output."""
+        for comments, instruction in zip(self.comments, self.instructions):
+            output.extend(comments)
+            output.append(instruction)
+        output.extend(self.trailing_comments)
+        self.instructions.clear()
+        self.comments.clear()
+        self.trailing_comments = []
+
+    def flush(self):
+        """Writes out all buffered lines."""
+        output = []
+        self._drain(output)
+        if output:
+            self.output_file.write('\n'.join(output) + '\n')
+
+    def report(self):
+        """Returns a one-line summary of the per-rule hit counts."""
+        rule_hits = ', '.join(f'{name}={hits}'
+                              for name, hits in self.hits.items())
+        return f'{rule_hits}; {self.words_saved} ROM words saved'
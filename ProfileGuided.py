@@ -0,0 +1,213 @@
+import argparse
+import io
+import json
+import os
+import sys
+from Parser import CommandType, Parser
+from HackAssembler import assemble
+from HackEmulator import HackEmulator, parse_assignment
+from SourceMap import SourceMapWriter, aggregate_counts
+
+
+# Share of the profiled cycles that the hot functions cover by default
+DEFAULT_COVERAGE = 0.95
+
+# Pseudo functions of the source map that are not VM functions
+NON_FUNCTIONS = {'-', '$BOOTSTRAP', '$SHARED'}
+
+
+def find_call_sites(vm_paths):
+    """
+    Returns the call sites of the .vm files: a dict from (file, line) to
+    (caller, n, callee) for the n-th call in the caller, numbered as
+    inline_functions numbers them.
+    """
+    call_sites = {}
+    for path in vm_paths:
+        file_name = os.path.splitext(os.path.basename(path))[0]
+        caller = file_name
+        call_count = 0
+        for command in Parser(path, streaming=True).source_commands():
+            if command.command_type == CommandType.C_FUNCTION:
+                caller = command.arg1
+                call_count = 0
+            elif command.command_type == CommandType.C_CALL:
+                call_sites[f'{file_name}.vm', command.line_number] = (
+                    caller, call_count, command.arg1)
+                call_count += 1
+    return call_sites
+
+
+def collect_profile(vm_paths, sources, counts):
+    """
+    Builds a profile from the execution counts of a program translated
+    with a source map: the cycles and calls of each function and the
+    executions of each call site, in a caller's call order. sources gives
+    the (file, line, function, command) of each ROM address.
+    """
+    by_function, _ = aggregate_counts(sources, counts)
+    functions = {name: {'calls': 0, 'cycles': cycles}
+                 for name, cycles in by_function.items()
+                 if name not in NON_FUNCTIONS}
+    site_locations = find_call_sites(vm_paths)
+    call_sites = {}
+    for caller, _, _ in site_locations.values():
+        call_sites.setdefault(caller, []).append(0)
+
+    seen = set()
+    for (file_name, line_number, _, _), count in zip(sources, counts):
+        location = (file_name, line_number)
+        if location in seen or location not in site_locations:
+            continue
+        # The first instruction of a call runs once per call
+        seen.add(location)
+        caller, n, callee = site_locations[location]
+        call_sites[caller][n] = count
+        functions.setdefault(callee, {'calls': 0, 'cycles': 0})
+        functions[callee]['calls'] += count
+    return {'cycles': sum(counts), 'functions': functions,
+            'call_sites': call_sites}
+
+
+def profile_program(vm_paths, max_cycles=None, ram=None):
+    """
+    Translates the .vm files with a source map, runs the result on the
+    emulator and returns its profile.
+    """
+    # Imported here because VMTranslator imports this module
+    from VMTranslator import new_code_writer, parse_args, write_program
+
+    args = parse_args(['.', '--source-map'])
+    has_sys = any(os.path.basename(path).lower() == 'sys.vm'
+                  for path in vm_paths)
+    source_map_writer = SourceMapWriter(io.StringIO())
+    code_writer = new_code_writer(source_map_writer, args)
+    write_program(code_writer,
+                  [(os.path.splitext(os.path.basename(path))[0], path, None,
+                    args)
+                   for path in vm_paths],
+                  has_sys)
+    code_writer.flush()
+
+    words, _, _ = assemble(
+        source_map_writer.output_file.getvalue().splitlines())
+    emulator = HackEmulator(words, ram=ram)
+    emulator.run(max_cycles)
+    sources = [source_map_writer.sources[index]
+               for index in source_map_writer.addresses]
+    return collect_profile(vm_paths, sources, emulator.execution_counts)
+
+
+def load_profile(path):
+    """Reads a profile written by save_profile."""
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def save_profile(profile, path):
+    """Writes a profile as JSON."""
+    with open(path, 'w') as file:
+        json.dump(profile, file, indent=2, sort_keys=True)
+        file.write('\n')
+
+
+def hot_functions(profile, coverage=DEFAULT_COVERAGE):
+    """
+    Returns the names of the fewest functions that together account for
+    at least the given share of the profiled function cycles.
+    """
+    functions = sorted(profile['functions'].items(),
+                       key=lambda item: (-item[1]['cycles'], item[0]))
+    total = sum(metrics['cycles'] for _, metrics in functions)
+    hot = set()
+    covered = 0
+    for name, metrics in functions:
+        if covered >= coverage * total or not metrics['cycles']:
+            break
+        hot.add(name)
+        covered += metrics['cycles']
+    return hot
+
+
+def hot_call_sites(profile, hot):
+    """
+    Returns the executed call sites in the given hot functions, as the
+    (caller, n) pairs that inline_functions takes.
+    """
+    return {(caller, n)
+            for caller, counts in profile['call_sites'].items()
+            if caller in hot
+            for n, count in enumerate(counts) if count}
+
+
+def count_cold_calls(programs, hot, tail_calls=False):
+    """
+    Returns the numbers of call sites and returns outside the hot
+    functions of a program, given as (file_name, commands) pairs. With
+    tail_calls, a call followed by a return counts as neither.
+    """
+    calls = returns = 0
+    for _, commands in programs:
+        function_name = None
+        previous = None
+        for cmd_type, arg1, *_ in commands:
+            if cmd_type == CommandType.C_FUNCTION:
+                function_name = arg1
+            elif function_name not in hot:
+                if cmd_type == CommandType.C_CALL:
+                    calls += 1
+                elif cmd_type == CommandType.C_RETURN:
+                    if tail_calls and previous == CommandType.C_CALL:
+                        calls -= 1
+                    else:
+                        returns += 1
+            previous = cmd_type
+    return calls, returns
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Profiles a VM program for profile-guided '
+                    'optimization: translates it with a source map, runs '
+                    'it on the emulator and writes the cycles and calls '
+                    'of each function and the executions of each call '
+                    'site, for VMTranslator --profile-use.')
+    arg_parser.add_argument(
+        'input_path', help='path to a .vm file or a directory of .vm files')
+    arg_parser.add_argument(
+        '-o', '--output',
+        help='profile path (default: <program>.profile.json next to the '
+             'translator output)')
+    arg_parser.add_argument(
+        '--cycles', type=int,
+        help='maximum number of cycles to run (default: until halted)')
+    arg_parser.add_argument(
+        '--set', type=parse_assignment, action='append', default=[],
+        metavar='ADDRESS=VALUE', help='initial RAM value, may be repeated')
+    args = arg_parser.parse_args()
+
+    input_path = os.path.normpath(args.input_path)
+    if os.path.isdir(input_path):
+        vm_paths = [os.path.join(input_path, file)
+                    for file in sorted(os.listdir(input_path))
+                    if file.endswith('.vm')]
+        output_path = os.path.join(
+            input_path, os.path.basename(input_path) + '.profile.json')
+    else:
+        vm_paths = [input_path]
+        output_path = os.path.splitext(input_path)[0] + '.profile.json'
+    output_path = args.output or output_path
+
+    profile = profile_program(vm_paths, args.cycles, dict(args.set))
+    save_profile(profile, output_path)
+    hot = hot_functions(profile)
+    print(f'Profile written to {output_path}: {profile["cycles"]} cycles, '
+          f'{len(hot)} of {len(profile["functions"])} functions hot')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (FileNotFoundError, ValueError) as e:
+        print(f'Profiling Error: {e}')
+        sys.exit(1)
@@ -0,0 +1,162 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+# Stages of translating one file, in pipeline order
+STAGES = ('read', 'tokenize', 'optimize', 'dispatch', 'emit', 'write')
+
+# Pseudo file name for the work not tied to one .vm file: the bootstrap,
+# the shared routines and closing the output file
+PROGRAM = '<program>'
+
+
+class TranslationProfiler:
+    def __init__(self):
+        """
+        Collects per-file stage timings, command counts and instruction
+        counts during a translation. Hooks registered with add_hook are
+        called with (event, file_name, metrics) as each file finishes
+        ('file') and once for the whole program ('finish').
+        """
+        self.files = {}
+        self.hooks = []
+        self.total_seconds = 0.0
+
+    def add_hook(self, hook):
+        """Registers a hook(event, file_name, metrics) callback."""
+        self.hooks.append(hook)
+
+    def file_metrics(self, file_name):
+        """Returns the metrics of a file, creating them on first use."""
+        metrics = self.files.get(file_name)
+        if metrics is None:
+            metrics = self.files[file_name] = {
+                'stages': dict.fromkeys(STAGES, 0.0),
+                'commands': Counter(),
+                'emitted_instructions': 0,
+                'output_instructions': 0,
+            }
+        return metrics
+
+    @contextmanager
+    def stage(self, file_name, stage):
+        """Adds the time spent in the with-block to a stage of a file."""
+        stages = self.file_metrics(file_name)['stages']
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages[stage] += time.perf_counter() - start
+
+    def count_commands(self, file_name, commands):
+        """Counts the parsed commands of a file by command type."""
+        counts = self.file_metrics(file_name)['commands']
+        for command in commands:
+            counts[command[0].name] += 1
+
+    def count_instructions(self, file_name, emitted, assembly_text):
+        """
+        Records the instructions a file's commands were translated to
+        (emitted) and the ROM words of its assembly text, which are fewer
+        once the peephole pass has run.
+        """
+        metrics = self.file_metrics(file_name)
+        metrics['emitted_instructions'] += emitted
+        metrics['output_instructions'] += sum(
+            1 for line in assembly_text.splitlines()
+            if line and not line.startswith(('//', '(')))
+
+    def end_file(self, file_name):
+        """Calls the hooks with the metrics of a finished file."""
+        metrics = self.file_metrics(file_name)
+        for hook in self.hooks:
+            hook('file', file_name, metrics)
+
+    def finish(self, total_seconds):
+        """Records the total translation time and calls the hooks."""
+        self.total_seconds = total_seconds
+        totals = self.totals()
+        for hook in self.hooks:
+            hook('finish', None, totals)
+
+    def totals(self):
+        """Returns the metrics summed over all files."""
+        stages = dict.fromkeys(STAGES, 0.0)
+        commands = Counter()
+        emitted = output = 0
+        for metrics in self.files.values():
+            for stage, seconds in metrics['stages'].items():
+                stages[stage] += seconds
+            commands.update(metrics['commands'])
+            emitted += metrics['emitted_instructions']
+            output += metrics['output_instructions']
+        return {
+            'total_seconds': self.total_seconds,
+            'stages': stages,
+            'commands': commands,
+            'emitted_instructions': emitted,
+            'output_instructions': output,
+        }
+
+    def metrics(self):
+        """Returns the totals and the per-file metrics as plain dicts."""
+        def plain(metrics):
+            return {**metrics, 'commands': dict(metrics['commands'])}
+
+        return {
+            'totals': plain(self.totals()),
+            'files': {file_name: plain(metrics)
+                      for file_name, metrics in self.files.items()},
+        }
+
+    def report(self):
+        """Returns the profile as printable lines."""
+        totals = self.totals()
+        lines = [f'Profile: {self.total_seconds * 1000:.2f} ms total']
+        for stage, seconds in totals['stages'].items():
+            lines.append(f'  {stage:<10} {seconds * 1000:10.2f} ms')
+
+        lines.append('Commands:')
+        for name, count in totals['commands'].most_common():
+            lines.append(f'  {name:<22} {count:>8}')
+        lines.append(f'Instructions: {totals["emitted_instructions"]} '
+                     f'emitted, {totals["output_instructions"]} output')
+
+        lines.append('Per file (ms): ' + ' '.join(
+            f'{stage:>9}' for stage in STAGES) + '  commands  output')
+        for file_name, metrics in self.files.items():
+            lines.append(
+                f'  {file_name:<12} ' +
+                ' '.join(f'{metrics["stages"][stage] * 1000:9.2f}'
+                         for stage in STAGES) +
+                f'  {sum(metrics["commands"].values()):>8}'
+                f'  {metrics["output_instructions"]:>6}')
+        return lines
+
+
+class TimedCodeWriter:
+    def __init__(self, code_writer, stages):
+        """
+        Forwards to a CodeWriter, adding the time spent in its write_*
+        methods to the 'emit' entry of the stages dict.
+        """
+        self.code_writer = code_writer
+        self.stages = stages
+
+    def __getattr__(self, name):
+        method = getattr(self.code_writer, name)
+        if not name.startswith('write_'):
+            return method
+        stages = self.stages
+
+        def timed(*args):
+            start = time.perf_counter()
+            try:
+                return method(*args)
+            finally:
+                stages['emit'] += time.perf_counter() - start
+
+        # Later lookups find the wrapper without calling __getattr__
+        setattr(self, name, timed)
+        return timed
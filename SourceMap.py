@@ -0,0 +1,167 @@
+import argparse
+import json
+import re
+import sys
+from collections import Counter
+
+
+# Prefix of the comment lines that carry source locations from the
+# CodeWriter to the SourceMapWriter, which removes them from the output
+SOURCE_MARKER = '//@'
+
+# File and line of the code that does not come from a .vm file
+NO_SOURCE = ('-', 0)
+
+# Start of a line holding an instruction: not blank, a comment or a label
+INSTRUCTION_LINE = re.compile(r'^[^/(\n]', re.MULTILINE)
+
+
+def format_marker(file_name, line_number, function_name, text):
+    """
+    Returns the marker line stating that the instructions which follow come
+    from the given .vm file, line, function and command text.
+    """
+    return (f'{SOURCE_MARKER} {file_name} {line_number} '
+            f'{function_name or "-"} {text}')
+
+
+def parse_marker(line):
+    """Returns the (file, line, function, command) of a marker line."""
+    _, file_name, line_number, function_name, text = line.split(' ', 4)
+    return file_name, int(line_number), function_name, text
+
+
+class SourceMapWriter:
+    def __init__(self, output_file):
+        """
+        Wraps the output file of a translation that is written with source
+        markers. The markers are removed from the text passed on to
+        output_file and every instruction is mapped to the location of the
+        marker before it.
+        """
+        self.output_file = output_file
+        self.sources = []           # Distinct (file, line, function, text)
+        self.source_indices = {}    # Source -> index in sources
+        self.addresses = []         # Source index of each ROM address
+        self.current = self._source_index(NO_SOURCE + ('-', ''))
+
+    def _source_index(self, source):
+        index = self.source_indices.get(source)
+        if index is None:
+            index = self.source_indices[source] = len(self.sources)
+            self.sources.append(source)
+        return index
+
+    def write(self, text):
+        """Writes assembly text, which ends at a line boundary."""
+        if SOURCE_MARKER not in text:
+            self._map_instructions(text)
+            self.output_file.write(text)
+            return
+
+        # Split at the marker lines: every part after the first starts with
+        # the rest of a marker line, followed by the lines it applies to
+        parts = ('\n' + text).split('\n' + SOURCE_MARKER)
+        kept_parts = []
+        if parts[0]:
+            kept_parts.append(parts[0][1:])
+            self._map_instructions(kept_parts[-1])
+        for part in parts[1:]:
+            marker, newline, lines = part.partition('\n')
+            self.current = self._source_index(
+                parse_marker(SOURCE_MARKER + marker))
+            if newline:
+                kept_parts.append(lines)
+                self._map_instructions(lines)
+        self.output_file.write('\n'.join(kept_parts))
+
+    def _map_instructions(self, text):
+        """Maps the instructions in text to the current source."""
+        self.addresses.extend(
+            [self.current] * len(INSTRUCTION_LINE.findall(text)))
+
+    def flush(self):
+        """Flushes the output file."""
+        self.output_file.flush()
+
+    def close(self):
+        """Closes the output file."""
+        self.output_file.close()
+
+    def save(self, path):
+        """
+        Writes the source map as JSON: the distinct sources as [file, line,
+        function, command] and the index of the source of each ROM address.
+        """
+        with open(path, 'w') as file:
+            # dumps encodes in one call, much faster than dump for big maps
+            file.write(json.dumps({'sources': self.sources,
+                                   'addresses': self.addresses}))
+
+
+def load_source_map(path):
+    """Returns the (file, line, function, command) of each ROM address."""
+    with open(path, 'r') as file:
+        source_map = json.load(file)
+    sources = [tuple(source) for source in source_map['sources']]
+    return [sources[index] for index in source_map['addresses']]
+
+
+def aggregate_counts(sources, counts):
+    """
+    Sums per-address execution counts by VM function and by VM line.
+    Returns two Counters, keyed by function name and by (file, line,
+    command).
+    """
+    if len(counts) != len(sources):
+        raise ValueError(
+            f'Profile has {len(counts)} addresses but the source map has '
+            f'{len(sources)}')
+    by_function = Counter()
+    by_line = Counter()
+    for (file_name, line_number, function_name, text), count in zip(
+            sources, counts):
+        if count:
+            by_function[function_name] += count
+            by_line[file_name, line_number, text] += count
+    return by_function, by_line
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Aggregates a per-address execution count profile of a '
+                    'translated program into cycles per VM function and '
+                    'per VM line, using the source map written with '
+                    'VMTranslator --source-map.')
+    arg_parser.add_argument('map_path', help='path to a .map.json file')
+    arg_parser.add_argument(
+        'counts_path',
+        help='JSON list of execution counts per ROM address, as written by '
+             'HackEmulator --counts')
+    arg_parser.add_argument(
+        '--top', type=int, default=20,
+        help='number of functions and lines to print')
+    args = arg_parser.parse_args()
+
+    sources = load_source_map(args.map_path)
+    with open(args.counts_path, 'r') as file:
+        counts = json.load(file)
+    by_function, by_line = aggregate_counts(sources, counts)
+    total = sum(counts) or 1
+
+    print('Cycles per VM function:')
+    for function_name, count in by_function.most_common(args.top):
+        print(f'  {count:>10} {count / total:6.1%}  {function_name}')
+    print('Cycles per VM line:')
+    for (file_name, line_number, text), count in by_line.most_common(
+            args.top):
+        print(f'  {count:>10} {count / total:6.1%}  '
+              f'{file_name}:{line_number}  {text}')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (FileNotFoundError, ValueError) as e:
+        print(f'Source Map Error: {e}')
+        sys.exit(1)
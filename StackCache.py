@@ -0,0 +1,310 @@
+from CodeWriter import CodeWriter
+from Parser import CommandType
+
+
+class StackCachingCodeWriter(CodeWriter):
+    # Hack computation of each binary operation on D (y) and M (x), leaving
+    # the result in D
+    BINARY_OPERATIONS_TO_D = {
+        'add': 'D=D+M', 'sub': 'D=M-D', 'and': 'D=D&M', 'or': 'D=D|M'
+    }
+    UNARY_OPERATIONS_TO_D = {'neg': 'D=-D', 'not': 'D=!D'}
+
+    def __init__(self, *args, **kwargs):
+        """
+        A CodeWriter that keeps the top of the VM stack in D between the
+        commands of a basic block. While the top is cached, RAM holds the
+        stack below it and SP points at the top's slot. Commands that work
+        on the top take it from D and leave their result there; the top is
+        spilled to RAM at labels, jumps, calls, returns and the end of the
+        output, so every jump target sees the stack entirely in RAM.
+        Takes the same arguments as CodeWriter.
+        """
+        super().__init__(*args, **kwargs)
+        self.cached = False     # The top of the stack is in D, not in RAM
+        self.spill_count = 0    # Cached tops stored to RAM
+        self.fill_count = 0     # Tops loaded from RAM into D
+
+    def _spill(self):
+        """Stores a cached top of the stack to RAM."""
+        if self.cached:
+            self.cached = False
+            self.spill_count += 1
+            self._write_template(('spill',), lambda label_id: [
+                '@SP',
+                'AM=M+1',       # SP++
+                'A=A-1',
+                'M=D'           # *(SP - 1) = D
+            ])
+
+    def _write_top(self, key, build, label_id=None):
+        """
+        Writes a command that takes the top of the stack in D and leaves
+        its result there, first loading the top from RAM if it is not
+        cached. build is as for _write_template and returns a comment
+        followed by the command's assembly.
+        """
+        filled = not self.cached
+        if filled:
+            self.fill_count += 1
+
+        def build_code(label_id):
+            comment, *assembly_code = build(label_id)
+            if filled:
+                assembly_code = ['@SP', 'AM=M-1', 'D=M'] + assembly_code
+            return [comment, *assembly_code]
+
+        self._write_template(('top',) + key + (filled,), build_code,
+                             label_id)
+        self.cached = True
+
+    def _load_code(self, segment, index):
+        """Returns the assembly that loads segment[index] into D."""
+        if segment == 'constant':
+            return self._constant_to_d(index)
+        if segment == 'static':
+            return [f'@{self.file_name}.{index}', 'D=M']
+        if segment == 'pointer':
+            return [f'@{3 + index}', 'D=M']
+        if segment == 'temp':
+            return [f'@{5 + index}', 'D=M']
+        if segment == 'stack':
+            # The top is spilled, so SP is the SP the offset refers to
+            if index <= self.STACK_SLOT_CHAIN_LIMIT:
+                return [*self._stack_slot_address(index), 'D=M']
+            return [f'@{index}', 'D=A', '@SP', 'A=M-D', 'D=M']
+        base_reg = self.segment_registers.get(segment)
+        if base_reg is None:
+            raise ValueError(f'Unsupported segment for push: {segment}')
+        if self.opt_level >= 1 and index <= self.SMALL_PUSH_INDEX_LIMIT:
+            return [*self._small_index_address(base_reg, index), 'D=M']
+        return [f'@{index}', 'D=A', f'@{base_reg}', 'A=D+M', 'D=M']
+
+    def _store_code(self, segment, index):
+        """
+        Returns the assembly that stores D to the target of 'pop segment
+        index', or None if the top has to be spilled for the pop.
+        """
+        if segment == 'static':
+            return [f'@{self.file_name}.{index}', 'M=D']
+        if segment == 'pointer':
+            return [f'@{3 + index}', 'M=D']
+        if segment == 'temp':
+            return [f'@{5 + index}', 'M=D']
+        if segment == 'stack':
+            # SP already is the SP after the pop
+            if 1 <= index <= self.STACK_SLOT_CHAIN_LIMIT:
+                return [*self._stack_slot_address(index), 'M=D']
+            return None
+        base_reg = self.segment_registers.get(segment)
+        if base_reg is None:
+            return None
+        if self.opt_level >= 1 and index <= self.SMALL_POP_INDEX_LIMIT:
+            return [*self._small_index_address(base_reg, index), 'M=D']
+        return [
+            '@R13',
+            'M=D',              # R13 = value
+            f'@{index}',
+            'D=A',
+            f'@{base_reg}',
+            'D=D+M',
+            '@R14',
+            'M=D',              # R14 = base + index
+            '@R13',
+            'D=M',
+            '@R14',
+            'A=M',
+            'M=D'
+        ]
+
+    def write_push_pop(self, command, segment, index):
+        """
+        Writes C_PUSH as a load into D, after spilling the previous top, and
+        C_POP of a cached top as a store from D.
+        """
+        static_key = self._static_key(segment)
+        if command == CommandType.C_PUSH:
+            self._spill()
+            self._write_template(
+                ('load', segment, index, static_key),
+                lambda label_id: [f'// push {segment} {index}',
+                                  *self._load_code(segment, index)])
+            self.cached = True
+            return
+
+        store_code = self._store_code(segment, index)
+        if not self.cached or store_code is None:
+            self._spill()
+            super().write_push_pop(command, segment, index)
+            return
+        self._write_template(
+            ('store', segment, index, static_key),
+            lambda label_id: [f'// pop {segment} {index}', *store_code])
+        self.cached = False
+
+    def write_arithmetic(self, command):
+        """Writes an arithmetic command on the top of the stack in D."""
+        if command in self.COMPARISON_JUMPS:
+            if self.shared_compares:
+                self._spill()
+                super().write_arithmetic(command)
+                return
+            self._write_top(
+                ('arithmetic', command),
+                lambda label_id: [
+                    f'// {command}',
+                    '@SP',
+                    'AM=M-1',
+                    'D=M-D',            # D = x - y
+                    *self._compare_code(self.COMPARISON_JUMPS[command],
+                                        label_id, to_d=True)],
+                self._next_label_id())
+        elif command in self.UNARY_OPERATIONS_TO_D:
+            self._write_top(
+                ('arithmetic', command),
+                lambda label_id: [f'// {command}',
+                                  self.UNARY_OPERATIONS_TO_D[command]])
+        else:
+            self._write_top(
+                ('arithmetic', command),
+                lambda label_id: [f'// {command}',
+                                  '@SP',
+                                  'AM=M-1',     # Pop x
+                                  self.BINARY_OPERATIONS_TO_D[command]])
+
+    def write_arithmetic_constant(self, command, value):
+        """
+        Writes a binary arithmetic command with a constant operand y on the
+        top of the stack in D.
+        """
+        label_id = None
+        if command in self.COMPARISON_JUMPS:
+            if self.shared_compares:
+                self._spill()
+                super().write_arithmetic_constant(command, value)
+                return
+            label_id = self._next_label_id()
+        self._write_top(
+            ('arithmetic_constant', command, value),
+            lambda label_id: self._arithmetic_constant_code(
+                command, value, label_id, to_d=True),
+            label_id)
+
+    def write_pop_constant(self, segment, index, value):
+        """Writes a direct store, which may take D, with the top spilled."""
+        self._spill()
+        super().write_pop_constant(segment, index, value)
+
+    def write_label(self, symbol):
+        """Writes a label, where the stack must be entirely in RAM."""
+        self._spill()
+        super().write_label(symbol)
+
+    def write_if(self, label):
+        """Writes an if-goto that tests a cached top directly."""
+        if not self.cached:
+            super().write_if(label)
+            return
+        self._write([
+            f'// if-goto {label}',
+            f'@{label}',
+            'D;JNE'
+        ])
+        self.cached = False
+
+    def write_fused_if(self, jump_mnemonic, label, constant=None):
+        """Writes a fused branch that tests a cached top directly."""
+        if not self.cached:
+            super().write_fused_if(jump_mnemonic, label, constant)
+            return
+        if jump_mnemonic is None:
+            assembly_code = [
+                f'// not + if-goto {label}',
+                'D=D+1',        # D = x + 1, zero only if x == -1
+                f'@{label}',
+                'D;JNE'
+            ]
+        elif constant is not None:
+            assembly_code = [
+                f'// {jump_mnemonic.lower()} {constant} + if-goto {label}',
+                *self._subtract_constant_from_d(constant),
+                f'@{label}',
+                f'D;{jump_mnemonic}'
+            ]
+        else:
+            assembly_code = [
+                f'// {jump_mnemonic.lower()} + if-goto {label}',
+                '@SP',
+                'AM=M-1',
+                'D=M-D',        # D = x - y
+                f'@{label}',
+                f'D;{jump_mnemonic}'
+            ]
+        self._write(assembly_code)
+        self.cached = False
+
+    def write_goto(self, label):
+        """Writes a goto with the stack entirely in RAM."""
+        self._spill()
+        super().write_goto(label)
+
+    def write_function(self, function_name, n_vars):
+        """Writes a function entry, a label."""
+        self._spill()
+        super().write_function(function_name, n_vars)
+
+    def write_call(self, function_name, n_args):
+        """Writes a call with the arguments in RAM."""
+        self._spill()
+        super().write_call(function_name, n_args)
+
+    def write_tail_call(self, function_name, n_args):
+        """Writes a tail call with the arguments in RAM."""
+        self._spill()
+        super().write_tail_call(function_name, n_args)
+
+    def write_return(self):
+        """Writes a return with the return value in RAM."""
+        self._spill()
+        super().write_return()
+
+    def write_inline_return(self, depth):
+        """
+        Writes the end of an inlined body. A cached return value stays in
+        D: only SP moves down to the callee's frame base.
+        """
+        if not self.cached or depth - 1 > self.STACK_SLOT_CHAIN_LIMIT:
+            self._spill()
+            super().write_inline_return(depth)
+        elif depth > 1:
+            self._write_template(
+                ('top_inline_return', depth),
+                lambda label_id: [f'// inline return {depth}',
+                                  '@SP',
+                                  *['M=M-1'] * (depth - 1)])
+
+    def write_shared_routines(self):
+        """Writes the shared routines after spilling the last top."""
+        self._spill()
+        super().write_shared_routines()
+
+    def stats(self):
+        """Returns the CodeWriter counters plus the spills and fills."""
+        stats = super().stats()
+        stats['spill_count'] = self.spill_count
+        stats['fill_count'] = self.fill_count
+        return stats
+
+    def write_fragment(self, assembly_text, stats):
+        """Appends a fragment written by another StackCachingCodeWriter."""
+        super().write_fragment(assembly_text, stats)
+        self.spill_count += stats['spill_count']
+        self.fill_count += stats['fill_count']
+
+    def flush(self):
+        """
+        Spills a cached top, so that the output written so far is complete,
+        and writes out the held back instructions.
+        """
+        self._spill()
+        super().flush()
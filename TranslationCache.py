@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+
+
+# Modules next to the translator's that cannot shape its output
+NON_TRANSLATOR_MODULES = {'Benchmark.py'}
+
+
+def is_translator_module(module):
+    """Returns whether a file name is a module of the translator."""
+    return (module.endswith('.py') and not module.startswith('test_') and
+            module not in NON_TRANSLATOR_MODULES)
+
+
+def translator_version():
+    """
+    Returns a hash of every module of the translator, so cached fragments
+    are invalidated whenever any code that may shape the output changes,
+    including modules added later. Tests and the benchmark are left out.
+    """
+    digest = hashlib.sha256()
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    for module in sorted(os.listdir(module_dir)):
+        if not is_translator_module(module):
+            continue
+        digest.update(module.encode() + b'\0')
+        with open(os.path.join(module_dir, module), 'rb') as file:
+            digest.update(file.read())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class TranslationCache:
+    def __init__(self, cache_dir, max_bytes=64 * 1024 * 1024):
+        """
+        Opens (and creates if needed) an on-disk cache of per-file
+        translated assembly, evicting the least recently used entries once
+        the cache grows beyond max_bytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.version = translator_version()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, file_name, source, options):
+        """
+        Returns the cache key of a file's translation: a hash of its name
+        (which prefixes its static symbols and labels), its source (the .vm
+        text, or the command list after whole-program passes), the
+        translator version and the code generation options.
+        """
+        digest = hashlib.sha256()
+        for part in (self.version, file_name,
+                     json.dumps(options, sort_keys=True), source):
+            digest.update(part.encode() if isinstance(part, str) else part)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        """Returns the cached (assembly, stats, folding_hits), or None."""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r') as file:
+                entry = json.load(file)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path)     # Mark as recently used
+        self.hits += 1
+        return entry['assembly'], entry['stats'], entry['folding_hits']
+
+    def put(self, key, fragment):
+        """Stores a translated (assembly, stats, folding_hits) fragment."""
+        assembly, stats, folding_hits = fragment
+        path = self._entry_path(key)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'assembly': assembly, 'stats': stats,
+                       'folding_hits': folding_hits}, file)
+        os.replace(temp_path, path)
+
+    def evict(self):
+        """Deletes the least recently used entries beyond max_bytes."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
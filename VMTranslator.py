@@ -1,26 +1,636 @@
+import argparse
+import cProfile
+import contextlib
+import io
+import itertools
+import json
+import pstats
 import sys
 import os
-from Parser import Parser, CommandType
+import time
+from concurrent.futures import ProcessPoolExecutor
+from Parser import Parser, CommandType, SourceCommand
 from CodeWriter import CodeWriter
+from StackCache import StackCachingCodeWriter
+from Optimizer import ConstantFolder
+from CallGraph import eliminate_dead_functions
+from Deduplicator import deduplicate_functions
+from Inliner import DEFAULT_MAX_SIZE, inline_functions
+from TranslationCache import TranslationCache
+from Profiler import PROGRAM, TimedCodeWriter, TranslationProfiler
+from ProfileGuided import (DEFAULT_COVERAGE, count_cold_calls,
+                           hot_call_sites, hot_functions, load_profile)
+from SourceMap import SourceMapWriter
+from HackAssembler import HackWriter
 
 
-def main():
-    if len(sys.argv) < 2:
-        print('Usage: python VMTranslator.py <path_to_file_or_directory>')
-        sys.exit(1)
+# Jump condition of 'x <cmp> y' and of its negation, per comparison command
+COMPARISON_JUMPS = {
+    'eq': ('JEQ', 'JNE'),
+    'lt': ('JLT', 'JGE'),
+    'gt': ('JGT', 'JLE'),
+}
+
+
+def arithmetic_at(commands, k):
+    """Returns the arithmetic command at index k of commands, or None."""
+    if k < len(commands) and commands[k][0] == CommandType.C_ARITHMETIC:
+        return commands[k][1]
+    return None
+
+
+def if_label_at(commands, k):
+    """Returns the label of the if-goto at index k of commands, or None."""
+    if k < len(commands) and commands[k][0] == CommandType.C_IF:
+        return commands[k][1]
+    return None
+
+
+def match_fused_branch(commands, i):
+    """
+    Checks whether the commands starting at index i form a branch that can
+    be fused into one conditional jump: 'eq/lt/gt [not] if-goto L' or
+    'not if-goto L', where the comparison may have a constant operand.
+    Returns (command_count, jump, label, constant), where jump is None for
+    a bare 'not', or None if there is no match.
+    """
+    constant = None
+    if commands[i][0] == CommandType.C_ARITHMETIC_CONSTANT:
+        constant = commands[i][2]
+        command = commands[i][1]
+    else:
+        command = arithmetic_at(commands, i)
+    if command in COMPARISON_JUMPS:
+        label = if_label_at(commands, i + 1)
+        if label is not None:
+            return 2, COMPARISON_JUMPS[command][0], label, constant
+        label = if_label_at(commands, i + 2)
+        if arithmetic_at(commands, i + 1) == 'not' and label is not None:
+            return 3, COMPARISON_JUMPS[command][1], label, constant
+    elif command == 'not':
+        label = if_label_at(commands, i + 1)
+        if label is not None:
+            return 2, None, label, None
+    return None
+
+
+# CodeWriter call for each command type, given (code_writer, arg1, arg2)
+COMMAND_WRITERS = {
+    CommandType.C_ARITHMETIC:
+        lambda writer, arg1, arg2: writer.write_arithmetic(arg1),
+    CommandType.C_PUSH:
+        lambda writer, arg1, arg2: writer.write_push_pop(
+            CommandType.C_PUSH, arg1, arg2),
+    CommandType.C_POP:
+        lambda writer, arg1, arg2: writer.write_push_pop(
+            CommandType.C_POP, arg1, arg2),
+    CommandType.C_LABEL:
+        lambda writer, arg1, arg2: writer.write_label(arg1),
+    CommandType.C_IF:
+        lambda writer, arg1, arg2: writer.write_if(arg1),
+    CommandType.C_GOTO:
+        lambda writer, arg1, arg2: writer.write_goto(arg1),
+    CommandType.C_FUNCTION:
+        lambda writer, arg1, arg2: writer.write_function(arg1, arg2),
+    CommandType.C_RETURN:
+        lambda writer, arg1, arg2: writer.write_return(),
+    CommandType.C_CALL:
+        lambda writer, arg1, arg2: writer.write_call(arg1, arg2),
+    CommandType.C_ARITHMETIC_CONSTANT:
+        lambda writer, arg1, arg2: writer.write_arithmetic_constant(
+            arg1, arg2),
+    CommandType.C_POP_CONSTANT:
+        lambda writer, arg1, arg2: writer.write_pop_constant(arg1, *arg2),
+    CommandType.C_INLINE_RETURN:
+        lambda writer, arg1, arg2: writer.write_inline_return(arg2),
+}
+
+# Longest command sequence match_fused_branch can fuse
+FUSED_BRANCH_LENGTH = 3
+
+
+def write_commands(code_writer, commands, fuse_branches=False,
+                   tail_calls=False):
+    """
+    Writes an iterable of (command_type, arg1, arg2) commands with the given
+    CodeWriter, looking at most FUSED_BRANCH_LENGTH commands ahead. With
+    fuse_branches, comparisons that feed an if-goto are written as a single
+    conditional jump. With tail_calls, a call directly followed by a return
+    is written as a tail call. In source_map mode, the code of each
+    SourceCommand is marked with its location.
+    """
+    source_map = code_writer.source_map
+    commands = iter(commands)
+    window = list(itertools.islice(commands, FUSED_BRANCH_LENGTH))
+    while window:
+        if source_map and isinstance(window[0], SourceCommand):
+            code_writer.write_source(window[0])
+        command_count = 1
+        fused = match_fused_branch(window, 0) if fuse_branches else None
+        if fused is not None:
+            command_count, jump, label, constant = fused
+            code_writer.write_fused_if(jump, label, constant)
+        elif (tail_calls and len(window) > 1 and
+              window[0][0] == CommandType.C_CALL and
+              window[1][0] == CommandType.C_RETURN):
+            command_count = 2
+            code_writer.write_tail_call(window[0][1], window[0][2])
+        else:
+            command = window[0]
+            COMMAND_WRITERS[command[0]](code_writer, command[1], command[2])
+
+        del window[:command_count]
+        window.extend(itertools.islice(commands, command_count))
+
+
+# Smallest local count that -Os zeroes in a loop: from 2 locals on, the
+# loop takes fewer ROM words than the unrolled pushes
+SIZE_LOCAL_INIT_LOOP = 2
+
+# Options that change the assembly a file translates to
+CODEGEN_OPTIONS = ('shared_calls', 'peephole', 'opt_level', 'fold_constants',
+                   'fuse_branches', 'tail_calls', 'shared_compares',
+                   'local_init_loop', 'stack_cache', 'hot_functions',
+                   'comments', 'source_map')
+
+
+# Compiled CodeWriter templates per set of code generation options, shared
+# by all CodeWriters of a long-running process; None gives each CodeWriter
+# its own templates
+shared_templates = None
+
+# Most shared templates kept: template keys include function, file and
+# constant names, so a long run over varied programs would otherwise grow
+# without bound
+MAX_SHARED_TEMPLATES = 20000
+
+
+def new_code_writer(output_file_path, args):
+    """Creates a CodeWriter with the code generation options in args."""
+    templates = None
+    if shared_templates is not None:
+        if sum(map(len, shared_templates.values())) > MAX_SHARED_TEMPLATES:
+            # Start over; the templates in use recompile on first use
+            shared_templates.clear()
+        options = json.dumps([getattr(args, name) for name in CODEGEN_OPTIONS])
+        templates = shared_templates.setdefault(options, {})
+    writer_class = (StackCachingCodeWriter if args.stack_cache
+                    else CodeWriter)
+    return writer_class(output_file_path,
+                        shared_calls=args.shared_calls,
+                        peephole=args.peephole,
+                        opt_level=args.opt_level,
+                        comments=args.comments,
+                        source_map=args.source_map,
+                        shared_compares=args.shared_compares,
+                        local_init_loop=args.local_init_loop,
+                        hot_functions=(None if args.hot_functions is None
+                                       else set(args.hot_functions)),
+                        templates=templates)
+
+
+def translate_file(code_writer, job):
+    """
+    Translates the .vm file of a job, given as for translate_fragment,
+    with the given CodeWriter and returns the constant folding hits.
+    """
+    file_name, vm_file_path, commands, args = job
+    if commands is None:
+        parser = Parser(vm_file_path, streaming=True)
+        commands = (parser.source_commands() if args.source_map
+                    else parser.commands())
+
+    # Set the filename for the static segment
+    code_writer.set_file_name(file_name)
+    constant_folder = ConstantFolder()
+    if args.fold_constants:
+        commands = constant_folder.optimize(commands)
+    write_commands(code_writer, commands, fuse_branches=args.fuse_branches,
+                   tail_calls=args.tail_calls)
+    code_writer.flush()
+    return constant_folder.hits
+
+
+def translate_fragment(job):
+    """
+    Translates one .vm file on its own, so that it can run in a worker
+    process. job is (file_name, vm_file_path, commands, args); commands is
+    None when the file still has to be parsed. Returns the assembly text,
+    the CodeWriter stats and the constant folding hits.
+    """
+    buffer = io.StringIO()
+    code_writer = new_code_writer(buffer, job[3])
+    folding_hits = translate_file(code_writer, job)
+    return buffer.getvalue(), code_writer.stats(), folding_hits
+
+
+def parse_file(file_name, vm_file_path, profiler=None, source_map=False,
+               interned=None):
+    """
+    Parses a .vm file into a list of commands, SourceCommands with
+    source_map. With a TranslationProfiler, reading and tokenizing are
+    timed separately (together for SourceCommands, which are read lazily)
+    and the commands counted. Files parsed with the same interned dict
+    share their equal Commands, see Parser.commands.
+    """
+    if profiler is None:
+        parser = Parser(vm_file_path, streaming=True)
+        return list(parser.source_commands() if source_map
+                    else parser.commands(interned))
+    if source_map:
+        with profiler.stage(file_name, 'tokenize'):
+            commands = list(
+                Parser(vm_file_path, streaming=True).source_commands())
+    else:
+        with profiler.stage(file_name, 'read'):
+            parser = Parser(vm_file_path)
+        with profiler.stage(file_name, 'tokenize'):
+            commands = list(parser.commands(interned))
+    profiler.count_commands(file_name, commands)
+    return commands
+
+
+def translate_fragment_profiled(job, profiler):
+    """
+    Like translate_fragment, but runs one stage at a time so that the
+    TranslationProfiler can time each: dispatch is the time spent in
+    write_commands outside of the CodeWriter's write_* methods (emit).
+    """
+    file_name, vm_file_path, commands, args = job
+    if commands is None:
+        commands = parse_file(file_name, vm_file_path, profiler,
+                              args.source_map)
+
+    constant_folder = ConstantFolder()
+    if args.fold_constants:
+        with profiler.stage(file_name, 'optimize'):
+            commands = list(constant_folder.optimize(commands))
+
+    buffer = io.StringIO()
+    code_writer = new_code_writer(buffer, args)
+    code_writer.set_file_name(file_name)
+    stages = profiler.file_metrics(file_name)['stages']
+    emit_seconds = stages['emit']
+    start = time.perf_counter()
+    write_commands(TimedCodeWriter(code_writer, stages), commands,
+                   fuse_branches=args.fuse_branches,
+                   tail_calls=args.tail_calls)
+    stages['dispatch'] += (time.perf_counter() - start -
+                           (stages['emit'] - emit_seconds))
+    with profiler.stage(file_name, 'emit'):
+        code_writer.flush()
+
+    assembly_text = buffer.getvalue()
+    stats = code_writer.stats()
+    profiler.count_instructions(file_name, stats['instruction_count'],
+                                assembly_text)
+    return assembly_text, stats, constant_folder.hits
+
+
+def translate_fragments(jobs, n_jobs):
+    """
+    Translates the given jobs, in a process pool when n_jobs > 1. The
+    results keep the order of jobs regardless of the number of workers.
+    """
+    if n_jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            return list(pool.map(translate_fragment, jobs))
+    return [translate_fragment(job) for job in jobs]
+
+
+def translate_cached(jobs, n_jobs, cache):
+    """
+    Like translate_fragments, but reuses the fragments found in the given
+    TranslationCache and stores the newly translated ones.
+    """
+    if cache is None:
+        return translate_fragments(jobs, n_jobs)
+
+    keys = []
+    for file_name, vm_file_path, commands, args in jobs:
+        if commands is None:
+            with open(vm_file_path, 'rb') as file:
+                source = file.read()
+        else:
+            # Whole-program passes rewrote the file's commands
+            source = repr(commands)
+        options = {name: getattr(args, name) for name in CODEGEN_OPTIONS}
+        keys.append(cache.key(file_name, source, options))
+
+    fragments = [cache.get(key) for key in keys]
+    missing = [i for i, fragment in enumerate(fragments) if fragment is None]
+    translated = translate_fragments([jobs[i] for i in missing], n_jobs)
+    for i, fragment in zip(missing, translated):
+        fragments[i] = fragment
+        cache.put(keys[i], fragment)
+    cache.evict()
+    return fragments
 
-    input_path = sys.argv[1]
-    files_to_translate = []
 
+def write_program(code_writer, jobs, has_sys, n_jobs=1, cache=None,
+                  profiler=None, fragments=None):
+    """
+    Writes a whole program with the given CodeWriter: the bootstrap, the
+    translation of each job and the shared routines. Returns the
+    ConstantFolder holding the combined folding hits. With a
+    TranslationProfiler, the files are translated one by one in this
+    process, bypassing n_jobs and the cache, so every stage is measured.
+    fragments may give the translations of the jobs, as returned by
+    translate_fragment, to link them without translating again.
+    """
+    # The bootstrap and the shared routines are written by program_writer
+    program_writer = code_writer
+    # Translated serially and without a cache, each file is written
+    # straight through code_writer instead of into a fragment first
+    direct = (fragments is None and profiler is None and cache is None and
+              (n_jobs <= 1 or len(jobs) <= 1))
+    if direct:
+        fragments = ()
+    elif fragments is None and profiler is None:
+        fragments = translate_cached(jobs, n_jobs, cache)
+    elif fragments is None:
+        fragments = (translate_fragment_profiled(job, profiler)
+                     for job in jobs)
+        program_writer = TimedCodeWriter(
+            code_writer, profiler.file_metrics(PROGRAM)['stages'])
+
+    # Always init SP for directories
+    program_writer.write_sp_init()
+    if has_sys:
+        program_writer.write_call('Sys.init', 0)
+
+    # Each file is translated into its own buffer and the buffers are
+    # concatenated in file order, so the output does not depend on jobs
+    constant_folder = ConstantFolder()
+    if direct:
+        for job in jobs:
+            for name, hits in translate_file(code_writer, job).items():
+                constant_folder.hits[name] += hits
+    for job, (assembly_text, stats, folding_hits) in zip(jobs, fragments):
+        if profiler is None:
+            code_writer.write_fragment(assembly_text, stats)
+        else:
+            with profiler.stage(job[0], 'write'):
+                code_writer.write_fragment(assembly_text, stats)
+            profiler.end_file(job[0])
+        for name, hits in folding_hits.items():
+            constant_folder.hits[name] += hits
+
+    program_writer.write_shared_routines()
+    return constant_folder
+
+
+def count_rom_words(programs, args):
+    """Returns the number of ROM words the given programs translate to."""
+    fragments = translate_fragments(
+        [(file_name, None, commands, args)
+         for file_name, commands in programs], 1)
+    return sum(stats['instruction_count'] for _, stats, _ in fragments)
+
+
+def shared_compare_savings(programs, has_sys, args):
+    """
+    Returns the ROM words that shared comparison routines save on the
+    given programs, by translating them with and without: what an inline
+    comparison costs depends on the code around it, the stack cache in
+    particular, so it is counted rather than estimated. The peephole
+    optimizer is left out of both translations.
+    """
+    if not any(command.command_type == CommandType.C_ARITHMETIC and
+               command.arg1 in CodeWriter.COMPARISON_JUMPS
+               for _, commands in programs for command in commands):
+        return 0
+    rom_words = []
+    for shared_compares in (True, False):
+        trial_args = argparse.Namespace(**vars(args))
+        trial_args.shared_compares = shared_compares
+        trial_args.peephole = False
+        trial_args.comments = False
+        trial_args.source_map = False
+        with open(os.devnull, 'w') as output_file:
+            code_writer = new_code_writer(output_file, trial_args)
+            write_program(code_writer,
+                          [(file_name, None, commands, trial_args)
+                           for file_name, commands in programs], has_sys)
+            code_writer.flush()
+        rom_words.append(code_writer.instruction_count)
+    return rom_words[1] - rom_words[0]
+
+
+# Extension of the output file of each output format
+OUTPUT_EXTENSIONS = {'asm': '.asm', 'hack': '.hack', 'bin': '.bin'}
+
+
+def open_output(output_path, output_format):
+    """
+    Opens the output file of the given format as a text stream for the
+    CodeWriter. For 'hack' and 'bin', a HackWriter assembles the stream in
+    memory, so no .asm text has to be written and parsed again.
+    """
+    if output_format == 'asm':
+        return open(output_path, 'w')
+    if output_format == 'hack':
+        return HackWriter(open(output_path, 'w'))
+    return HackWriter(open(output_path, 'wb'), binary=True)
+
+
+@contextlib.contextmanager
+def program_output(output_path, output_format):
+    """
+    Opens the output file as open_output does, for a with block. If the
+    block raises, the file is closed without writing what is still
+    buffered and removed, so a failed translation leaves no partial output
+    that could pass for a result.
+    """
+    output_file = open_output(output_path, output_format)
+    try:
+        yield output_file
+    except BaseException:
+        if isinstance(output_file, HackWriter):
+            output_file = output_file.output_file
+        output_file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(output_path)
+        raise
+
+
+def split_translator_args(argv):
+    """
+    Splits the command-line arguments of a tool that runs the translator
+    at the first '--' into the tool's own and those passed on to the
+    translator. Returns (argv, translator_args).
+    """
+    if '--' not in argv:
+        return argv, []
+    index = argv.index('--')
+    return argv[:index], argv[index + 1:]
+
+
+def parse_args(argv):
+    """
+    Parses the command-line arguments. An optimization level of 1 turns on
+    small-index addressing together with branch fusion, constant folding
+    and the peephole pass.
+    """
+    arg_parser = argparse.ArgumentParser(
+        description='Translates Hack VM code into Hack assembly.')
+    arg_parser.add_argument(
+        'input_path', help='path to a .vm file or a directory of .vm files')
+    arg_parser.add_argument(
+        '-O', '--opt-level', choices=['0', '1', '2', 's'], default='0',
+        help='optimization level: 0 emits the plain translation, 1 adds '
+             'index-specialized addressing, branch fusion, constant '
+             'folding and peephole optimization, 2 (speed) adds inlining, '
+             'tail calls and the stack cache, s (size) adds tail calls, '
+             'the stack cache, local-initialization loops, dead-function '
+             'elimination, function deduplication, and shared calls and '
+             'comparisons where they save ROM. 2 and s hold the whole '
+             'program in memory, one Command per distinct line')
+    arg_parser.add_argument(
+        '--shared-calls', action='store_true',
+        help='route call/return through shared $CALL/$RETURN subroutines '
+             'to reduce ROM size')
+    arg_parser.add_argument(
+        '--peephole', action='store_true',
+        help='run a peephole optimization pass over the emitted assembly')
+    arg_parser.add_argument(
+        '--fuse-branches', action='store_true',
+        help='fuse eq/lt/gt/not followed by if-goto into one conditional '
+             'jump')
+    arg_parser.add_argument(
+        '--fold-constants', action='store_true',
+        help='fold constant arithmetic and lower push-constant sequences '
+             'to superinstructions before code generation')
+    arg_parser.add_argument(
+        '--tail-calls', action='store_true',
+        help='translate a call directly followed by return as a tail call '
+             'that reuses the current frame, so that tail recursion runs '
+             'in constant stack space')
+    arg_parser.add_argument(
+        '--shared-compares', action='store_true',
+        help='route eq/lt/gt through shared $COMPARE_ subroutines to '
+             'reduce ROM size')
+    arg_parser.add_argument(
+        '--local-init-loop', type=int, metavar='N',
+        help='zero the locals of functions with at least N locals in a '
+             'loop instead of unrolling (default with -Os: '
+             f'{SIZE_LOCAL_INIT_LOOP})')
+    arg_parser.add_argument(
+        '--stack-cache', action='store_true',
+        help='keep the top of the stack in D within basic blocks and '
+             'store it to RAM only at labels, jumps, calls and returns')
+    arg_parser.add_argument(
+        '--no-comments', dest='comments', action='store_false',
+        help='omit // comments from the emitted assembly')
+    arg_parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='number of worker processes translating files in parallel')
+    arg_parser.add_argument(
+        '--cache', action='store_true',
+        help='reuse per-file translations from an on-disk cache')
+    arg_parser.add_argument(
+        '--cache-dir',
+        help='cache directory (default: .vmcache next to the output file)')
+    arg_parser.add_argument(
+        '--cache-size', type=int, default=64,
+        help='maximum cache size in MiB before old entries are evicted')
+    arg_parser.add_argument(
+        '--eliminate-dead-functions', action='store_true',
+        help='translate only the functions reachable from Sys.init (or '
+             'from the entry of a single-file program)')
+    arg_parser.add_argument(
+        '--deduplicate-functions', action='store_true',
+        help='write identical function bodies once and make the names of '
+             'the duplicates labels of the copy that is kept')
+    arg_parser.add_argument(
+        '--inline', action='store_true',
+        help='inline the calls to small leaf functions')
+    arg_parser.add_argument(
+        '--inline-size', type=int, default=DEFAULT_MAX_SIZE,
+        help='largest function body, in VM commands, that --inline '
+             'inlines (default: %(default)s)')
+    arg_parser.add_argument(
+        '--profile-use', metavar='PATH',
+        help='optimize with a profile written by ProfileGuided.py: the hot '
+             'functions that cover most cycles get -O2 code and inline '
+             'their executed call sites, the others get -Os code')
+    arg_parser.add_argument(
+        '--profile-coverage', type=float, default=DEFAULT_COVERAGE,
+        help='share of the profiled cycles the hot functions cover '
+             '(default: %(default)s)')
+    arg_parser.add_argument(
+        '--output-format', choices=sorted(OUTPUT_EXTENSIONS), default='asm',
+        help='write Hack assembly (asm), or assemble in memory and write '
+             'Hack machine code as text (hack) or as packed big-endian '
+             '16-bit words (bin)')
+    arg_parser.add_argument(
+        '--source-map', action='store_true',
+        help='write a .map.json file next to the output that maps every '
+             'instruction to its .vm file, line, function and command')
+    arg_parser.add_argument(
+        '--profile', action='store_true',
+        help='time the read, tokenize, optimize, dispatch, emit and write '
+             'stages per file and report command and instruction counts; '
+             'files are translated serially and without the cache')
+    arg_parser.add_argument(
+        '--profile-output', metavar='PATH',
+        help='with --profile, also write the metrics to a JSON file')
+    arg_parser.add_argument(
+        '--cprofile', nargs='?', const='', metavar='PATH',
+        help='run the translation under cProfile and print the top '
+             'functions, or save the raw stats to PATH')
+    # Set by main from the --profile-use profile
+    arg_parser.set_defaults(hot_functions=None, hot_call_sites=None)
+    # Whether -Os decides on shared calls and comparisons per program
+    arg_parser.set_defaults(size_shared_calls=False,
+                            size_shared_compares=False)
+    args = arg_parser.parse_args(argv)
+    optimize_size = args.opt_level == 's'
+    args.opt_level = 1 if optimize_size else int(args.opt_level)
+    if args.profile_use:
+        # Hot code is optimized for speed, the rest for size
+        args.opt_level = max(args.opt_level, 2)
+        optimize_size = True
+    if args.opt_level >= 2:
+        args.inline = True
+        args.tail_calls = True
+        args.stack_cache = True
+    if optimize_size:
+        # Shared routines are kept only where they save ROM, see
+        # run_whole_program_passes, unless asked for explicitly
+        args.size_shared_calls = not args.shared_calls
+        args.size_shared_compares = not args.shared_compares
+        args.tail_calls = True
+        args.stack_cache = True
+        args.shared_calls = True
+        args.shared_compares = True
+        args.deduplicate_functions = True
+        args.eliminate_dead_functions = True
+        if args.local_init_loop is None:
+            args.local_init_loop = SIZE_LOCAL_INIT_LOOP
+    if args.opt_level >= 1:
+        args.fuse_branches = True
+        args.fold_constants = True
+        args.peephole = True
+    return args
+
+
+def find_program_files(input_path, output_format):
+    """
+    Returns the output path and the .vm files of a program given as a .vm
+    file or a directory of .vm files. Raises ValueError for other paths.
+    """
+    extension = OUTPUT_EXTENSIONS[output_format]
+    files_to_translate = []
     if os.path.isdir(input_path):
         # Input is a directory
         # Sanitize path to remove any trailing slashes
         input_path = os.path.normpath(input_path)
         dir_name = os.path.basename(input_path)
-        output_path = os.path.join(input_path, dir_name + '.asm')
+        output_path = os.path.join(input_path, dir_name + extension)
 
-        # Find all .vm files in the directory
-        for file in os.listdir(input_path):
+        # Find all .vm files in the directory, in a stable order
+        for file in sorted(os.listdir(input_path)):
             if file.endswith('.vm'):
                 files_to_translate.append(os.path.join(input_path, file))
     elif os.path.isfile(input_path):
@@ -28,68 +638,255 @@ def main():
         if not input_path.endswith('.vm'):
             raise ValueError('Input file must be a .vm file.')
         base_name = os.path.splitext(input_path)[0]
-        output_path = base_name + '.asm'
+        output_path = base_name + extension
         files_to_translate.append(input_path)
     else:
+        raise ValueError(f'Input path \'{input_path}\' is not a valid file '
+                         'or directory.')
+    return output_path, files_to_translate
+
+
+def apply_profile(args):
+    """
+    Loads the --profile-use profile and sets the hot functions and call
+    sites in args.
+    """
+    profile = load_profile(args.profile_use)
+    args.hot_functions = sorted(hot_functions(profile, args.profile_coverage))
+    args.hot_call_sites = hot_call_sites(profile, args.hot_functions)
+
+
+def uses_whole_program(args):
+    """Returns whether args enable passes that need every file parsed."""
+    return (args.eliminate_dead_functions or args.inline or
+            args.deduplicate_functions)
+
+
+def run_whole_program_passes(programs, has_sys, args):
+    """
+    Runs inlining, dead-function elimination and function deduplication,
+    as enabled in args, over a program given as (file_name, commands)
+    pairs. Without dead-function elimination, the inlined functions that
+    are no longer called are still removed. With a profile, also decides
+    whether the cold code uses shared calls, and at -Os, whether shared
+    calls and comparisons are used at all. Returns (programs, inlined,
+    removed_functions, merged_functions).
+    """
+    inlined = {}
+    removed_functions = []
+    merged_functions = []
+    if args.inline:
+        programs, inlined = inline_functions(
+            programs, args.inline_size, sites=args.hot_call_sites)
+    if args.eliminate_dead_functions:
+        programs, removed_functions = eliminate_dead_functions(programs,
+                                                               has_sys)
+    elif inlined:
+        # The callees inlined at every call site are left unreachable
+        programs, removed_functions = eliminate_dead_functions(
+            programs, has_sys, candidates=inlined)
+    if args.deduplicate_functions:
+        programs, merged_functions = deduplicate_functions(
+            programs, args.hot_functions)
+    if args.profile_use or args.size_shared_calls:
+        # Shared call/return routines only pay off for enough cold calls
+        # and returns
+        calls, returns = count_cold_calls(programs,
+                                          args.hot_functions or (),
+                                          args.tail_calls)
+        args.shared_calls = new_code_writer(
+            io.StringIO(), args).shared_call_savings(
+                calls + has_sys, returns) > 0
+    if args.size_shared_compares:
+        args.shared_compares = shared_compare_savings(programs, has_sys,
+                                                      args) > 0
+    return programs, inlined, removed_functions, merged_functions
+
+
+def translate_program(files_to_translate, output_path, args, profiler=None):
+    """
+    Translates the .vm files of one program to output_path. Errors are
+    raised rather than reported, so that a caller translating many
+    programs can handle each one on its own. Returns a dict with what the
+    report needs: the CodeWriter, the ConstantFolder, the cache, the
+    inlined, removed and merged functions and the source map path.
+    """
+    start = time.perf_counter()
+
+    # Call Sys.init only if Sys.vm is present
+    has_sys = any(os.path.basename(vm_file).lower() == 'sys.vm'
+                  for vm_file in files_to_translate)
+
+    jobs = [(os.path.splitext(os.path.basename(vm_file_path))[0],
+             vm_file_path, None, args)
+            for vm_file_path in files_to_translate]
+
+    if args.profile_use:
+        apply_profile(args)
+
+    removed_functions = []
+    merged_functions = []
+    inlined = {}
+    if uses_whole_program(args):
+        # Parse every .vm file up front, so the whole-program passes can
+        # see all functions. The program is held as a whole, so its equal
+        # commands share one Command
+        interned = {}
+        programs = [(file_name,
+                     parse_file(file_name, vm_file_path, profiler,
+                                args.source_map, interned))
+                    for file_name, vm_file_path, _, _ in jobs]
+        del interned
+        (programs, inlined, removed_functions,
+         merged_functions) = run_whole_program_passes(programs, has_sys,
+                                                      args)
+        jobs = [(file_name, None, commands, args)
+                for file_name, commands in programs]
+
+    cache = None
+    if args.cache and profiler is None:
+        cache_dir = args.cache_dir or os.path.join(
+            os.path.dirname(output_path), '.vmcache')
+        cache = TranslationCache(cache_dir,
+                                 max_bytes=args.cache_size * 1024 * 1024)
+
+    # Create one CodeWriter for the single output file
+    with program_output(output_path, args.output_format) as output_file:
+        source_map_writer = None
+        if args.source_map:
+            source_map_writer = output_file = SourceMapWriter(output_file)
+        code_writer = new_code_writer(output_file, args)
+        constant_folder = write_program(code_writer, jobs, has_sys,
+                                        args.jobs, cache, profiler)
+        if profiler is None:
+            code_writer.close()
+        else:
+            with profiler.stage(PROGRAM, 'write'):
+                code_writer.close()
+            profiler.end_file(PROGRAM)
+            profiler.finish(time.perf_counter() - start)
+
+    source_map_path = None
+    if source_map_writer is not None:
+        source_map_path = os.path.splitext(output_path)[0] + '.map.json'
+        source_map_writer.save(source_map_path)
+    return {
+        'code_writer': code_writer,
+        'constant_folder': constant_folder,
+        'cache': cache,
+        'inlined': inlined,
+        'removed_functions': removed_functions,
+        'merged_functions': merged_functions,
+        'source_map_path': source_map_path,
+    }
+
+
+def main(argv=None, profiler=None):
+    """
+    Runs the translator with the given command-line arguments (default:
+    sys.argv). A TranslationProfiler passed in is filled in as with
+    --profile, so a build system can collect the metrics through its
+    hooks without parsing the printed report.
+    """
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.profile and profiler is None:
+        profiler = TranslationProfiler()
+    input_path = args.input_path
+
+    if not os.path.exists(input_path):
         print(
             f'Error: Input path \'{input_path}\' '
             'is not a valid file or directory.')
         sys.exit(1)
+    output_path, files_to_translate = find_program_files(
+        input_path, args.output_format)
 
     # --- Main Translation Process ---
     try:
-        # Create one CodeWriter for the single output file
-        code_writer = CodeWriter(output_path)
-
-        # Always init SP for directories
-        code_writer.write_sp_init()
+        cprofiler = None
+        if args.cprofile is not None:
+            cprofiler = cProfile.Profile()
+            cprofiler.enable()
 
-        # Call Sys.init only if Sys.vm is present
-        has_sys = any(os.path.basename(vm_file).lower() == 'sys.vm'
-                      for vm_file in files_to_translate)
-        if has_sys:
-            code_writer.write_call('Sys.init', 0)
+        result = translate_program(files_to_translate, output_path, args,
+                                   profiler)
+        code_writer = result['code_writer']
+        constant_folder = result['constant_folder']
+        cache = result['cache']
+        inlined = result['inlined']
+        removed_functions = result['removed_functions']
+        merged_functions = result['merged_functions']
+        source_map_path = result['source_map_path']
 
-        # Loop through each .vm file
-        for vm_file_path in files_to_translate:
-            base_name = os.path.splitext(os.path.basename(vm_file_path))[0]
-            # Set the filename for the static segment
-            code_writer.set_file_name(base_name)
-
-            parser = Parser(vm_file_path)
-            while parser.has_more_commands():
-                parser.advance()
-                cmd_type = parser.command_type()
-
-                if cmd_type == CommandType.C_ARITHMETIC:
-                    command = parser.arg1()
-                    code_writer.write_arithmetic(command)
-                elif cmd_type in [CommandType.C_PUSH, CommandType.C_POP]:
-                    segment = parser.arg1()
-                    index = parser.arg2()
-                    code_writer.write_push_pop(cmd_type, segment, index)
-                elif cmd_type == CommandType.C_LABEL:
-                    label = parser.arg1()
-                    code_writer.write_label(label)
-                elif cmd_type == CommandType.C_IF:
-                    label = parser.arg1()
-                    code_writer.write_if(label)
-                elif cmd_type == CommandType.C_GOTO:
-                    label = parser.arg1()
-                    code_writer.write_goto(label)
-                elif cmd_type == CommandType.C_FUNCTION:
-                    function_name = parser.arg1()
-                    n_vars = parser.arg2()
-                    code_writer.write_function(function_name, n_vars)
-                elif cmd_type == CommandType.C_RETURN:
-                    code_writer.write_return()
-                elif cmd_type == CommandType.C_CALL:
-                    function_name = parser.arg1()
-                    n_args = parser.arg2()
-                    code_writer.write_call(function_name, n_args)
-
-        code_writer.close()
+        if cprofiler is not None:
+            cprofiler.disable()
+            if args.cprofile:
+                cprofiler.dump_stats(args.cprofile)
+            else:
+                pstats.Stats(cprofiler).sort_stats('cumulative').print_stats(
+                    25)
         print(f'Translation finished.  Output written to {output_path}')
+        if source_map_path is not None:
+            print(f'Source map written to {source_map_path}')
+        if cache is not None:
+            print(f'Cache: {cache.hits} hits, {cache.misses} misses')
+        if args.shared_calls:
+            print(f'Shared calls: {code_writer.shared_call_count} call '
+                  f'sites, {code_writer.shared_return_count} returns, '
+                  f'{code_writer.shared_call_savings()} ROM words saved')
+        if args.tail_calls:
+            print(f'Tail calls: {code_writer.tail_call_count} call sites')
+        if args.stack_cache:
+            print(f'Stack cache: {code_writer.spill_count} spills, '
+                  f'{code_writer.fill_count} fills')
+        if args.shared_compares:
+            print(f'Shared compares: '
+                  f'{sum(code_writer.compare_counts.values())} comparisons, '
+                  f'{code_writer.shared_compare_savings()} ROM words saved')
+        if args.local_init_loop is not None:
+            words_saved, cycles = code_writer.init_loop_savings()
+            print(f'Local-initialization loops: '
+                  f'{code_writer.init_loop_count} functions, {words_saved} '
+                  f'ROM words saved, {cycles} more cycles if each is called '
+                  f'once')
+        if args.profile_use:
+            print(f'Profile-guided: {len(args.hot_functions)} hot '
+                  f'functions, {len(args.hot_call_sites)} hot call sites')
+            for function_name in args.hot_functions:
+                print(f'  hot {function_name}')
+        if args.peephole:
+            print(f'Peephole: {code_writer.peephole.report()}')
+        if args.fold_constants:
+            print(f'Constant folding: {constant_folder.report()}')
+        if args.inline:
+            print(f'Inlining: {sum(inlined.values())} call sites of '
+                  f'{len(inlined)} functions inlined')
+            for function_name, sites in sorted(inlined.items()):
+                print(f'  inlined {function_name} at {sites} call sites')
+        if args.eliminate_dead_functions or removed_functions:
+            saved_words = count_rom_words(
+                [(file_name, body)
+                 for file_name, _, body in removed_functions], args)
+            print(f'Dead-function elimination: removed '
+                  f'{len(removed_functions)} functions, '
+                  f'{saved_words} ROM words saved')
+            for file_name, function_name, _ in removed_functions:
+                print(f'  removed {function_name} ({file_name}.vm)')
+        if args.deduplicate_functions:
+            saved_words = count_rom_words(
+                [(file_name, body)
+                 for file_name, _, _, body in merged_functions], args)
+            print(f'Function deduplication: merged '
+                  f'{len(merged_functions)} functions, '
+                  f'{saved_words} ROM words saved')
+            for file_name, function_name, kept_name, _ in merged_functions:
+                print(f'  merged {function_name} ({file_name}.vm) into '
+                      f'{kept_name}')
+        if args.profile:
+            print('\n'.join(profiler.report()))
+            if args.profile_output:
+                with open(args.profile_output, 'w') as file:
+                    json.dump(profiler.metrics(), file, indent=2)
     except FileNotFoundError:
         print(f'Error: File not found at \'{input_path}\'')
         sys.exit(1)
@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import sys
+import time
+import VMTranslator
+from SourceMap import SourceMapWriter
+from VMTranslator import (CODEGEN_OPTIONS, apply_profile, find_program_files,
+                          new_code_writer, parse_args, parse_file,
+                          program_output, run_whole_program_passes,
+                          split_translator_args, translate_fragment,
+                          uses_whole_program, write_program)
+
+
+class ProgramWatcher:
+    def __init__(self, input_path, args):
+        """
+        Keeps the parsed commands and the translated fragment of each file
+        of a program in memory, so that after a change only the changed
+        files are parsed and translated again before the output is
+        relinked. input_path and args are as for VMTranslator.
+        """
+        self.input_path = input_path
+        self.args = args
+        self.files = {}     # .vm path -> (signature, file name, commands)
+        self.fragments = {}     # File name -> (options, commands, fragment)
+        self.output_path = None
+        if args.profile_use:
+            apply_profile(args)
+
+    @staticmethod
+    def _signature(path):
+        """Returns what changes when a file is modified."""
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self):
+        """
+        Checks the program's .vm files for additions, removals and
+        modifications. If any, parses the added and modified files,
+        translates the files whose commands changed and rewrites the
+        output. Returns the paths of the changed files. A file that fails
+        to parse raises ValueError once and blocks the output until it
+        changes again.
+        """
+        self.output_path, vm_paths = find_program_files(
+            self.input_path, self.args.output_format)
+        signatures = {path: self._signature(path) for path in vm_paths}
+        changed = [path for path in vm_paths
+                   if path not in self.files or
+                   self.files[path][0] != signatures[path]]
+        removed = [path for path in self.files if path not in signatures]
+        if not changed and not removed:
+            return []
+
+        for path in removed:
+            del self.files[path]
+        interned = {}
+        for path in changed:
+            file_name = os.path.splitext(os.path.basename(path))[0]
+            # Until the file parses, it has no commands
+            self.files[path] = (signatures[path], file_name, None)
+            try:
+                commands = parse_file(file_name, path,
+                                      source_map=self.args.source_map,
+                                      interned=interned)
+            except ValueError as e:
+                raise ValueError(f'{path}: {e}') from e
+            self.files[path] = (signatures[path], file_name, commands)
+        self._write(vm_paths)
+        return sorted(changed + removed)
+
+    def _write(self, vm_paths):
+        """
+        Translates the files whose commands changed and atomically
+        replaces the output with the relinked program.
+        """
+        args = self.args
+        broken = [path for path in vm_paths if self.files[path][2] is None]
+        if broken:
+            raise ValueError(f'{", ".join(broken)} did not translate')
+
+        # Sys.vm appearing or disappearing changes the bootstrap
+        has_sys = any(os.path.basename(path).lower() == 'sys.vm'
+                      for path in vm_paths)
+        programs = [self.files[path][1:] for path in vm_paths]
+        if uses_whole_program(args):
+            programs = run_whole_program_passes(programs, has_sys,
+                                                args)[0]
+        options = json.dumps([getattr(args, name)
+                              for name in CODEGEN_OPTIONS])
+
+        fragments = {}
+        for file_name, commands in programs:
+            cached = self.fragments.get(file_name)
+            if (cached is None or cached[0] != options or
+                    cached[1] != commands):
+                cached = (options, commands, translate_fragment(
+                    (file_name, None, commands, args)))
+            fragments[file_name] = cached
+        self.fragments = fragments
+
+        # Write next to the output and rename, so that readers never see
+        # a partial file
+        temp_path = self.output_path + '.tmp'
+        with program_output(temp_path, args.output_format) as output_file:
+            source_map_writer = None
+            if args.source_map:
+                source_map_writer = output_file = SourceMapWriter(
+                    output_file)
+            code_writer = new_code_writer(output_file, args)
+            write_program(code_writer,
+                          [(file_name, None, commands, args)
+                           for file_name, commands in programs],
+                          has_sys,
+                          fragments=[fragments[file_name][2]
+                                     for file_name, _ in programs])
+            code_writer.close()
+        if source_map_writer is not None:
+            source_map_path = (os.path.splitext(self.output_path)[0] +
+                               '.map.json')
+            source_map_writer.save(source_map_path + '.tmp')
+            os.replace(source_map_path + '.tmp', source_map_path)
+        os.replace(temp_path, self.output_path)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Translates a VM program and keeps translating it as '
+                    'its .vm files change, reusing the parsed and '
+                    'translated unchanged files.',
+        epilog='Arguments after -- are passed to the translator, e.g. '
+               '"-- -O1 --source-map".')
+    arg_parser.add_argument(
+        'input_path', help='path to a .vm file or a directory of .vm files')
+    arg_parser.add_argument(
+        '--interval', type=float, default=0.02,
+        help='seconds between checks for changed files (default: '
+             '%(default)s)')
+    argv, translator_args = split_translator_args(sys.argv[1:])
+    args = arg_parser.parse_args(argv)
+
+    translate_args = parse_args([args.input_path] + translator_args)
+    if translate_args.profile or translate_args.cprofile is not None:
+        arg_parser.error('--profile and --cprofile are not supported in '
+                         'watch mode')
+    # Templates stay compiled across retranslations
+    VMTranslator.shared_templates = {}
+    watcher = ProgramWatcher(args.input_path, translate_args)
+    print(f'Watching {args.input_path}, press Ctrl+C to stop')
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                changed = watcher.poll()
+            except (OSError, ValueError) as e:
+                print(f'Translation Error: {e}')
+            else:
+                if changed:
+                    print(f'{len(changed)} files changed, translated in '
+                          f'{(time.perf_counter() - start) * 1000:.1f} ms. '
+                          f'Output written to {watcher.output_path}')
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from HackAssembler import HackWriter, assemble
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'test_fixtures')
+
+
+def read_fixture(name, mode='r'):
+    """Returns the contents of a file in test_fixtures."""
+    with open(os.path.join(FIXTURE_DIR, name), mode) as file:
+        return file.read()
+
+
+class AssemblerFixtureTest(unittest.TestCase):
+    """
+    Assembles test_fixtures/Assembler.asm, which uses predefined symbols,
+    labels, variables and every comp, dest and jump form, and compares
+    the result word for word with test_fixtures/Assembler.hack.
+    """
+
+    def setUp(self):
+        self.source = read_fixture('Assembler.asm')
+        self.expected = read_fixture('Assembler.hack')
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.output_dir.cleanup)
+
+    def write(self, chunks, binary=False):
+        """
+        Writes the chunks of assembly text through a HackWriter and
+        returns what it wrote to its output file.
+        """
+        output_path = os.path.join(self.output_dir.name, 'Assembler.out')
+        hack_writer = HackWriter(open(output_path, 'wb' if binary else 'w'),
+                                 binary=binary)
+        for chunk in chunks:
+            hack_writer.write(chunk)
+        hack_writer.close()
+        with open(output_path, 'rb' if binary else 'r') as file:
+            return file.read()
+
+    def test_assemble(self):
+        words, labels, variables = assemble(self.source.splitlines())
+        self.assertEqual([f'{word:016b}' for word in words],
+                         self.expected.splitlines())
+        self.assertEqual(labels, {'FORWARD': 35, 'LOOP': 39, 'END': 92})
+        self.assertEqual(variables, {'counter': 16, 'total': 17,
+                                     'sum.0': 18})
+
+    def test_hack_writer(self):
+        self.assertEqual(self.write([self.source]), self.expected)
+
+    def test_hack_writer_line_by_line(self):
+        # As a CodeWriter writes it: the symbols used before their label
+        # is declared resolve in close
+        chunks = [line + '\n' for line in self.source.splitlines()]
+        self.assertEqual(self.write(chunks), self.expected)
+
+    def test_hack_writer_binary(self):
+        expected = b''.join(int(line, 2).to_bytes(2, 'big')
+                            for line in self.expected.splitlines())
+        self.assertEqual(self.write([self.source], binary=True), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+from BatchTranslator import translate_batch
+from VMTranslator import split_translator_args
+
+
+GOOD_VM = 'function Main.main 0\npush constant 7\nreturn\n'
+# Translates partially: A.vm is written out before B.vm fails
+FAILING_PROGRAM = {
+    'A.vm': 'function A.f 0\npush constant 1\nreturn\n' * 200,
+    'B.vm': 'function B.g 0\npush constant 1\nfrobnicate\nreturn\n',
+}
+
+
+class BatchTranslatorTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_program(self, name, files):
+        """Writes a program directory and returns its path."""
+        program_dir = os.path.join(self.directory, name)
+        os.mkdir(program_dir)
+        for file_name, text in files.items():
+            with open(os.path.join(program_dir, file_name), 'w') as file:
+                file.write(text)
+        return program_dir
+
+    def read_outputs(self, records):
+        outputs = {}
+        for record in records:
+            with open(record['output']) as file:
+                outputs[record['path']] = file.read()
+        return outputs
+
+    def test_failing_program_leaves_other_programs_alone(self):
+        good_paths = [self.write_program('First', {'Main.vm': GOOD_VM}),
+                      self.write_program('Last', {'Main.vm': GOOD_VM})]
+        failing_path = self.write_program('Middle', FAILING_PROGRAM)
+        expected = self.read_outputs(translate_batch(good_paths, []))
+
+        records = translate_batch(
+            [good_paths[0], failing_path, good_paths[1]], [])
+        self.assertEqual([record['status'] for record in records],
+                         ['ok', 'error', 'ok'])
+        self.assertIn('frobnicate', records[1]['error'])
+        self.assertEqual(self.read_outputs([records[0], records[2]]),
+                         expected)
+        # The partial output of the failing program is removed
+        self.assertFalse(os.path.exists(
+            os.path.join(failing_path, 'Middle.asm')))
+
+    def test_split_translator_args(self):
+        self.assertEqual(split_translator_args(['a', '--', '-O', '1']),
+                         (['a'], ['-O', '1']))
+        self.assertEqual(split_translator_args(['a', '-j', '2']),
+                         (['a', '-j', '2'], []))
+        self.assertEqual(split_translator_args(['--', 'x', '--', 'y']),
+                         ([], ['x', '--', 'y']))
+
+
+if __name__ == '__main__':
+    unittest.main()
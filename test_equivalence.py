@@ -0,0 +1,419 @@
+import os
+import tempfile
+import unittest
+
+from HackAssembler import assemble
+from HackEmulator import HackEmulator
+from Parser import Command, CommandType, Parser
+from VMTranslator import (find_program_files, match_fused_branch,
+                          parse_args, translate_program)
+
+
+# Cycles a test program may run for before it counts as hung
+MAX_CYCLES = 1000000
+
+
+def run_program(files, options):
+    """
+    Translates a program, given as a dict of .vm file names to their text,
+    with the given translator options and runs it on the emulator until it
+    halts. Returns the RAM the programs leave their results in, temp and
+    3000-3099, and the result of translate_program.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        program_dir = os.path.join(directory, 'Program')
+        os.mkdir(program_dir)
+        for file_name, text in files.items():
+            with open(os.path.join(program_dir, file_name), 'w') as file:
+                file.write(text)
+        output_path, files_to_translate = find_program_files(program_dir,
+                                                             'asm')
+        result = translate_program(files_to_translate, output_path,
+                                   parse_args([program_dir] + options))
+        with open(output_path) as file:
+            words, labels, _ = assemble(file.read().splitlines())
+
+    emulator = HackEmulator(words, labels)
+    emulator.run(MAX_CYCLES, profile=False)
+    if not emulator.halted:
+        raise AssertionError(f'Program did not halt with {options}')
+    return emulator.read_ram(5, 13) + emulator.read_ram(3000, 3100), result
+
+
+def vm(*lines):
+    """Returns the text of a .vm file with the given commands."""
+    return '\n'.join(lines) + '\n'
+
+
+INLINE_PROGRAM = {
+    'Sys.vm': vm(
+        'function Sys.init 0',
+        'push constant 3000', 'pop pointer 1',
+        'push constant 7', 'pop that 0',
+        'push constant 3000', 'call Point.getx 1', 'pop temp 0',
+        'push constant 3000', 'push constant 42', 'call Point.setx 2',
+        'pop temp 1',
+        'push constant 3000', 'call Point.getx 1', 'pop temp 2',
+        'push constant 5',
+        'push constant 0', 'push constant 13', 'sub', 'call Math.abs 1',
+        'push constant 4', 'call Math.max 2', 'add', 'pop temp 3',
+        'push constant 3', 'push constant 20', 'call Math.swapsub 2',
+        'pop temp 4',
+        'call Point.count 0', 'call Point.count 0', 'add', 'pop temp 5',
+        'push constant 9', 'push constant 2', 'push constant 3',
+        'call Math.mix 3', 'pop temp 6',
+        'push pointer 1', 'pop temp 7',
+        'label Sys.init$HALT',
+        'goto Sys.init$HALT'),
+    'Math.vm': vm(
+        'function Math.abs 0',
+        'push argument 0', 'push constant 0', 'lt',
+        'if-goto Math.abs$NEG',
+        'push argument 0', 'return',
+        'label Math.abs$NEG',
+        'push argument 0', 'neg', 'return',
+        'function Math.max 1',
+        'push argument 0', 'pop local 0',
+        'push argument 1', 'push local 0', 'gt', 'not',
+        'if-goto Math.max$DONE',
+        'push argument 1', 'pop local 0',
+        'label Math.max$DONE',
+        'push local 0', 'return',
+        # Pops to its arguments, which inlined live on the stack
+        'function Math.swapsub 0',
+        'push argument 1', 'push argument 0',
+        'pop argument 1', 'pop argument 0',
+        'push argument 0', 'push argument 1', 'sub', 'return',
+        # Leaves a three word deep frame behind its return value
+        'function Math.mix 2',
+        'push argument 0', 'push argument 1', 'sub', 'pop local 0',
+        'push argument 2', 'pop local 1',
+        'push local 0', 'push local 1', 'add', 'return'),
+    'Point.vm': vm(
+        'function Point.getx 0',
+        'push argument 0', 'pop pointer 0', 'push this 0', 'return',
+        'function Point.setx 0',
+        'push argument 0', 'pop pointer 0',
+        'push argument 1', 'pop this 0',
+        'push constant 0', 'return',
+        'function Point.count 0',
+        'push static 0', 'push constant 1', 'add', 'pop static 0',
+        'push static 0', 'return'),
+}
+
+
+TAIL_CALL_PROGRAM = {
+    'Sys.vm': vm(
+        'function Sys.init 0',
+        'push constant 200', 'push constant 0', 'call Tail.sum 2',
+        'pop temp 0',
+        'push constant 7', 'call Tail.one 1', 'pop temp 1',
+        'push constant 5', 'push constant 6', 'push constant 7',
+        'push constant 8', 'call Tail.four 4', 'pop temp 2',
+        'push constant 3', 'call Tail.zeroer 1', 'pop temp 3',
+        'push constant 9', 'call Tail.wrap 1', 'pop temp 4',
+        'label Sys.init$HALT',
+        'goto Sys.init$HALT'),
+    'Tail.vm': vm(
+        # Tail recursion with the same number of arguments
+        'function Tail.sum 1',
+        'push argument 0', 'push constant 0', 'eq',
+        'if-goto Tail.sum$DONE',
+        'push argument 0', 'pop local 0',
+        'push local 0', 'push constant 1', 'sub',
+        'push argument 1', 'push local 0', 'add',
+        'call Tail.sum 2', 'return',
+        'label Tail.sum$DONE',
+        'push argument 1', 'return',
+        # Tail calls with more arguments than the caller has
+        'function Tail.one 2',
+        'push argument 0', 'push constant 1', 'add',
+        'push argument 0', 'push constant 2', 'add',
+        'push argument 0', 'push constant 3', 'add',
+        'call Tail.three 3', 'return',
+        'function Tail.three 1',
+        'push argument 0', 'push argument 1', 'add',
+        'push argument 2', 'sub', 'pop local 0',
+        'push local 0', 'push constant 10', 'call Tail.mul 2', 'return',
+        'function Tail.mul 0',
+        'push argument 0', 'push argument 1', 'add', 'return',
+        # Tail calls with fewer arguments than the caller has
+        'function Tail.four 3',
+        'push argument 0', 'push argument 1', 'add',
+        'push argument 2', 'add', 'push argument 3', 'sub',
+        'call Tail.neg 1', 'return',
+        'function Tail.neg 0',
+        'push argument 0', 'neg', 'return',
+        'function Tail.zeroer 0',
+        'call Tail.const 0', 'return',
+        'function Tail.const 1',
+        'push constant 42', 'pop local 0', 'push local 0', 'return',
+        # A tail call after a normal call, with the caller's pointers set
+        'function Tail.wrap 0',
+        'push constant 3050', 'pop pointer 1',
+        'push argument 0', 'pop that 0',
+        'push constant 1', 'push constant 2', 'call Tail.mul 2',
+        'push argument 0', 'call Tail.mul 2', 'return'),
+}
+
+
+STACK_CACHE_PROGRAM = {
+    'Sys.vm': vm(
+        'function Sys.init 0',
+        'push constant 3000', 'pop pointer 1',
+        # x comes from RAM, so that constant folding leaves the operations
+        'push constant 5', 'pop temp 7',
+        'push constant 12', 'push temp 7', 'sub',
+        'push constant 3', 'neg', 'add', 'not', 'pop that 0',
+        'push temp 7', 'push constant 3', 'and',
+        'push constant 8', 'or', 'pop that 1',
+        'push temp 7', 'push temp 7', 'eq',
+        'push temp 7', 'push constant 9', 'lt', 'and',
+        'push constant 9', 'push temp 7', 'gt', 'or', 'pop that 2',
+        # Constant operands, including ones that are not plain loads
+        'push temp 7', 'push constant 1', 'add',
+        'push constant 1', 'sub', 'push constant 32767', 'add',
+        'pop that 3',
+        'push temp 7', 'push constant 32767', 'neg',
+        'push constant 1', 'sub', 'or', 'pop that 4',
+        'push temp 7', 'push constant 7', 'neg', 'and', 'pop that 5',
+        'push temp 7', 'push constant 7', 'lt', 'pop that 6',
+        'push temp 7', 'push constant 3', 'neg', 'gt', 'pop that 7',
+        'push temp 7', 'push constant 5', 'eq', 'not', 'pop that 8',
+        # Tops left at labels, jumps and calls
+        'push constant 0', 'pop temp 0',
+        'push constant 10', 'pop temp 1',
+        'label Sys.init$LOOP',
+        'push temp 1', 'push constant 0', 'gt', 'not',
+        'if-goto Sys.init$END',
+        'push temp 0', 'push temp 1', 'add', 'pop temp 0',
+        'push temp 1', 'push constant 1', 'sub', 'pop temp 1',
+        'goto Sys.init$LOOP',
+        'label Sys.init$END',
+        'push constant 7', 'push constant 2',
+        'push constant 3', 'call Main.mix 2', 'add', 'pop temp 2',
+        'push constant 9', 'call Main.deep 1', 'pop temp 3',
+        'push constant 1', 'if-goto Sys.init$TAKEN',
+        'push constant 99', 'pop temp 4',
+        'label Sys.init$TAKEN',
+        'push constant 0', 'if-goto Sys.init$HALT',
+        'push constant 33', 'pop temp 5',
+        'label Sys.init$HALT',
+        'goto Sys.init$HALT'),
+    'Main.vm': vm(
+        'function Main.mix 2',
+        'push argument 0', 'push argument 1', 'sub', 'pop local 0',
+        'push argument 1', 'pop local 1',
+        'push local 0', 'push local 1', 'add', 'return',
+        # Pops to a local too far away to store from D
+        'function Main.deep 9',
+        'push argument 0', 'push constant 2', 'add', 'pop local 8',
+        'push local 8', 'push local 8', 'add', 'pop static 0',
+        'push static 0', 'return'),
+}
+
+
+DEDUPLICATION_PROGRAM = {
+    'Sys.vm': vm(
+        'function Sys.init 0',
+        'push constant 3100', 'pop pointer 1',
+        'push constant 77', 'pop that 0',
+        'push constant 3100', 'call A.get 1', 'pop temp 0',
+        'push constant 3100', 'call B.get 1', 'pop temp 1',
+        'push constant 5', 'call A.sum 1', 'pop temp 2',
+        'push constant 6', 'call B.sum 1', 'pop temp 3',
+        'push constant 10', 'call A.bump 1', 'pop temp 4',
+        'push constant 20', 'call A.bump2 1', 'pop temp 5',
+        'push constant 5', 'call B.bump 1', 'pop temp 6',
+        'push constant 5', 'call B.bump 1', 'pop temp 7',
+        'label Sys.init$HALT',
+        'goto Sys.init$HALT'),
+    'A.vm': vm(
+        'function A.get 0',
+        'push argument 0', 'pop pointer 0', 'push this 0', 'return',
+        'function A.sum 0',
+        'push argument 0', 'push constant 0', 'eq', 'if-goto A.sum$ZERO',
+        'push argument 0', 'push argument 0', 'push constant 1', 'sub',
+        'call A.sum 1', 'add', 'return',
+        'label A.sum$ZERO',
+        'push constant 0', 'return',
+        # Same body as A.bump, on the same statics
+        'function A.bump 0',
+        'push static 0', 'push argument 0', 'add', 'pop static 0',
+        'push static 0', 'return',
+        'function A.bump2 0',
+        'push static 0', 'push argument 0', 'add', 'pop static 0',
+        'push static 0', 'return'),
+    'B.vm': vm(
+        'function B.get 0',
+        'push argument 0', 'pop pointer 0', 'push this 0', 'return',
+        'function B.sum 0',
+        'push argument 0', 'push constant 0', 'eq', 'if-goto B.sum$ZERO',
+        'push argument 0', 'push argument 0', 'push constant 1', 'sub',
+        'call B.sum 1', 'add', 'return',
+        'label B.sum$ZERO',
+        'push constant 0', 'return',
+        # Same body as A.bump, but on the statics of B
+        'function B.bump 0',
+        'push static 0', 'push argument 0', 'add', 'pop static 0',
+        'push static 0', 'return'),
+}
+
+
+def push_value(value):
+    """Returns the commands that push a possibly negative value."""
+    if value < 0:
+        return [f'push constant {-value}', 'neg']
+    return [f'push constant {value}']
+
+
+def fused_branch_program():
+    """
+    Returns a program that branches on every comparison, with and without
+    'not', with a variable and with a constant y, for x below, equal to
+    and above y. Then come the sequences that must not be fused: a label
+    between the comparison and the if-goto, and comparisons whose result
+    is stored rather than branched on. Each result goes to RAM 3000 on.
+    """
+    lines = ['function Sys.init 0', 'push constant 3000', 'pop pointer 1']
+    cases = [(comparison, negate, x, y, constant_y)
+             for comparison in ('eq', 'lt', 'gt')
+             for negate in (False, True)
+             for x, y in ((-2, 5), (5, 5), (7, 5))
+             for constant_y in (False, True)]
+    for index, (comparison, negate, x, y, constant_y) in enumerate(cases):
+        lines += push_value(x) + ['pop static 0']
+        lines += push_value(y) + ['pop static 1']
+        lines += ['push static 0']
+        lines += push_value(y) if constant_y else ['push static 1']
+        lines += [comparison] + (['not'] if negate else [])
+        lines += [f'if-goto TAKEN{index}',
+                  'push constant 2', f'pop that {index}',
+                  f'goto NEXT{index}',
+                  f'label TAKEN{index}',
+                  'push constant 1', f'pop that {index}',
+                  f'label NEXT{index}']
+    index = len(cases)
+    for comparison in ('eq', 'lt', 'gt'):
+        for negate in (False, True):
+            not_lines = ['not'] if negate else []
+            lines += ['push static 0', 'push static 1', comparison,
+                      *not_lines, f'label MIDDLE{index}',
+                      f'if-goto TAKEN{index}',
+                      'push constant 2', f'pop that {index}',
+                      f'goto NEXT{index}',
+                      f'label TAKEN{index}',
+                      'push constant 1', f'pop that {index}',
+                      f'label NEXT{index}',
+                      'push static 1', 'push static 0', comparison,
+                      *not_lines, f'pop that {index + 1}']
+            index += 2
+    lines += ['label Sys.init$HALT', 'goto Sys.init$HALT']
+    return {'Sys.vm': vm(*lines)}
+
+
+FUSED_BRANCH_PROGRAM = fused_branch_program()
+
+
+class EquivalenceTest(unittest.TestCase):
+    def assert_equivalent(self, files, options_list):
+        """
+        Checks that the program leaves the same results with each of the
+        option lists as without optimization. Returns the results of
+        translate_program, one per option list.
+        """
+        expected, _ = run_program(files, ['-O', '0'])
+        results = []
+        for options in options_list:
+            with self.subTest(options=options):
+                ram, result = run_program(files, options)
+                self.assertEqual(ram, expected)
+                results.append(result)
+        return results
+
+    def test_inlining(self):
+        results = self.assert_equivalent(
+            INLINE_PROGRAM, [['--inline'], ['--inline', '-O1'], ['-O2']])
+        for result in results:
+            self.assertIn('Math.swapsub', result['inlined'])
+            self.assertIn('Math.mix', result['inlined'])
+
+    def test_tail_calls(self):
+        results = self.assert_equivalent(
+            TAIL_CALL_PROGRAM,
+            [['--tail-calls'], ['--tail-calls', '--shared-calls'],
+             ['--tail-calls', '-O1'], ['-Os']])
+        for result in results:
+            self.assertGreater(
+                result['code_writer'].stats()['tail_call_count'], 0)
+
+    def test_stack_cache(self):
+        results = self.assert_equivalent(
+            STACK_CACHE_PROGRAM,
+            [['--stack-cache'], ['--stack-cache', '-O1'],
+             ['--stack-cache', '-O1', '--shared-compares'],
+             ['-O2'], ['-Os']])
+        for result in results:
+            self.assertGreater(
+                result['code_writer'].stats()['spill_count'], 0)
+
+    def test_fused_branches(self):
+        self.assert_equivalent(
+            FUSED_BRANCH_PROGRAM,
+            [['--fuse-branches'], ['--fuse-branches', '--fold-constants'],
+             ['-O1'], ['-O1', '--shared-compares'], ['-O2'], ['-Os'],
+             ['-Os', '--shared-compares']])
+
+    def test_deduplication(self):
+        results = self.assert_equivalent(
+            DEDUPLICATION_PROGRAM,
+            [['--deduplicate-functions'],
+             ['--deduplicate-functions', '-O1'], ['-Os'],
+             ['-Os', '--source-map']])
+        for result in results:
+            merged = {function_name: kept_name for _, function_name,
+                      kept_name, _ in result['merged_functions']}
+            self.assertEqual(merged, {'B.get': 'A.get', 'B.sum': 'A.sum',
+                                      'A.bump2': 'A.bump'})
+
+
+def match(*lines):
+    """Returns what match_fused_branch finds at the first of the lines."""
+    return match_fused_branch([Parser.parse_command(line) if
+                               isinstance(line, str) else line
+                               for line in lines], 0)
+
+
+class FusedBranchMatchTest(unittest.TestCase):
+    def test_fuses_comparisons(self):
+        for comparison, jumps in (('eq', ('JEQ', 'JNE')),
+                                  ('lt', ('JLT', 'JGE')),
+                                  ('gt', ('JGT', 'JLE'))):
+            with self.subTest(comparison=comparison):
+                self.assertEqual(match(comparison, 'if-goto L'),
+                                 (2, jumps[0], 'L', None))
+                self.assertEqual(match(comparison, 'not', 'if-goto L'),
+                                 (3, jumps[1], 'L', None))
+                constant = Command(CommandType.C_ARITHMETIC_CONSTANT,
+                                   comparison, 5)
+                self.assertEqual(match(constant, 'if-goto L'),
+                                 (2, jumps[0], 'L', 5))
+                self.assertEqual(match(constant, 'not', 'if-goto L'),
+                                 (3, jumps[1], 'L', 5))
+        self.assertEqual(match('not', 'if-goto L'), (2, None, 'L', None))
+
+    def test_does_not_fuse(self):
+        for lines in (('lt', 'label M', 'if-goto L'),
+                      ('lt', 'not', 'label M', 'if-goto L'),
+                      ('not', 'label M', 'if-goto L'),
+                      ('lt', 'pop temp 0'),
+                      ('lt', 'not', 'pop temp 0'),
+                      ('lt', 'goto L'),
+                      ('add', 'if-goto L'),
+                      ('lt',)):
+            with self.subTest(lines=lines):
+                self.assertIsNone(match(*lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+// Assembler fixture: predefined symbols, labels, variables, numbers and
+// every comp, dest and jump form of the Hack instruction set
+
+// Predefined symbols
+@SP
+@LCL
+@ARG
+@THIS
+@THAT
+@R0
+@R1
+@R2
+@R3
+@R4
+@R5
+@R6
+@R7
+@R8
+@R9
+@R10
+@R11
+@R12
+@R13
+@R14
+@R15
+@SCREEN
+@KBD
+
+// Numbers
+@0
+@1
+@16
+@32767
+
+// Variables get RAM addresses from 16 in order of first use; a label
+// declared after its first use is not a variable
+@counter
+M=0
+@FORWARD
+0;JMP
+@total
+M=1
+@counter
+D=M
+(FORWARD)
+@total
+D=D+M
+@sum.0
+M=D
+
+(LOOP)
+// Computations with a = 0
+D=0
+D=1
+D=-1
+D=D
+D=A
+D=!D
+D=!A
+D=-D
+D=-A
+D=D+1
+D=A+1
+D=D-1
+D=A-1
+D=D+A
+D=A+D
+D=D-A
+D=A-D
+D=D&A
+D=A&D
+D=D|A
+D=A|D
+// Computations with a = 1
+D=M
+D=!M
+D=-M
+D=M+1
+D=M-1
+D=D+M
+D=M+D
+D=D-M
+D=M-D
+D=D&M
+D=M&D
+D=D|M
+D=M|D
+// Destinations
+0
+M=0
+D=0
+MD=0
+A=0
+AM=0
+AD=0
+AMD=0
+// Jumps
+@LOOP
+0;JMP
+D;JGT
+D;JEQ
+D;JGE
+D;JLT
+D;JNE
+D;JLE
+D;JMP
+AM=M-1;JNE   // dest, comp and jump together
+@END
+(END)
+@END
+0;JMP
@@ -0,0 +1,48 @@
+import io
+import unittest
+
+from Parser import Parser
+from Peephole import DEFAULT_RULES
+from VMTranslator import new_code_writer, parse_args, write_commands
+
+
+# For each peephole rule, VM commands whose CodeWriter output it rewrites,
+# and the translator options they are translated with
+RULE_EXAMPLES = {
+    'inc_dec': (['push local 0', 'neg'], []),
+    'fold_dec_load': (['push constant 1', 'pop temp 0'], []),
+    'fold_inc_load': (['function Main.f 2'], []),
+    'store_reload': (['pop static 1', 'push static 1'], []),
+    'redundant_a_reload': (['push temp 0', 'push temp 1', 'add'], []),
+}
+
+
+def peephole_hits(lines, options):
+    """
+    Translates the given VM commands with the peephole optimizer on and
+    returns its per-rule hit counts.
+    """
+    args = parse_args(['Main.vm', '--peephole'] + options)
+    code_writer = new_code_writer(io.StringIO(), args)
+    code_writer.set_file_name('Main')
+    write_commands(code_writer, [Parser.parse_command(line)
+                                 for line in lines],
+                   fuse_branches=args.fuse_branches,
+                   tail_calls=args.tail_calls)
+    code_writer.flush()
+    return code_writer.peephole.hits
+
+
+class PeepholeRuleTest(unittest.TestCase):
+    def test_every_rule_has_an_example(self):
+        self.assertEqual({name for name, _, _ in DEFAULT_RULES},
+                         set(RULE_EXAMPLES))
+
+    def test_every_rule_fires_on_code_writer_output(self):
+        for name, (lines, options) in RULE_EXAMPLES.items():
+            with self.subTest(rule=name):
+                self.assertGreater(peephole_hits(lines, options)[name], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import TranslationCache as translation_cache
+from TranslationCache import TranslationCache, is_translator_module
+from VMTranslator import find_program_files, parse_args, translate_program
+
+
+MAIN_VM = 'function Main.main 0\npush constant 1\nreturn\n'
+SYS_VM = ('function Sys.init 0\ncall Main.main 0\npop temp 0\n'
+          'label END\ngoto END\n')
+
+
+class TranslationCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.program_dir = os.path.join(directory.name, 'Program')
+        self.cache_dir = os.path.join(directory.name, 'cache')
+        os.mkdir(self.program_dir)
+        self.write_file('Main.vm', MAIN_VM)
+        self.write_file('Sys.vm', SYS_VM)
+
+    def write_file(self, file_name, text):
+        with open(os.path.join(self.program_dir, file_name), 'w') as file:
+            file.write(text)
+
+    def translate(self, options=()):
+        """
+        Translates the program with the cache and returns the output and
+        the cache's (hits, misses).
+        """
+        output_path, files_to_translate = find_program_files(
+            self.program_dir, 'asm')
+        args = parse_args([self.program_dir, '--cache', '--cache-dir',
+                           self.cache_dir, *options])
+        cache = translate_program(files_to_translate, output_path,
+                                  args)['cache']
+        with open(output_path) as file:
+            return file.read(), (cache.hits, cache.misses)
+
+    def test_hits_on_unchanged_program(self):
+        output, counts = self.translate()
+        self.assertEqual(counts, (0, 2))
+        self.assertEqual(self.translate(), (output, (2, 0)))
+
+    def test_misses_on_changed_source(self):
+        self.translate()
+        self.write_file('Main.vm', MAIN_VM.replace('constant 1',
+                                                   'constant 2'))
+        output, counts = self.translate()
+        self.assertEqual(counts, (1, 1))
+        self.assertIn('@2', output)
+
+    def test_misses_on_changed_options(self):
+        self.translate()
+        self.assertEqual(self.translate(['-O', '1'])[1], (0, 2))
+        self.assertEqual(self.translate(['-O', '1'])[1], (2, 0))
+
+    def test_misses_on_changed_translator(self):
+        self.translate()
+        with mock.patch.object(translation_cache, 'translator_version',
+                               return_value='changed'):
+            self.assertEqual(self.translate()[1], (0, 2))
+
+    def test_translator_version_covers_only_translator_modules(self):
+        self.assertTrue(is_translator_module('CodeWriter.py'))
+        self.assertFalse(is_translator_module('test_peephole.py'))
+        self.assertFalse(is_translator_module('Benchmark.py'))
+        self.assertFalse(is_translator_module('requests.jsonl'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from VMTranslator import parse_args
+from WatchTranslator import ProgramWatcher
+
+
+MAIN_VM = 'function Main.main 0\npush constant 1\nreturn\n'
+SYS_VM = ('function Sys.init 0\ncall Main.main 0\npop temp 0\n'
+          'label END\ngoto END\n')
+HELPER_VM = ('function Helper.twice 0\npush argument 0\npush argument 0\n'
+             'add\nreturn\n')
+
+
+class ProgramWatcherTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.program_dir = os.path.join(directory.name, 'Program')
+        self.output_path = os.path.join(self.program_dir, 'Program.asm')
+        os.mkdir(self.program_dir)
+        self.write_file('Main.vm', MAIN_VM)
+        self.write_file('Sys.vm', SYS_VM)
+        self.watcher = ProgramWatcher(self.program_dir,
+                                      parse_args([self.program_dir]))
+
+    def path(self, file_name):
+        return os.path.join(self.program_dir, file_name)
+
+    def write_file(self, file_name, text):
+        with open(self.path(file_name), 'w') as file:
+            file.write(text)
+
+    def read_output(self):
+        with open(self.output_path) as file:
+            return file.read()
+
+    def test_add_remove_rebuild_cycle(self):
+        self.assertEqual(self.watcher.poll(),
+                         [self.path('Main.vm'), self.path('Sys.vm')])
+        first_output = self.read_output()
+        self.assertEqual(self.watcher.poll(), [])
+
+        self.write_file('Helper.vm', HELPER_VM)
+        self.assertEqual(self.watcher.poll(), [self.path('Helper.vm')])
+        self.assertIn('(Helper.twice)', self.read_output())
+
+        # Only the modified file is translated again
+        sys_fragment = self.watcher.fragments['Sys']
+        self.write_file('Main.vm', MAIN_VM.replace('constant 1',
+                                                   'constant 12345'))
+        self.assertEqual(self.watcher.poll(), [self.path('Main.vm')])
+        self.assertIs(self.watcher.fragments['Sys'], sys_fragment)
+        self.assertIn('@12345', self.read_output())
+
+        os.remove(self.path('Helper.vm'))
+        self.write_file('Main.vm', MAIN_VM)
+        self.assertEqual(self.watcher.poll(),
+                         [self.path('Helper.vm'), self.path('Main.vm')])
+        self.assertEqual(self.read_output(), first_output)
+
+    def test_output_is_replaced_atomically(self):
+        with mock.patch('os.replace', wraps=os.replace) as replace:
+            self.watcher.poll()
+        replace.assert_called_once_with(self.output_path + '.tmp',
+                                        self.output_path)
+        self.assertEqual(sorted(os.listdir(self.program_dir)),
+                         ['Main.vm', 'Program.asm', 'Sys.vm'])
+
+    def test_failed_rebuild_keeps_previous_output(self):
+        self.watcher.poll()
+        output = self.read_output()
+        self.write_file('Main.vm', MAIN_VM + 'frobnicate\n')
+        with self.assertRaises(ValueError):
+            self.watcher.poll()
+        self.assertEqual(self.read_output(), output)
+        self.assertFalse(os.path.exists(self.output_path + '.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()